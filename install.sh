@@ -46,13 +46,30 @@ echo
 let stat=0
 
 $INSTALL_PGM -v $SRCDIR/backup.py $DESTDIR || let stat+=1
+$INSTALL_PGM -v $SRCDIR/capacity.py $DESTDIR || let stat+=1
+$INSTALL_PGM -v $SRCDIR/catalog.py $DESTDIR || let stat+=1
+$INSTALL_PGM -v $SRCDIR/compression.py $DESTDIR || let stat+=1
 $INSTALL_PGM -v $SRCDIR/daemon.py $DESTDIR || let stat+=1
 $INSTALL_PGM -v $SRCDIR/deletor.py $DESTDIR || let stat+=1
+$INSTALL_PGM -v $SRCDIR/destindex.py $DESTDIR || let stat+=1
+$INSTALL_PGM -v $SRCDIR/eventloop.py $DESTDIR || let stat+=1
 $INSTALL_PGM -v $SRCDIR/helper.py $DESTDIR || let stat+=1
 $INSTALL_PGM -v $SRCDIR/__init__.py $DESTDIR || let stat+=1
 $INSTALL_PGM -v $SRCDIR/init.py $DESTDIR || let stat+=1
+$INSTALL_PGM -v $SRCDIR/journal.py $DESTDIR || let stat+=1
+$INSTALL_PGM -v $SRCDIR/localcopy.py $DESTDIR || let stat+=1
 $INSTALL_PGM -v $SRCDIR/logger.py $DESTDIR || let stat+=1
+$INSTALL_PGM -v $SRCDIR/metascan.py $DESTDIR || let stat+=1
 $INSTALL_PGM -v $SRCDIR/openduckbilld.py $DESTDIR || let stat+=1
+$INSTALL_PGM -v $SRCDIR/pathtrie.py $DESTDIR || let stat+=1
+$INSTALL_PGM -v $SRCDIR/pendinglog.py $DESTDIR || let stat+=1
+$INSTALL_PGM -v $SRCDIR/planner.py $DESTDIR || let stat+=1
+$INSTALL_PGM -v $SRCDIR/rescan.py $DESTDIR || let stat+=1
+$INSTALL_PGM -v $SRCDIR/restore.py $DESTDIR || let stat+=1
+$INSTALL_PGM -v $SRCDIR/scheduler.py $DESTDIR || let stat+=1
+$INSTALL_PGM -v $SRCDIR/snapshot.py $DESTDIR || let stat+=1
+$INSTALL_PGM -v $SRCDIR/sshmux.py $DESTDIR || let stat+=1
+$INSTALL_PGM -v $SRCDIR/versionstore.py $DESTDIR || let stat+=1
 $INSTALL_PGM -v $DOCSDIR/README $DESTDIR || let stat+=1
 $INSTALL_PGM -v $DOCSDIR/README.access $DESTDIR || let stat+=1
 
@@ -108,11 +125,14 @@ if [ $RUNNING_AS_ROOT ]; then
   echo
   echo "$PROG: Creating symlink /usr/bin/openduckbill"
   ln -svf $DESTDIR/openduckbilld.py /usr/bin/openduckbill
+  echo "$PROG: Creating symlink /usr/bin/openduckbill-restore"
+  ln -svf $DESTDIR/restore.py /usr/bin/openduckbill-restore
 else
   echo
   echo "$PROG: You might want to create a symbolic link from '$DESTDIR/openduckbilld.py' to '/usr/bin/openduckbill'"
   echo "$PROG: Run following command as root"
   echo "    ln -sf $DESTDIR/openduckbilld.py /usr/bin/openduckbill"
+  echo "    ln -sf $DESTDIR/restore.py /usr/bin/openduckbill-restore"
 fi
 
 echo
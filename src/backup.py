@@ -29,22 +29,131 @@ backup module takes care of the core functionality of the application which
 is, performing a backup. Also includes preparing an rsync command
 depending on various options passed, like whether it has to do a full backup,
 backup a modified path, recursive backup, non-recursive backup or dry-run.
-Further this is done either in a threaded or non-threaded manner.
+Further this is done either in worker threads (initial backup, several
+entries at a time) or asynchronously, with rsync run as a child process of
+the daemon event loop.
 """
 
 import sys
 import os
 import re
+import tempfile
 import threading
+import time
 
+import capacity
+import catalog
 import helper
+import localcopy
+import pathtrie
+import planner
+
+# Exit values of rsync for partial transfers, where the failed files are
+# named in the output.
+RSYNC_PARTIAL = (23, 24)
+
+
+def ScopedPatterns(path, pattern):
+  """Restrict an entry include/exclude pattern to the entry path.
+
+  Used to merge the rules of several entries into one rsync command.
+
+  Args:
+    path: String - Entry path.
+    pattern: String - rsync include/exclude pattern.
+
+  Returns:
+    List - Equivalent anchored patterns, None if pattern can not be scoped
+      (it matches paths with a "/" but is not absolute).
+  """
+
+  if pattern.startswith('/'):
+    return [pattern]
+  if '/' in pattern.rstrip('/'):
+    return None
+  path = os.path.normpath(path).rstrip('/')
+  return [path + '/' + pattern, path + '/**/' + pattern]
+
+
+def ExcludeFileRule(line):
+  """Parse a line of an rsync --exclude-from file.
+
+  Args:
+    line: String - Line, without the newline.
+
+  Returns:
+    Tuple - ('+' or '-', pattern), ('#', line) for a comment or empty line,
+      None if the line is not understood (eg. "!", which clears the rules).
+  """
+
+  if not line or line[0] in '#;':
+    return '#', line
+  if line[:2] in ('- ', '+ '):
+    return line[0], line[2:]
+  if line[0] in '-+!' and (len(line) == 1 or line[1] in ' ,'):
+    return None
+  # Without a prefix, a line of an exclude file is an exclude pattern.
+  return '-', line
+
+
+def FailedPaths(lines):
+  """Find the paths rsync failed to transfer in its output.
+
+  Args:
+    lines: List - Output lines of rsync.
+
+  Returns:
+    List - Paths (as printed by rsync), None if an error does not name the
+      path it is about.
+  """
+
+  paths = []
+  for line in lines:
+    if line.startswith('rsync error:') or line.startswith('rsync warning:'):
+      # Summary line.
+      continue
+    if not (line.startswith('rsync:') or line.startswith('localcopy:') or
+            line.startswith('file has vanished')):
+      continue
+    match = re.search(r'"([^"]+)"', line)
+    if not match:
+      return None
+    paths.append(match.group(1))
+  return paths
+
+
+def BatchKind(startbackup, plan):
+  """Returns how an entry can be batched with others (see BatchBackup).
+
+  Args:
+    startbackup: Object - Backup of the entry, with plan applied.
+    plan: Object - planner.TransferPlan of the entry, or None.
+
+  Returns:
+    String - 'list' (file list), 'tree' (recursive) or None if the entry
+      has to be backed up on its own.
+  """
+
+  if plan is None:
+    return None
+  for patterns in (startbackup.entry_exc, startbackup.entry_inc):
+    for pattern in patterns or []:
+      if pattern and ScopedPatterns(startbackup.entry['path'],
+                                    pattern) is None:
+        return None
+  if plan.mode == planner.MODE_LIST:
+    return 'list'
+  if startbackup.entry['recursive']:
+    return 'tree'
+  return None
+
 
 class Backup:
   """Class which provides methods to perform backups."""
 
   def __init__(self, backupdir, backupbinary, excfile, entry,
                modified_path=None, log_handle='', dryrun=False, 
-               sh_var=None):
+               sh_var=None, filelist=None, deletemissing=False):
     """Initialise environment, which includes setting rsync options list.
 
     Args:
@@ -52,11 +161,17 @@ class Backup:
       backupbinary: String - the rsync binary path
       excfile: String - The filename whihc contains the exclude entries.
       entry: List - List of entries. Each entry is a dictionary.
-      modified_path: List - Paths which were modified. ()
+      modified_path: String or List - Path(s) which were modified. ()
       log_handle: Object - Handle to the logging object.
       dryrun: Boolean - used to specify whether rsync should be executed with a
         "--dry-run" option or not
-      sh_var: List - SSH Variables required when backup method is RSYNC.
+      sh_var: List - SSH Variables required when backup method is RSYNC
+        (ssh path, port, user, server and optionally the remote shell
+        command).
+      filelist: List - Exact paths to transfer (passed to rsync using
+        --files-from). When given, modified_path is ignored.
+      deletemissing: Boolean - filelist contains deleted paths, which have to
+        be removed at the destination (--delete-missing-args).
     """
 
     self.backupbinary = backupbinary
@@ -65,6 +180,8 @@ class Backup:
     self.entry = entry
     self.name = entry['name']
     self.modfied_path = modified_path
+    self.filelist = filelist
+    self.deletemissing = deletemissing
     try:
       self.entry_exc = entry['exclude']
     except KeyError:
@@ -94,13 +211,22 @@ class Backup:
         'tempdir_o': '--temp-dir=',
         'forcedel_o': '--force',
         'shell_o': '-e',
+        'filesfrom_o': '--files-from=',
+        'from0_o': '--from0',
+        'deletemissing_o': '--delete-missing-args',
 	'backup_o' : '-b',
 	'backup_suffix_o' : '--suffix=',
-	'backup_suffix_extn' : '.odb~'
+	'backup_suffix_extn' : '.odb~',
+        'backupdir_o': '--backup-dir='
     }
     self.dryrun = dryrun
     self.logmsg = log_handle
     self.maintainprevious = self.logmsg.maintainprevious
+    # Previous versions go to the version store instead of ".odb~" files.
+    self.versionstore = self.logmsg.versionstore
+    if dryrun:
+      self.versionstore = None
+    self.staging = None
     self.shellvar = sh_var
     if self.shellvar:
       self.sshpath = self.shellvar[0]
@@ -109,7 +235,35 @@ class Backup:
       self.sshserver = self.shellvar[3]
       self.ssh_cmd = [self.sshpath, '-l', self.sshuser, '-p', self.sshport,
                       self.sshserver]
+      if len(self.shellvar) > 4:
+        # Through the ssh master connection, see sshmux.
+        self.sshshell = self.shellvar[4]
+      else:
+        self.sshshell = self.sshpath + ' -p ' + self.sshport
     self.help_backup = helper.CommandHelper(self.logmsg)
+    # Decides on rsync compression (method RSYNC), see compression.
+    self.advisor = None
+    if self.shellvar:
+      self.advisor = self.logmsg.compression
+    self.compress = False
+    # Small file lists to a local destination are copied without rsync.
+    self.localcopy = False
+    self.rules = None
+
+  def ApplyPlan(self, plan):
+    """Back up what a transfer plan says instead of the whole entry.
+
+    Args:
+      plan: Object - planner.TransferPlan of this entry.
+    """
+
+    self.modfied_path = plan.sources
+    if plan.mode == planner.MODE_LIST:
+      self.filelist = plan.filelist
+      self.deletemissing = bool(plan.deletes)
+    else:
+      self.filelist = None
+      self.deletemissing = False
 
   def VerifyBackup(self):
     """Checks whether the entry path (source) exists at the destination.
@@ -144,23 +298,54 @@ class Backup:
     return self.backupretval
 
   def DoBackup(self):
-    """The code that does the rsync command generation.
+    """Performs the actual backup.
 
-    Also performs the actual backup. Backup is done in a sequential manner,
-    with each call to RunCommandPopen waiting for the rsync command to be 
-    completed. RunCommandPopen (Helper) returns exit value of the rsync command.
+    Backup is done in a sequential manner, with each call to RunCommandPopen
+    waiting for the rsync command to be completed. RunCommandPopen (Helper)
+    returns exit value of the rsync command.
 
     Returns:
       backupretval: Integer - Is the exit value obtained from the command
     """
 
+    if self.CanCopyLocally():
+      retval, lines = self.CopyLocally()
+      retval = self.FinishBackup(retval)
+      self.KeepVersions()
+      return retval
+    cmdarglist = self.BuildCommand()
+    if not cmdarglist:
+      self.KeepVersions()
+      return self.backupretval
+    retval = None
+    try:
+      retval = self.help_backup.RunCommandPopen(cmdarglist)
+    finally:
+      retval = self.FinishBackup(retval)
+      self.KeepVersions()
+    return retval
+
+  def BuildCommand(self):
+    """The code that does the rsync command generation.
+
+    A file list (if any) is written to a temporary file, which is removed
+    by FinishBackup. With a version store, the staging directory created
+    for the previous versions is ingested by KeepVersions.
+
+    Returns:
+      cmdarglist: List - The rsync command, None if there is nothing to run
+        (backupretval is set in that case).
+    """
+
     cmdarglist = []
+    self.filelistname = None
+    self.backupretval = None
 
-    if not self.modfied_path:
-      tmpsource = self.entry['path']
+    if self.filelist is not None:
+      # Paths in the file list are relative to "/"
+      backupsources = ['/']
     else:
-      tmpsource = self.modfied_path
-    backupsource = os.path.normpath(os.path.expanduser(tmpsource))
+      backupsources = self.Sources()
     backupdest = self.backupdir
     if self.dryrun:
       cmdarglist.extend([self.backupbinary,
@@ -169,33 +354,52 @@ class Backup:
       cmdarglist.extend([self.backupbinary])
 
     if self.shellvar:
-      shelloptions = [self.rsync_options['shell_o'], self.sshpath + ' -p ' +
-                     self.sshport]
+      shelloptions = [self.rsync_options['shell_o'], self.sshshell]
       cmdarglist.extend(shelloptions)
+    if self.advisor:
+      cmdarglist.extend(self.advisor.Options(self.compress))
 
-    if self.entry['recursive']:
+    if self.filelist is not None:
+      # New directories have been expanded into the list already.
+      cmdarglist.extend([self.rsync_options['norecursive_o']])
+    elif self.Recursive():
       cmdarglist.extend([self.rsync_options['recursive_o']])
     else:
-      if not os.path.isfile(backupsource):
-        backupsource += '/'
+      if not os.path.isfile(backupsources[0]):
+        backupsources[0] += '/'
       cmdarglist.extend([self.rsync_options['norecursive_o']])
 
-    if self.entry_exc:
-      for exc_item in self.entry_exc:
-        if exc_item:
-          cmdarglist.extend(['--exclude=' + exc_item])
-    if self.entry_inc:
-      for inc_item in self.entry_inc:
-        if inc_item:
-          cmdarglist.extend(['--include=' + inc_item])
+    cmdarglist.extend(self.FilterOptions())
 
-    if self.maintainprevious:
+    if self.maintainprevious and self.versionstore:
+      self.staging = self.versionstore.NewStaging()
+      if not self.staging:
+        self.backupretval = 1
+        return None
+      cmdarglist.extend([self.rsync_options['backup_o'],
+                         self.rsync_options['backupdir_o'] + self.staging])
+      # Deleted files are kept in the store as well.
+      if self.filelist is None:
+        cmdarglist.extend([self.rsync_options['delete_o'],
+                           self.rsync_options['deleteafter_o']])
+    elif self.maintainprevious:
       cmdarglist.extend([self.rsync_options['backup_o'], 
                         self.rsync_options['backup_suffix_o'] +
 			self.rsync_options['backup_suffix_extn']])
-    else:
+    elif self.filelist is None:
       cmdarglist.extend([self.rsync_options['delete_o'],
                          self.rsync_options['deleteafter_o']])
+    if self.filelist is not None and self.deletemissing:
+      cmdarglist.extend([self.rsync_options['deletemissing_o']])
+
+    if self.filelist is not None:
+      self.filelistname = self.WriteFileList()
+      if not self.filelistname:
+        self.backupretval = 1
+        return None
+      cmdarglist.extend([self.rsync_options['filesfrom_o'] +
+                         self.filelistname,
+                         self.rsync_options['from0_o']])
     
     if cmdarglist:
       cmdarglist.extend([self.rsync_options['relative_o'],
@@ -210,7 +414,8 @@ class Backup:
                          self.rsync_options['deleteexc_o'],
                          self.rsync_options['forcedel_o'],
                          self.rsync_options['excludefile_o'] +
-                         self.excludefile, backupsource])
+                         self.excludefile])
+      cmdarglist.extend(backupsources)
       if self.shellvar:
         cmdarglist.extend([self.sshuser + '@' + self.sshserver + ':' 
                            + backupdest])
@@ -221,23 +426,468 @@ class Backup:
       return None
 
     self.logmsg.logger.debug('%s', cmdarglist)
+    return cmdarglist
+
+  def Sources(self):
+    """Returns the source paths, unless a file list is transferred."""
 
-    self.backupretval = self.help_backup.RunCommandPopen(cmdarglist)
+    if not self.modfied_path:
+      tmpsources = [self.entry['path']]
+    elif isinstance(self.modfied_path, list):
+      tmpsources = self.modfied_path
+    else:
+      tmpsources = [self.modfied_path]
+    return [os.path.normpath(os.path.expanduser(tmpsource))
+            for tmpsource in tmpsources]
+
+  def Recursive(self):
+    """Returns True if the sources are transferred recursively."""
+
+    return self.entry['recursive']
+
+  def FilterOptions(self):
+    """Returns the rsync options for the entry include/exclude patterns."""
+
+    options = []
+    if self.entry_exc:
+      for exc_item in self.entry_exc:
+        if exc_item:
+          options.extend(['--exclude=' + exc_item])
+    if self.entry_inc:
+      for inc_item in self.entry_inc:
+        if inc_item:
+          options.extend(['--include=' + inc_item])
+    return options
+
+  def ChooseCompression(self):
+    """Decide whether to compress the transfer. Blocking, reads samples."""
+
+    if not self.advisor or self.dryrun:
+      return
+    if self.filelist is not None:
+      paths = self.filelist
+    else:
+      paths = self.Sources()
+    self.compress = self.advisor.ShouldCompress(paths, self.name)
+
+  def RecordTransfer(self, lines, seconds):
+    """Measure the link throughput from the output of a finished rsync."""
+
+    if self.advisor:
+      self.advisor.Record(lines, seconds)
+
+  def Attribute(self, retval, lines):
+    """Returns the exit value of each entry backed up, see BatchBackup."""
+
+    return [retval]
+
+  def FilterRules(self):
+    """Returns the include/exclude rules of the entry, in rsync order.
+
+    Returns:
+      List - ('+' or '-', pattern) tuples, see localcopy.Excluded. Lines of
+        the exclude file which are not understood are kept as (None, line),
+        so that CanCopyLocally leaves the backup to rsync.
+    """
+
+    rules = []
+    for exc_item in self.entry_exc or []:
+      if exc_item:
+        rules.append(('-', exc_item))
+    for inc_item in self.entry_inc or []:
+      if inc_item:
+        rules.append(('+', inc_item))
+    try:
+      excfile = file(self.excludefile)
+      try:
+        for line in excfile:
+          line = line.rstrip('\n')
+          rule = ExcludeFileRule(line)
+          if rule is None:
+            rules.append((None, line))
+          elif rule[0] != '#':
+            rules.append(rule)
+      finally:
+        excfile.close()
+    except IOError, e:
+      self.logmsg.logger.warning('%s', e)
+    return rules
+
+  def PathRules(self, path):
+    """Returns the include/exclude rules applying to path."""
+
+    return self.AllRules()
+
+  def AllRules(self):
+    """Returns every include/exclude rule of the backup."""
+
+    if self.rules is None:
+      self.rules = self.FilterRules()
+    return self.rules
+
+  def CanCopyLocally(self):
+    """Checks whether the backup can be done by localcopy, without rsync.
+
+    Only for a file list of at most localcopy.MAX_PATHS paths to a local
+    destination (methods LOCAL and NFS), with include/exclude patterns
+    which only match names.
+    """
+
+    if (not self.localcopy or self.shellvar or self.dryrun or
+        self.filelist is None or len(self.filelist) > localcopy.MAX_PATHS):
+      return False
+    for action, pattern in self.AllRules():
+      if action not in ('+', '-') or not localcopy.SimplePattern(pattern):
+        return False
+    return True
+
+  def CopyLocally(self):
+    """Copy the file list in-process, see CanCopyLocally. Blocking.
+
+    Returns:
+      Tuple - (exit value, error lines), like an rsync command.
+    """
+
+    backupsuffix = None
+    self.filelistname = None
+    self.backupretval = None
+    if self.maintainprevious and self.versionstore:
+      self.staging = self.versionstore.NewStaging()
+      if not self.staging:
+        return 1, []
+    elif self.maintainprevious:
+      backupsuffix = self.rsync_options['backup_suffix_extn']
+    copier = localcopy.LocalCopier(self.backupdir, self.logmsg, backupsuffix,
+                                   self.staging)
+    return copier.Transfer(self.filelist, self.deletemissing, self.PathRules)
+
+  def FinishBackup(self, retval):
+    """Clean up after the rsync command built by BuildCommand has exited.
+
+    Args:
+      retval: Integer - Exit value of the command, None if it did not run.
+
+    Returns:
+      backupretval: Integer - Is the exit value obtained from the command
+    """
+
+    if self.filelistname:
+      try:
+        os.remove(self.filelistname)
+      except OSError, e:
+        self.logmsg.logger.warning('%s', e)
+      self.filelistname = None
+    if retval is None:
+      return self.backupretval
+    self.backupretval = retval
     if self.backupretval < 0:
       self.logmsg.logger.warning('%s Terminated, Err code: %s', self.name,
                                 self.backupretval)
-
     return self.backupretval
 
+  def KeepVersions(self):
+    """Move the versions replaced by the backup into the version store.
 
-class AsyncBackup(threading.Thread):
-  """Class which provides methods to perfrom backups in a new thread."""
+    Blocking, run once the backup has finished (whether it succeeded or
+    not, a partial transfer has replaced files too).
+    """
+
+    if not self.staging:
+      return
+    staging = self.staging
+    self.staging = None
+    self.versionstore.Ingest(staging, self.name)
+
+  def WriteFileList(self):
+    """Write filelist to a temporary file, for rsync option --files-from.
 
-  def __init__(self, backupdir, backupbinary, excfile, entrylist,
-               pathslist, log_handle, sh_var=None):
-    """Initialise thread and backup environment.
+    Paths are written relative to "/" and NUL separated (--from0), so that
+    file names with newlines are handled.
+
+    Returns:
+      String - Name of the temporary file, None on error.
+    """
+
+    try:
+      listfd, listname = tempfile.mkstemp('.filelist', 'tmp-', '/tmp/')
+    except OSError, e:
+      self.logmsg.logger.error('%s', e)
+      return None
+    try:
+      try:
+        data = []
+        for path in self.filelist:
+          data.append(path.lstrip('/'))
+        os.write(listfd, '\0'.join(data) + '\0')
+      except OSError, e:
+        self.logmsg.logger.error('%s', e)
+        os.remove(listname)
+        return None
+    finally:
+      os.close(listfd)
+    self.logmsg.logger.debug('File list (%s paths): %s', len(self.filelist),
+                             listname)
+    return listname
+
+
+class BatchBackup(Backup):
+  """Backs up several entries with one rsync command.
+
+  The entries are either all transferred with a file list, or all
+  recursively (subtree roots or the whole entry), to the same destination.
+  Their include/exclude patterns are merged, each restricted to the path of
+  its entry (see ScopedPatterns). rsync has one exit value for the whole
+  run; a partial transfer is attributed to the entries owning the paths
+  rsync reports as failed.
+  """
+
+  def __init__(self, backups):
+    """Initialise the batch.
+
+    Args:
+      backups: List - Backup objects of the entries, with their plans
+        applied (see Backup.ApplyPlan).
+    """
+
+    first = backups[0]
+    Backup.__init__(self, first.backupdir, first.backupbinary,
+                    first.excludefile, first.entry,
+                    log_handle=first.logmsg, dryrun=first.dryrun,
+                    sh_var=first.shellvar)
+    self.backups = backups
+    self.name = ', '.join([item.name for item in backups])
+    if first.filelist is not None:
+      self.filelist = []
+      for item in backups:
+        self.filelist.extend(item.filelist)
+        if item.deletemissing:
+          self.deletemissing = True
+      self.filelist.sort()
+    self.router = pathtrie.EntryRouter([item.entry for item in backups])
+    self.localcopy = first.localcopy
+    self.compress = first.compress
+
+  def Sources(self):
+    sources = []
+    for item in self.backups:
+      sources.extend(item.Sources())
+    return sources
+
+  def Recursive(self):
+    return self.filelist is None
+
+  def FilterOptions(self):
+    options = []
+    for item in self.backups:
+      path = item.entry['path']
+      for patterns, option in ((item.entry_exc, '--exclude='),
+                               (item.entry_inc, '--include=')):
+        for pattern in patterns or []:
+          if pattern:
+            for scoped in ScopedPatterns(path, pattern):
+              options.append(option + scoped)
+    return options
+
+  def AllRules(self):
+    rules = []
+    for item in self.backups:
+      rules.extend(item.AllRules())
+    return rules
+
+  def PathRules(self, path):
+    index = self.router.RouteIndex(path)
+    if index is None:
+      return []
+    return self.backups[index].PathRules(path)
+
+  def Attribute(self, retval, lines):
+    """Find out which entries failed.
+
+    Args:
+      retval: Integer - Exit value of rsync.
+      lines: List - Output lines of rsync.
+
+    Returns:
+      List - Exit value of each entry, in the order of the backups.
+    """
+
+    retvals = [retval] * len(self.backups)
+    if retval not in RSYNC_PARTIAL:
+      return retvals
+    paths = FailedPaths(lines)
+    if not paths:
+      return retvals
+    failed = set()
+    destprefix = self.backupdir.rstrip('/') + '/'
+    for path in paths:
+      if path.startswith(destprefix):
+        # Receiver side path
+        path = path[len(destprefix) - 1:]
+      elif not path.startswith('/'):
+        path = '/' + path
+      index = self.router.RouteIndex(path)
+      if index is None:
+        return retvals
+      failed.add(index)
+    for index in xrange(len(self.backups)):
+      if index not in failed:
+        retvals[index] = 0
+    return retvals
+
+
+class InitialBackup:
+  """Runs the initial backup of the entries, several entries at a time."""
+
+  def __init__(self, backups, workers, log_handle, transferplanner=None):
+    """Initialise the initial backup.
+
+    Args:
+      backups: List - (Backup object, size estimate, catalog.EntryCatalog or
+        None, net changes read back from the pending change log or None)
+        tuples. Larger entries are started first, so that the longest
+        backup does not start last.
+      workers: Integer - Maximum number of entries backed up at a time.
+      log_handle: Object - Handle to the logging object.
+      transferplanner: Object - planner.TransferPlanner, plans the backup of
+        the changes found with a catalog.
+    """
+
+    self.queue = list(backups)
+    self.queue.sort(lambda a, b: cmp(b[1], a[1]))
+    self.workers = max(1, min(workers, len(self.queue)))
+    self.loghandle = log_handle
+    self.planner = transferplanner
+    if self.planner is None:
+      self.planner = planner.TransferPlanner(log_handle)
+    self.lock = threading.Lock()
+    # Entry name => (exit value, seconds)
+    self.results = {}
+
+  def Run(self):
+    """Backup every entry, returns when all are done.
+
+    Returns:
+      results: Dictionary - Entry name => (exit value, seconds taken).
+    """
+
+    started = time.time()
+    threads = []
+    for number in xrange(self.workers):
+      thread = threading.Thread(target=self.Work,
+                                name='InitialBackup-%d' % number)
+      thread.setDaemon(True)
+      thread.start()
+      threads.append(thread)
+    for thread in threads:
+      # Join with a timeout, so that KeyboardInterrupt is delivered.
+      while thread.isAlive():
+        thread.join(1)
+    failed = []
+    for name, (retval, seconds) in self.results.iteritems():
+      if retval:
+        failed.append(name)
+    failed.sort()
+    self.loghandle.logger.info('Initial backup of %s entries done in %.0f'
+                               ' seconds, %s worker(s)', len(self.results),
+                               time.time() - started, self.workers)
+    if failed:
+      self.loghandle.logger.error('Initial backup failed for: %s', failed)
+    return self.results
+
+  def Work(self):
+    """Body of the worker threads, backs up queued entries."""
+
+    while True:
+      self.lock.acquire()
+      try:
+        if not self.queue:
+          return
+        startbackup, size, entrycatalog, replayed = self.queue.pop(0)
+      finally:
+        self.lock.release()
+      started = time.time()
+      try:
+        retval = self.BackupOne(startbackup, entrycatalog, replayed)
+      except Exception, e:
+        self.loghandle.logger.error('Backup of entry %s failed: %s',
+                                    startbackup.name, e)
+        retval = 1
+      seconds = time.time() - started
+      self.loghandle.logger.debug('Entry %s (size %s) took %.0f seconds',
+                                  startbackup.name, size, seconds)
+      self.lock.acquire()
+      try:
+        self.results[startbackup.name] = (retval, seconds)
+      finally:
+        self.lock.release()
+
+  def BackupOne(self, startbackup, entrycatalog, replayed=None):
+    """Back up one entry.
+
+    With a valid catalog only the changes since the last backup are
+    transferred, nothing at all if there are none. The source is stat'ed
+    before the backup, and becomes the new catalog if the backup succeeds.
+    Changes read back from the pending change log are added to the ones
+    found with the catalog, which misses a file rewritten within the second
+    of its last backup with the same size.
+
+    Args:
+      startbackup: Object - Backup of the entry.
+      entrycatalog: Object - catalog.EntryCatalog of the entry, or None.
+      replayed: Dictionary - Net changes logged before the last exit, see
+        journal.ChangeJournal.NetChanges.
+
+    Returns:
+      retval: Integer - Exit value of the backup.
+    """
+
+    if entrycatalog is None or self.loghandle.dryrun:
+      startbackup.ChooseCompression()
+      return startbackup.VerifyBackup()
+    current = entrycatalog.Scan()
+    if entrycatalog.valid:
+      changes = entrycatalog.Diff(current)
+      if replayed:
+        for pathname, change in replayed.iteritems():
+          changes.setdefault(pathname, change)
+      if not changes:
+        self.loghandle.logger.info('Entry %s unchanged since its last backup',
+                                   startbackup.name)
+        return 0
+      plan = self.planner.PlanEntry(startbackup.entry, changes,
+                                    entrycatalog.CoveringDirs(changes))
+      self.loghandle.logger.info('Entry %s: %s changes since its last backup',
+                                 startbackup.name, len(changes))
+      startbackup.ApplyPlan(plan)
+    startbackup.ChooseCompression()
+    retval = startbackup.VerifyBackup()
+    if not retval:
+      entrycatalog.Replace(current)
+      if not entrycatalog.Save():
+        self.loghandle.logger.warning('Failed to write catalog %s',
+                                      entrycatalog.filename)
+    else:
+      entrycatalog.Unsure()
+    return retval
+
+
+class AsyncBackup:
+  """Class which provides methods to perfrom backups from the event loop.
+
+  Planning the backup (which walks directory trees) runs in a worker thread
+  of the loop, the rsync commands of the matched entries then run one after
+  the other as children of the loop. Unless batch is False, entries
+  transferred the same way share one rsync command (see BatchBackup).
+  """
+
+  def __init__(self, loop, backupdir, backupbinary, excfile, entrylist,
+               pathslist, log_handle, sh_var=None, router=None,
+               changes=None, transferplanner=None, donefunc=None,
+               catalogs=None, batch=True, localcopy=False, capacity=None):
+    """Initialise backup environment.
 
     Args:
+      loop: Object - eventloop.EventLoop
       backupdir: String - path of the backup directory
       backupbinary: String - the rsync binary path
       excfile: String - The filename whihc contains the exclude entries.
@@ -245,9 +895,26 @@ class AsyncBackup(threading.Thread):
       pathslist: List - Paths which were modified.
       log_handle: Object - Handle to the logging object.
       sh_var: List - SSH parameters list
+      router: Object - pathtrie.EntryRouter built from entrylist. Built here
+        if not given.
+      changes: Dictionary - Net changes (journal.ChangeJournal.NetChanges)
+        since the last backup. If given, entries without any net change are
+        not backed up, and the transfer of each entry is planned by
+        transferplanner.
+      transferplanner: Object - planner.TransferPlanner. Created here if
+        not given.
+      donefunc: Function - Called with this object once every entry has
+        been backed up.
+      catalogs: Dictionary - Entry name => catalog.EntryCatalog, updated
+        after each successful backup.
+      batch: Boolean - Back up several entries with one rsync command.
+      localcopy: Boolean - Copy small file lists in-process (see
+        Backup.CanCopyLocally).
+      capacity: Object - capacity.CapacityMonitor, entries which do not fit
+        at the destination are held back (see held).
     """
 
-    threading.Thread.__init__(self, name='AsyncBackup')
+    self.loop = loop
     self.destdir = backupdir
     self.binary = backupbinary
     self.exc_file = excfile
@@ -255,72 +922,336 @@ class AsyncBackup(threading.Thread):
     self.entry_list = entrylist
     self.loghandle = log_handle
     self.ssh_var = sh_var
+    self.router = router
+    self.changes = changes
+    self.planner = transferplanner
+    self.donefunc = donefunc
+    self.catalogs = catalogs
+    self.batch = batch
+    self.localcopy = localcopy
+    self.capacity = capacity
+    # Names of the entries held back for lack of space.
+    self.held = []
+    self.snapshots = []
+    self.planned = False
+    self.active = False
+    self.child = None
+    self.current = None
+    self.exitvalue = None
+    self.started = None
+    # (Backup object, indexes in matched_entry) tuples, one per rsync run.
+    self.jobs = []
+    self.counter = 0
+    self.failedbackup = 0
+    self.fblist = []
+    self.matched_entry = []
 
-  def run(self):
-    """Starts the a brand new thread for backup.
+  def Start(self):
+    """Starts the backup.
 
     Backup all paths populated in list (modified_path) by
     FindEntries() function.
     """
 
-    self.FindEntries(self.pathslist, self.entry_list)
-
-    failedbackup = 0
-    fblist = []
-    counter = 0
-
-    for entry in self.matched_entry:
-      path = self.modified_path[counter]
-      asyncbackupstart = Backup(self.destdir, self.binary,
-                                self.exc_file, entry, modified_path=path,
-                                log_handle=self.loghandle,
-                                dryrun=self.loghandle.dryrun,
-                                sh_var=self.ssh_var)
-      retcode = asyncbackupstart.DoBackup()
-      counter += 1
-      path = None
-      # Here the number of failed backups are calculated by checking the return
-      # code from asyncbackupstart.DoBackup function.
-      if not retcode:
+    self.active = True
+    self.loop.RunInThread(self.FindEntries,
+                          (self.pathslist, self.entry_list),
+                          self.OnPlanned)
+
+  def IsActive(self):
+    """Returns True until every entry has been backed up."""
+
+    return self.active
+
+  def Failed(self, entryname):
+    """Returns True unless the changes of entryname have been backed up."""
+
+    return (not self.planned or entryname in self.fblist or
+            entryname in self.held)
+
+  def OnPlanned(self, result, error):
+    """FindEntries finished in the worker thread."""
+
+    if error is not None:
+      self.loghandle.logger.error('Failed to plan backup: %s', error)
+      self.matched_entry = []
+      self.Finish()
+      return
+    self.planned = True
+    if self.capacity:
+      self.AdmitEntries()
+    self.jobs = self.BuildJobs()
+    self.counter = 0
+    self.BackupNext()
+
+  def AdmitEntries(self):
+    """Hold back the entries which do not fit at the destination."""
+
+    requests = []
+    for index in xrange(len(self.matched_entry)):
+      entry = self.matched_entry[index]
+      requests.append((index, self.estimates[index], entry.get('priority', 0)))
+    admitted, held = self.capacity.Admit(requests)
+    for index in held:
+      name = self.matched_entry[index]['name']
+      self.held.append(name)
+      self.loghandle.logger.warning('Backup of entry %s held back: %s free'
+                                    ' at the destination', name,
+                                    capacity.FormatBytes(self.capacity.Free()))
+
+  def BuildJobs(self):
+    """Group the matched entries into rsync runs.
+
+    Returns:
+      jobs: List - (Backup object, indexes in matched_entry) tuples.
+    """
+
+    jobs = []
+    # (kind, compress) => (Backup objects, indexes), see BatchKind
+    batches = {}
+    for index in xrange(len(self.matched_entry)):
+      if self.matched_entry[index]['name'] in self.held:
+        continue
+      plan = self.plans[index]
+      startbackup = Backup(self.destdir, self.binary,
+                           self.exc_file, self.matched_entry[index],
+                           modified_path=self.modified_path[index],
+                           log_handle=self.loghandle,
+                           dryrun=self.loghandle.dryrun,
+                           sh_var=self.ssh_var)
+      if plan is not None:
+        startbackup.ApplyPlan(plan)
+      startbackup.localcopy = self.localcopy
+      startbackup.compress = self.compress[index]
+      kind = None
+      if self.batch:
+        kind = BatchKind(startbackup, plan)
+      if kind is None:
+        jobs.append((startbackup, [index]))
+        continue
+      # Compressed and uncompressed entries are transferred separately.
+      members, indexes = batches.setdefault((kind, startbackup.compress),
+                                            ([], []))
+      members.append(startbackup)
+      indexes.append(index)
+    kinds = batches.keys()
+    kinds.sort()
+    for kind in kinds:
+      members, indexes = batches[kind]
+      if len(members) == 1:
+        jobs.append((members[0], indexes))
+      else:
+        self.loghandle.logger.debug('Batching %s entries in one rsync',
+                                    len(members))
+        jobs.append((BatchBackup(members), indexes))
+    return jobs
+
+  def BackupNext(self):
+    """Start the rsync command of the next job."""
+
+    if self.counter >= len(self.jobs):
+      self.Finish()
+      return
+    self.current = self.jobs[self.counter][0]
+    self.started = time.time()
+    if self.current.CanCopyLocally():
+      self.loop.RunInThread(self.current.CopyLocally, (), self.CopiedLocally)
+      return
+    cmdarglist = self.current.BuildCommand()
+    if not cmdarglist:
+      self.EntryDone(self.current.backupretval or 1, [])
+      return
+    self.child = self.loop.SpawnProcess(cmdarglist, self.EntryDone)
+
+  def CopiedLocally(self, result, error):
+    """The in-process copy of the current job is done."""
+
+    if error is not None:
+      self.loghandle.logger.error('In-process copy failed: %s', error)
+      self.EntryDone(1, [])
+    else:
+      self.EntryDone(result[0], result[1])
+
+  def EntryDone(self, retcode, lines):
+    """The rsync command (or copy) of the current job has exited."""
+
+    retcode = self.current.FinishBackup(retcode)
+    self.child = None
+    self.current.RecordTransfer(lines, time.time() - self.started)
+    if self.current.staging:
+      # Hashing the replaced versions reads them, not on the loop.
+      self.exitvalue = (retcode, lines)
+      self.loop.RunInThread(self.current.KeepVersions, (), self.VersionsKept)
+      return
+    self.JobDone(retcode, lines)
+
+  def VersionsKept(self, result, error):
+    """The previous versions replaced by the current job are stored."""
+
+    if error is not None:
+      self.loghandle.logger.error('Version store: %s', error)
+    retcode, lines = self.exitvalue
+    self.JobDone(retcode, lines)
+
+  def JobDone(self, retcode, lines):
+    """Record the outcome of the current job, start the next one."""
+
+    indexes = self.jobs[self.counter][1]
+    retcodes = self.current.Attribute(retcode, lines)
+    self.counter += 1
+    for position in xrange(len(indexes)):
+      entry = self.matched_entry[indexes[position]]
+      entryretcode = retcodes[position]
+      snapshot = self.snapshots[indexes[position]]
+      if not entryretcode and snapshot is not None:
+        self.catalogs[entry['name']].Apply(snapshot)
+      elif self.catalogs and entry['name'] in self.catalogs:
+        # The destination changed in a way the catalog does not tell.
+        sources = self.modified_path[indexes[position]]
+        if isinstance(sources, str):
+          sources = [sources]
+        self.catalogs[entry['name']].Unsure(sources)
+      # Here the number of failed backups are calculated by checking the
+      # return code of the rsync command.
+      if not entryretcode:
         self.loghandle.logger.info('Backup of entry %s completed'
                                    ' successfully.', entry['name'])
       else:
         self.loghandle.logger.error('Backup of entry %s failed.',
                                     entry['name'])
-        failedbackup += 1
-        fblist.append(entry['name'])
+        self.failedbackup += 1
+        self.fblist.append(entry['name'])
+    self.BackupNext()
+
+  def Finish(self):
+    """Every entry has been backed up."""
 
     # Print message if backups are failing
-    if failedbackup >= len(self.matched_entry):
-      self.loghandle.logger.critical('Almost all backups failed: %s', fblist)
+    if self.matched_entry and self.failedbackup >= len(self.matched_entry):
+      self.loghandle.logger.critical('Almost all backups failed: %s',
+                                     self.fblist)
       self.loghandle.logger.critical('Please investigate.')
       # Add a GUI dialog here. (TODO)
+    self.active = False
+    if self.donefunc:
+      self.donefunc(self)
 
   def FindEntries(self, pathslist, entrylist):
-    """Find all modified paths that match any corresposnding entry path.
+    """Find the entry owning each modified path.
 
-    Append them to a list (modified_path).
+    Paths are routed with the entry router (a walk down the path, instead of
+    matching every path against every entry). Matched entries are appended
+    to matched_entry, in entry list order, and the path(s) to back up for
+    each of them to modified_path.
+
+    If the net changes are known, entries where every change cancelled out
+    are skipped and the transfer planner decides how each entry is backed up
+    (exact file list, a few subtree roots or the whole entry). Otherwise the
+    common leading directory of the modified paths of an entry is backed up.
 
     Args:
       pathslist: List - List of file/directory paths that got modifed.
       entrylist: List - List of entries. Each entry is a dictionary.
     """
 
-    self.tmplist = []
     self.modified_path = []
     self.matched_entry = []
-    for entry in entrylist:
-      for path in pathslist:
-        if re.match(entry['path'], path):
-          self.tmplist.append(path)
-          try:
-            self.matched_entry.index(entry)
-          except ValueError:
-            self.matched_entry.append(entry)
-      if self.tmplist:
-        prefx = self.CommonDirPrefix(self.tmplist)
-        self.modified_path.append(prefx)
-        self.tmplist = []
+    self.plans = []
+    self.compress = []
+    self.estimates = []
+    if self.router is None:
+      self.router = pathtrie.EntryRouter(entrylist)
+    if self.changes is None:
+      for entry, paths in self.router.RouteAll(pathslist):
+        self.matched_entry.append(entry)
+        self.modified_path.append(self.CommonDirPrefix(paths))
+        self.plans.append(None)
+        self.snapshots.append(None)
+        self.compress.append(self.Compression(entry, None,
+                                              self.modified_path[-1]))
+        self.estimates.append(None)
+      return
+    if self.planner is None:
+      self.planner = planner.TransferPlanner(self.loghandle)
+    for plan in self.planner.Plan(self.router, self.changes, pathslist):
+      self.matched_entry.append(plan.entry)
+      self.modified_path.append(plan.sources)
+      self.plans.append(plan)
+      self.snapshots.append(self.CatalogSnapshot(plan))
+      self.compress.append(self.Compression(plan.entry, plan, plan.sources))
+      self.estimates.append(self.EstimateBytes(plan, self.snapshots[-1]))
+
+  def EstimateBytes(self, plan, snapshot):
+    """Estimate the bytes a plan adds at the destination.
+
+    With a catalog, these are the sizes of the files which differ from the
+    catalog. Without, the sizes of the files in a file list. Blocking.
+
+    Returns:
+      Integer - Bytes, None if unknown (the entry is synced as a whole).
+    """
+
+    if not self.capacity:
+      return None
+    total = 0
+    if snapshot is not None:
+      entrycatalog = self.catalogs[plan.entry['name']]
+      cleared, updates = snapshot
+      for pathname, meta in updates.iteritems():
+        if meta is not None and entrycatalog.files.get(pathname) != meta:
+          total += catalog.MetaSize(meta)
+      return total
+    if plan.mode != planner.MODE_LIST:
+      return None
+    for pathname in plan.filelist:
+      try:
+        total += os.lstat(pathname).st_size
+      except OSError:
+        pass
+    return total
+
+  def Compression(self, entry, plan, modified):
+    """Decide whether to compress the transfer of an entry (method RSYNC).
+
+    Args:
+      entry: Dictionary - The entry.
+      plan: Object - planner.TransferPlan of the entry, or None.
+      modified: String or List - Path(s) backed up, if not the whole entry.
+
+    Returns:
+      Boolean - True to compress, see compression.CompressionAdvisor.
+    """
+
+    advisor = self.loghandle.compression
+    if not advisor or not self.ssh_var or self.loghandle.dryrun:
+      return False
+    if plan is not None and plan.mode == planner.MODE_LIST:
+      paths = plan.filelist
+    elif isinstance(modified, list):
+      paths = modified
+    elif modified:
+      paths = [modified]
+    else:
+      paths = [entry['path']]
+    return advisor.ShouldCompress(paths, entry['name'])
+
+  def CatalogSnapshot(self, plan):
+    """Take the metadata of what plan backs up, before it is transferred.
+
+    Returns:
+      Tuple - See catalog.EntryCatalog.Snapshot, None without a catalog.
+    """
+
+    if not self.catalogs or self.loghandle.dryrun:
+      return None
+    entrycatalog = self.catalogs.get(plan.entry['name'])
+    if entrycatalog is None or not entrycatalog.valid:
+      return None
+    if plan.mode == planner.MODE_LIST:
+      return entrycatalog.Snapshot(plan.filelist, [])
+    if plan.mode == planner.MODE_ROOTS:
+      return entrycatalog.Snapshot([], plan.sources)
+    return entrycatalog.Snapshot([], [plan.entry['path']])
 
   def CommonDirPrefix(self, dirlist):
     """Given a list of pathnames, returns the longest common leading directory.
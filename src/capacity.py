@@ -0,0 +1,238 @@
+#!/usr/bin/python2.4
+
+# Copyright 2008 Google Inc.
+# Author : Anoop Chandran <anoopj@google.com>
+#
+# openduckbill is a simple backup application. It offers support for
+# transferring data to a local backup directory, NFS. It also provides
+# file system monitoring of directories marked for backup. Please read
+# the README file for more details.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""Free space of the backup destination, and admission of backups.
+
+capacity keeps the free space of the filesystem holding the backup
+directory, probed every PROBE_INTERVAL seconds and after every backup:
+statvfs(2) for backup methods LOCAL and NFS, "df" run over ssh for RSYNC.
+The recent probes give the rate at which the destination fills up, and a
+forecast of when it will be full.
+
+Before the entries of a flush are transferred, the bytes each one adds at
+the destination are estimated (see backup.AsyncBackup.EstimateBytes). If
+they do not all fit in the free space (less "minfreespace"), entries are
+admitted by decreasing "priority" (an optional setting of each entry),
+then smallest first, as long as they fit. The others are held back: their
+changes are kept pending and retried later, instead of failing rsync after
+rsync on a full filesystem.
+"""
+
+import os
+import subprocess
+import time
+
+import sshmux
+
+# Seconds between two probes of the free space.
+PROBE_INTERVAL = 300
+# Probes kept to compute the growth rate.
+HISTORY = 24
+# Warn when the destination is forecast to be full within this many seconds.
+FORECAST_WARNING = 7 * 86400
+# Seconds before the changes of a held back entry are retried.
+HOLD_DELAY = 600
+
+
+def LocalFree(path):
+  """Returns the bytes available to the user on the filesystem of path."""
+
+  st = os.statvfs(path)
+  return st.f_bavail * st.f_frsize
+
+
+def RemoteFree(sshcmd, path):
+  """Returns the bytes available on the filesystem of path on a server.
+
+  Args:
+    sshcmd: List - ssh command reaching the server, see init.InitData.
+    path: String - Path on the server.
+
+  Returns:
+    Integer - Bytes available, None if unknown.
+  """
+
+  runcmd = list(sshcmd)
+  runcmd.append('df -Pk %s' % sshmux.ShellQuote(path))
+  try:
+    proc = subprocess.Popen(runcmd, stdin=file(os.devnull),
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, close_fds=True)
+    output = proc.communicate()[0]
+  except OSError:
+    return None
+  if proc.returncode:
+    return None
+  # Filesystem 1024-blocks Used Available Capacity Mounted on
+  lines = output.strip().split('\n')
+  try:
+    return int(lines[-1].split()[3]) * 1024
+  except (IndexError, ValueError):
+    return None
+
+
+def FormatBytes(count):
+  """Returns a byte count in a readable unit."""
+
+  for unit in ('bytes', 'KB', 'MB', 'GB'):
+    if abs(count) < 1024:
+      return '%.0f %s' % (count, unit)
+    count /= 1024.0
+  return '%.1f TB' % count
+
+
+class CapacityMonitor:
+  """Tracks the free space of the destination, see module docstring."""
+
+  def __init__(self, probefunc, reserve, loghandle, reclaimfunc=None):
+    """Initialise the monitor.
+
+    Args:
+      probefunc: Function - Returns the free bytes at the destination, None
+        if unknown. Blocking, called from a worker thread.
+      reserve: Integer - Bytes which are never used up by backups.
+      loghandle: Object - Handle to the logging object.
+      reclaimfunc: Function - Returns the bytes at the destination which are
+        no longer backed up, from the index of the destination (see
+        destindex). Told along with the forecast warning.
+    """
+
+    self.probefunc = probefunc
+    self.reclaimfunc = reclaimfunc
+    self.reserve = reserve
+    self.loghandle = loghandle
+    # (time, free bytes) tuples, oldest first.
+    self.history = []
+    # Estimated bytes of the backups admitted since the last probe.
+    self.committed = 0
+    self.warned = False
+
+  def Free(self):
+    """Returns the last known free bytes, None if never probed."""
+
+    if not self.history:
+      return None
+    return self.history[-1][1]
+
+  def Record(self, free):
+    """Record the result of a probe (see probefunc)."""
+
+    if free is None:
+      return
+    self.history.append((time.time(), free))
+    del self.history[:-HISTORY]
+    self.committed = 0
+    forecast = self.Forecast()
+    if forecast is not None and forecast < FORECAST_WARNING:
+      if not self.warned:
+        self.loghandle.logger.warning('Backup destination forecast to be full'
+                                      ' in %.1f hours (%s free, growing %s'
+                                      ' per hour)', forecast / 3600.0,
+                                      FormatBytes(free),
+                                      FormatBytes(self.GrowthRate() * 3600))
+        if self.reclaimfunc:
+          reclaimable = self.reclaimfunc()
+          if reclaimable:
+            self.loghandle.logger.warning('%s at the destination are no'
+                                          ' longer backed up (see'
+                                          ' "retainbackup")',
+                                          FormatBytes(reclaimable))
+        self.warned = True
+    else:
+      self.warned = False
+
+  def GrowthRate(self):
+    """Returns the bytes used per second (least squares over the history).
+
+    Returns:
+      Float - Bytes per second, negative if space is being freed. None
+        without at least two probes.
+    """
+
+    if len(self.history) < 2:
+      return None
+    count = len(self.history)
+    start = self.history[0][0]
+    meantime = sum([when - start for when, free in self.history]) / count
+    meanfree = sum([free for when, free in self.history]) / float(count)
+    covariance = 0.0
+    variance = 0.0
+    for when, free in self.history:
+      covariance += (when - start - meantime) * (free - meanfree)
+      variance += (when - start - meantime) ** 2
+    if not variance:
+      return None
+    return -covariance / variance
+
+  def Forecast(self):
+    """Returns the seconds left until the destination is full, or None."""
+
+    growth = self.GrowthRate()
+    if not growth or growth <= 0:
+      return None
+    return max(0, self.Free() - self.reserve) / growth
+
+  def Admit(self, requests):
+    """Choose the backups which fit in the free space.
+
+    Args:
+      requests: List - (key, estimated bytes or None if unknown, priority)
+        tuples.
+
+    Returns:
+      Tuple - (admitted keys, held back keys).
+    """
+
+    free = self.Free()
+    if free is None:
+      return [key for key, size, priority in requests], []
+    available = free - self.reserve - self.committed
+    total = 0
+    for key, size, priority in requests:
+      total += size or 0
+    if total <= available:
+      self.committed += total
+      return [key for key, size, priority in requests], []
+    # Highest priority first, then smallest. Unknown sizes are sorted
+    # last and admitted while some space is left.
+    ordered = []
+    for key, size, priority in requests:
+      ordered.append((-priority, size is None, size or 0, key))
+    ordered.sort()
+    admitted = []
+    held = []
+    for negpriority, unknown, size, key in ordered:
+      if unknown:
+        fits = available > 0
+      else:
+        # Entries only removing files always fit.
+        fits = size <= 0 or size <= available
+      if fits:
+        available -= size
+        self.committed += size
+        admitted.append(key)
+      else:
+        held.append(key)
+    return admitted, held
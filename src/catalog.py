@@ -0,0 +1,411 @@
+#!/usr/bin/python2.4
+
+# Copyright 2008 Google Inc.
+# Author : Anoop Chandran <anoopj@google.com>
+#
+# openduckbill is a simple backup application. It offers support for
+# transferring data to a local backup directory, NFS. It also provides
+# file system monitoring of directories marked for backup. Please read
+# the README file for more details.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""On-disk catalog of what has been backed up.
+
+catalog keeps, for every entry, the metadata (inode, size, mtime, mode) of
+each file and directory as it was when its last backup succeeded. On
+restart, the source is stat'ed once and compared with the catalog, giving
+the exact changes to back up instead of a full rsync of the entry. While the
+daemon runs, the catalog is updated after every successful backup with the
+metadata taken when the backup was planned (so a file modified during the
+transfer is seen as changed on the next restart).
+
+A catalog is only used if the entry, the exclude lists and the backup
+destination are unchanged since it was written. Remove the files in
+~/.openduckbill/catalog to force a full sync of every entry.
+
+Every change of a catalog is also recorded in the index of the backup
+destination (see destindex), if the daemon keeps one.
+"""
+
+import marshal
+import os
+import stat
+import time
+
+import journal
+import pathtrie
+
+CATALOG_VERSION = 1
+CATALOG_DIR = '~/.openduckbill/catalog'
+
+# Metadata fields
+_INO = 0
+_SIZE = 1
+_MTIME = 2
+_MODE = 3
+
+
+def StatMeta(st):
+  """Returns the catalog metadata tuple of an lstat result."""
+
+  return (st.st_ino, st.st_size, int(st.st_mtime), st.st_mode)
+
+
+def MetaSize(meta):
+  """Returns the size of a metadata tuple (see StatMeta)."""
+
+  return meta[_SIZE]
+
+
+def ScanTree(path, recursive, files=None):
+  """Collect the metadata of path and everything below it.
+
+  Args:
+    path: String - File or directory path.
+    recursive: Boolean - Descend into subdirectories. If False, only path
+      and its direct children are collected.
+    files: Dictionary - Filled in and returned, a new one if None.
+
+  Returns:
+    files: Dictionary - pathname => metadata tuple.
+  """
+
+  if files is None:
+    files = {}
+  try:
+    st = os.lstat(path)
+  except OSError:
+    return files
+  files[path] = StatMeta(st)
+  if not stat.S_ISDIR(st.st_mode):
+    return files
+  stack = [path]
+  while stack:
+    dirpath = stack.pop()
+    try:
+      names = os.listdir(dirpath)
+    except OSError:
+      continue
+    for name in names:
+      pathname = os.path.join(dirpath, name)
+      try:
+        st = os.lstat(pathname)
+      except OSError:
+        continue
+      files[pathname] = StatMeta(st)
+      if recursive and stat.S_ISDIR(st.st_mode):
+        stack.append(pathname)
+  return files
+
+
+class EntryCatalog:
+  """Catalog of one entry."""
+
+  def __init__(self, entry, identity, catalogdir=CATALOG_DIR):
+    """Initialise an empty catalog.
+
+    Args:
+      entry: Dictionary - The entry.
+      identity: Dictionary - Everything which makes a catalog invalid when
+        changed (entry settings, exclude lists, backup destination).
+      catalogdir: String - Directory holding the catalog files.
+    """
+
+    self.entry = entry
+    self.identity = identity
+    self.filename = os.path.join(os.path.expanduser(catalogdir),
+                                 entry['name'].replace('/', '_'))
+    self.files = {}
+    # Directory path => set of pathnames directly below it (in files, or
+    # leading to paths in files), so that Apply finds what is below a
+    # cleared prefix without going through every path.
+    self.children = {}
+    # True if files describes what has been backed up.
+    self.valid = False
+    self.dirty = False
+    # destindex.DestinationIndex kept up to date, if any.
+    self.destindex = None
+
+  def __len__(self):
+    return len(self.files)
+
+  def Load(self):
+    """Read the catalog file.
+
+    Returns:
+      Boolean - True if the catalog can be used.
+    """
+
+    try:
+      catfile = file(self.filename, 'rb')
+      try:
+        header = marshal.load(catfile)
+        if (header.get('version') != CATALOG_VERSION or
+            header.get('identity') != self.identity):
+          return False
+        self.files = marshal.load(catfile)
+      finally:
+        catfile.close()
+    except (IOError, EOFError, ValueError, TypeError, AttributeError):
+      return False
+    self.IndexChildren()
+    self.valid = True
+    self.dirty = False
+    return True
+
+  def Dump(self):
+    """Returns the catalog file contents."""
+
+    header = {'version': CATALOG_VERSION, 'identity': self.identity}
+    return marshal.dumps(header) + marshal.dumps(self.files)
+
+  def Write(self, data):
+    """Atomically replace the catalog file with data (see Dump).
+
+    Returns:
+      Boolean - True on success.
+    """
+
+    catalogdir = os.path.dirname(self.filename)
+    tmpname = self.filename + '.tmp'
+    try:
+      if not os.path.isdir(catalogdir):
+        os.makedirs(catalogdir, 0700)
+      fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+      try:
+        while data:
+          written = os.write(fd, data)
+          data = data[written:]
+        os.fsync(fd)
+      finally:
+        os.close(fd)
+      os.rename(tmpname, self.filename)
+    except (IOError, OSError):
+      return False
+    return True
+
+  def Save(self):
+    """Write the catalog if it changed. Returns False on error."""
+
+    if not self.dirty:
+      return True
+    self.dirty = False
+    if not self.Write(self.Dump()):
+      self.dirty = True
+      return False
+    return True
+
+  def Invalidate(self):
+    """Forget the catalog, eg. after a failed backup of the whole entry."""
+
+    self.files = {}
+    self.children = {}
+    self.valid = False
+    self.dirty = False
+    try:
+      os.remove(self.filename)
+    except OSError:
+      pass
+
+  def Scan(self):
+    """Returns the current metadata of the source (pathname => metadata)."""
+
+    return ScanTree(self.entry['path'], self.entry['recursive'])
+
+  def Replace(self, files):
+    """Make files (see Scan) the backed up state."""
+
+    self.files = files
+    self.IndexChildren()
+    self.valid = True
+    self.dirty = True
+    if self.destindex is not None:
+      self.destindex.ReplaceEntry(self.entry['name'], files, time.time())
+
+  def IndexChildren(self):
+    """Build the children map of files."""
+
+    self.children = {}
+    for pathname in self.files:
+      self.AddChild(pathname)
+
+  def AddChild(self, pathname):
+    """Register pathname below its parent directory, and so on up."""
+
+    while True:
+      parent = os.path.dirname(pathname)
+      if parent == pathname:
+        return
+      try:
+        self.children[parent].add(pathname)
+        return
+      except KeyError:
+        self.children[parent] = set([pathname])
+        pathname = parent
+
+  def RemovePath(self, pathname):
+    """Remove pathname from files and from the children map."""
+
+    del self.files[pathname]
+    if pathname in self.children:
+      # Still leads to paths below it.
+      return
+    while True:
+      parent = os.path.dirname(pathname)
+      siblings = self.children.get(parent)
+      if siblings is None or parent == pathname:
+        return
+      siblings.discard(pathname)
+      if siblings:
+        return
+      del self.children[parent]
+      if parent in self.files:
+        return
+      pathname = parent
+
+  def Below(self, prefix):
+    """Returns prefix and the paths below it which are in files."""
+
+    found = []
+    stack = [prefix]
+    while stack:
+      pathname = stack.pop()
+      if pathname in self.files:
+        found.append(pathname)
+      stack.extend(self.children.get(pathname, ()))
+    return found
+
+  def Unsure(self, sources=None):
+    """Tell the index of the destination that a backup of sources failed.
+
+    Also used for backups which succeeded without updating the catalog.
+    sources defaults to the entry path.
+    """
+
+    if self.destindex is not None:
+      if not sources:
+        sources = [self.entry['path']]
+      self.destindex.Unsure(sources, time.time())
+
+  def Diff(self, files):
+    """Compare the catalog with the current metadata of the source.
+
+    Children of created or deleted directories are left out: a created
+    directory is expanded by the planner, a deleted one is removed as a
+    whole.
+
+    Args:
+      files: Dictionary - Current metadata, see Scan.
+
+    Returns:
+      Dictionary - Net changes, in the format of
+        journal.ChangeJournal.NetChanges.
+    """
+
+    changes = {}
+    newdirs = set()
+    for pathname, meta in files.iteritems():
+      old = self.files.get(pathname)
+      isdir = stat.S_ISDIR(meta[_MODE])
+      if old is None:
+        changes[pathname] = (journal.OP_CREATE, isdir)
+        if isdir:
+          newdirs.add(pathname)
+      elif old != meta:
+        if isdir or old[:_MODE] == meta[:_MODE]:
+          # Directory contents are compared file by file.
+          changes[pathname] = (journal.OP_ATTRIB, isdir)
+        else:
+          changes[pathname] = (journal.OP_UPDATE, isdir)
+    deleted = set()
+    for pathname, meta in self.files.iteritems():
+      if pathname not in files:
+        deleted.add(pathname)
+    for pathname in deleted:
+      if os.path.dirname(pathname) not in deleted:
+        changes[pathname] = (journal.OP_DELETE,
+                             stat.S_ISDIR(self.files[pathname][_MODE]))
+    for pathname in changes.keys():
+      if os.path.dirname(pathname) in newdirs:
+        del changes[pathname]
+    return changes
+
+  def CoveringDirs(self, changes):
+    """Returns the directories holding changes, see pathtrie.ChangedPathSet."""
+
+    changed = pathtrie.ChangedPathSet([self.entry['path']])
+    for pathname, (operation, isdir) in changes.iteritems():
+      if isdir and operation != journal.OP_DELETE:
+        changed.Add(pathname)
+      else:
+        changed.Add(os.path.dirname(pathname))
+    return changed.CoveringPaths()
+
+  def Snapshot(self, paths, subtrees):
+    """Take the metadata of paths before they are backed up.
+
+    Args:
+      paths: List - Paths backed up one by one (file list).
+      subtrees: List - Directories backed up recursively.
+
+    Returns:
+      Tuple - (cleared prefixes, pathname => metadata or None), passed to
+        Apply once the backup succeeded.
+    """
+
+    updates = {}
+    cleared = list(subtrees)
+    for pathname in paths:
+      try:
+        updates[pathname] = StatMeta(os.lstat(pathname))
+      except OSError:
+        updates[pathname] = None
+        cleared.append(pathname)
+    for subtree in subtrees:
+      ScanTree(subtree, self.entry['recursive'], updates)
+    return cleared, updates
+
+  def Apply(self, snapshot):
+    """Record a successful backup, see Snapshot.
+
+    Runs on the event loop: the paths below cleared prefixes are found with
+    the children map, so the cost is that of the cleared subtrees and the
+    updates, whatever the size of the catalog.
+    """
+
+    cleared, updates = snapshot
+    if not self.valid:
+      return
+    removed = []
+    for prefix in cleared:
+      for pathname in self.Below(prefix.rstrip('/') or '/'):
+        if updates.get(pathname) is None:
+          removed.append(pathname)
+    for pathname, meta in updates.iteritems():
+      if meta is None:
+        if pathname in self.files:
+          removed.append(pathname)
+      else:
+        if pathname not in self.files:
+          self.AddChild(pathname)
+        self.files[pathname] = meta
+    for pathname in removed:
+      if pathname in self.files:
+        self.RemovePath(pathname)
+    self.dirty = True
+    if self.destindex is not None:
+      self.destindex.ApplyEntry(self.entry['name'], removed, updates,
+                                time.time())
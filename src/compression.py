@@ -0,0 +1,337 @@
+#!/usr/bin/python2.4
+
+# Copyright 2008 Google Inc.
+# Author : Anoop Chandran <anoopj@google.com>
+#
+# openduckbill is a simple backup application. It offers support for
+# transferring data to a local backup directory, NFS. It also provides
+# file system monitoring of directories marked for backup. Please read
+# the README file for more details.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""Decides whether rsync compresses the data sent to the backup server.
+
+With backup method RSYNC, compression (rsync -z) pays off when the link is
+slow compared to how fast the data compresses, and when the data
+compresses at all. For every backup, a few of the files to transfer are
+sampled: their first block is compressed with zlib (what rsync uses),
+giving the compression ratio and speed. Files with a suffix of an already
+compressed format (see NOCOMPRESS_SUFFIXES) are not sampled, and count as
+incompressible. The link throughput is measured from the bytes rsync
+reports to have sent (--stats) in recent transfers.
+
+Compression is used if the effective throughput with compression (each
+byte is compressed, then the compressed bytes are sent) is better than
+without by at least COMPRESS_GAIN:
+
+  1 / (ratio / link + 1 / cpu)  >  link * COMPRESS_GAIN
+
+Until a transfer has been measured, compression is used for data which
+compresses to at most UNKNOWN_LINK_RATIO of its size.
+
+Run this module to compare transfers of a directory with and without
+compression over a local stand-in for the link (an rsync server started
+through a pipe, limited to a given bandwidth):
+
+  python compression.py <directory> <KBytes/second> [rsync path]
+"""
+
+import os
+import re
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+# Suffixes of compressed formats, also passed to rsync --skip-compress.
+NOCOMPRESS_SUFFIXES = ['7z', 'ace', 'avi', 'bz2', 'deb', 'flac', 'gif', 'gpg',
+                       'gz', 'iso', 'jar', 'jpeg', 'jpg', 'lz', 'lzma', 'lzo',
+                       'mkv', 'mov', 'mp3', 'mp4', 'mpeg', 'mpg', 'odp', 'ods',
+                       'odt', 'ogg', 'png', 'rar', 'rpm', 'tbz', 'tgz', 'tiff',
+                       'wma', 'wmv', 'xz', 'z', 'zip']
+# Files sampled per backup, and bytes compressed of each.
+SAMPLE_FILES = 16
+SAMPLE_BLOCK = 65536
+# zlib level used by rsync -z.
+ZLIB_LEVEL = 6
+# Compression has to improve the throughput by this factor.
+COMPRESS_GAIN = 1.1
+# Largest ratio compressed while the link throughput is unknown.
+UNKNOWN_LINK_RATIO = 0.5
+# Transfers shorter or smaller than this are not measured.
+MIN_MEASURE_SECONDS = 1.0
+MIN_MEASURE_BYTES = 65536
+# Weight of the last measure in the running averages.
+AVERAGE_WEIGHT = 0.3
+
+_SENT_RE = re.compile(r'^Total bytes sent:\s*([\d,.]+)')
+
+
+def NoCompress(path):
+  """Checks whether path has the suffix of a compressed format."""
+
+  suffix = os.path.splitext(path)[1][1:].lower()
+  return suffix in NOCOMPRESS_SUFFIXES
+
+
+def SentBytes(lines):
+  """Returns the bytes sent according to rsync --stats, None if unknown."""
+
+  for line in lines:
+    match = _SENT_RE.match(line)
+    if match:
+      digits = match.group(1).replace(',', '').replace('.', '')
+      try:
+        return int(digits)
+      except ValueError:
+        return None
+  return None
+
+
+def SampleFiles(paths, limit=SAMPLE_FILES):
+  """Pick up to limit regular files among paths and below directories.
+
+  Returns:
+    List - (path, size) tuples.
+  """
+
+  found = []
+  for path in paths:
+    try:
+      st = os.lstat(path)
+    except OSError:
+      continue
+    if stat.S_ISREG(st.st_mode):
+      found.append((path, st.st_size))
+    elif stat.S_ISDIR(st.st_mode):
+      for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+          pathname = os.path.join(dirpath, filename)
+          try:
+            st = os.lstat(pathname)
+          except OSError:
+            continue
+          if stat.S_ISREG(st.st_mode):
+            found.append((pathname, st.st_size))
+            if len(found) >= limit:
+              return found
+    if len(found) >= limit:
+      break
+  return found[:limit]
+
+
+def SampleRatio(paths):
+  """Estimate how well the files below paths compress.
+
+  Returns:
+    Tuple - (ratio, bytes compressed per second), ratio being the size of
+      the compressed data over the size of the data (weighted by file
+      size). (None, None) if there is nothing to sample.
+  """
+
+  total = 0
+  compressed = 0.0
+  sampled = 0
+  seconds = 0.0
+  for path, size in SampleFiles(paths):
+    if not size:
+      continue
+    total += size
+    if NoCompress(path):
+      compressed += size
+      continue
+    try:
+      samplefile = file(path, 'rb')
+      try:
+        data = samplefile.read(SAMPLE_BLOCK)
+      finally:
+        samplefile.close()
+    except IOError:
+      compressed += size
+      continue
+    if not data:
+      compressed += size
+      continue
+    started = time.time()
+    packed = zlib.compress(data, ZLIB_LEVEL)
+    seconds += time.time() - started
+    sampled += len(data)
+    compressed += size * min(1.0, float(len(packed)) / len(data))
+  if not total:
+    return None, None
+  cpurate = None
+  if sampled:
+    cpurate = sampled / max(seconds, 0.0001)
+  return compressed / total, cpurate
+
+
+class CompressionAdvisor:
+  """Keeps the link measurements and decides on compression."""
+
+  def __init__(self, loghandle, always=False):
+    """Initialise the advisor.
+
+    Args:
+      loghandle: Object - Handle to the logging object.
+      always: Boolean - Always compress, without sampling.
+    """
+
+    self.loghandle = loghandle
+    self.always = always
+    # Running averages, bytes per second.
+    self.linkrate = None
+    self.cpurate = None
+    # rsync (on both ends) knows --skip-compress.
+    self.skipcompress = True
+
+  def Options(self, compress):
+    """Returns the rsync options for a transfer.
+
+    Args:
+      compress: Boolean - Compress the transfer, see ShouldCompress.
+    """
+
+    options = []
+    if compress:
+      options.append('-z')
+      if self.skipcompress:
+        options.append('--skip-compress=' + '/'.join(NOCOMPRESS_SUFFIXES))
+    if not self.always:
+      # The link throughput is measured from the statistics.
+      options.append('--stats')
+    return options
+
+  def Average(self, average, value):
+    if average is None:
+      return value
+    return average + AVERAGE_WEIGHT * (value - average)
+
+  def Record(self, lines, seconds):
+    """Measure the link throughput from a finished rsync transfer.
+
+    Args:
+      lines: List - Output lines of rsync.
+      seconds: Float - Duration of the transfer.
+    """
+
+    sent = SentBytes(lines)
+    if sent is None or sent < MIN_MEASURE_BYTES:
+      return
+    if seconds < MIN_MEASURE_SECONDS:
+      return
+    self.linkrate = self.Average(self.linkrate, sent / seconds)
+    self.loghandle.logger.debug('Link throughput %.0f KB/s (average %.0f'
+                                ' KB/s)', sent / seconds / 1024,
+                                self.linkrate / 1024)
+
+  def ShouldCompress(self, paths, name):
+    """Decide on compression for a backup. Blocking, reads samples.
+
+    Args:
+      paths: List - Files and directories to transfer.
+      name: String - Entry name, for messages.
+
+    Returns:
+      Boolean - True to compress.
+    """
+
+    if self.always:
+      return True
+    ratio, cpurate = SampleRatio(paths)
+    if ratio is None:
+      return False
+    if cpurate is not None:
+      self.cpurate = self.Average(self.cpurate, cpurate)
+    if self.linkrate is None or self.cpurate is None:
+      compress = ratio <= UNKNOWN_LINK_RATIO
+    else:
+      effective = 1.0 / (ratio / self.linkrate + 1.0 / self.cpurate)
+      compress = effective > self.linkrate * COMPRESS_GAIN
+    self.loghandle.logger.debug('Entry %s compresses to %.0f%%, compression'
+                                ' %s', name, ratio * 100,
+                                compress and 'on' or 'off')
+    return compress
+
+
+def Benchmark(source, kbytes, rsyncpath='/usr/bin/rsync'):
+  """Transfer source with and without compression over a stand-in link.
+
+  The rsync server runs locally, started through a pipe (like ssh does)
+  by a shell script standing in for ssh, and the transfer is limited to
+  kbytes per second (--bwlimit) to stand in for the link.
+
+  Args:
+    source: String - Directory to transfer.
+    kbytes: Integer - Bandwidth of the stand-in link, KBytes/second.
+    rsyncpath: String - Path of the rsync binary.
+
+  Returns:
+    Dictionary - 'plain' and 'compressed' => seconds taken, and 'advice'
+      => what CompressionAdvisor decides for source on that link.
+  """
+
+  workdir = tempfile.mkdtemp('', 'odb-bench-')
+  try:
+    shellname = os.path.join(workdir, 'loopback-ssh')
+    shellfile = file(shellname, 'w')
+    shellfile.write('#!/bin/sh\nshift\nexec "$@"\n')
+    shellfile.close()
+    os.chmod(shellname, 0700)
+    advisor = CompressionAdvisor(NullLog())
+    results = {}
+    for label, compress in (('plain', False), ('compressed', True)):
+      dest = os.path.join(workdir, label)
+      runcmd = [rsyncpath, '-a', '--bwlimit=%d' % kbytes, '-e', shellname]
+      runcmd.extend(advisor.Options(compress))
+      runcmd.extend([source.rstrip('/') + '/', 'localhost:' + dest + '/'])
+      started = time.time()
+      proc = subprocess.Popen(runcmd, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT)
+      lines = proc.communicate()[0].split('\n')
+      results[label] = time.time() - started
+      if not compress:
+        advisor.Record(lines, results[label])
+    results['advice'] = advisor.ShouldCompress([source], source)
+    return results
+  finally:
+    shutil.rmtree(workdir, True)
+
+
+class NullLogger:
+  def debug(self, *args):
+    pass
+
+
+class NullLog:
+  """Stand-in for the logging object, when run from the command line."""
+
+  logger = NullLogger()
+
+
+if __name__ == '__main__':
+  if len(sys.argv) < 3:
+    print 'Usage: %s <directory> <KBytes/second> [rsync path]' % sys.argv[0]
+    sys.exit(2)
+  arguments = sys.argv[1:3] + sys.argv[3:4]
+  arguments[1] = int(arguments[1])
+  timings = Benchmark(*arguments)
+  print 'Without compression: %.1f seconds' % timings['plain']
+  print 'With compression: %.1f seconds' % timings['compressed']
+  print 'Compression advised: %s' % timings['advice']
@@ -30,17 +30,20 @@ Briefly, the functionalities:
     - Perform initial sequential backup
     - Create exclude file
     - Fork to background to run as a daemon
-    - Create timer thread for backup
-    - Create timer thread for deleting unscheduled files/directories in backup
+    - Run an event loop for filesystem events, timers, signals and rsync
+    - Create scheduler for backup
+    - Create timer for deleting unscheduled files/directories in backup
       partition (supported in local or NFS backup modes only)
     - Initialise filesytem monitoring
     - Do signal handling
-    - Verify if filesystem changes have occured and backup needs to be done
-    - Start separate thread to perform backup
+    - Flush the changes of an entry once it is quiet (or waited too long)
+    - Start rsync (child of the event loop) to perform backup
     - Do cleanup operations on an error condition or after receiving a signal.
     - Show GUI messages to inform user about error conditions
     - Print debug and resource usage information.
     - Filesystem monitoring.
+    - Rescan entries when filesystem events have been lost.
+    - Reload the entries and excludes of the config file on SIGHUP.
 """
 
 import os
@@ -48,11 +51,24 @@ import resource
 import signal
 import sys
 import tempfile
-import threading
+import time
 
 import backup
+import capacity
+import catalog
 import deletor
+import destindex
+import eventloop
 import init
+import journal
+import pathtrie
+import pendinglog
+import planner
+import rescan
+import scheduler
+import snapshot
+import sshmux
+import versionstore
 
 try:
   import pyinotify
@@ -63,6 +79,10 @@ except ImportError, strerror:
   print 'Quitting!'
   sys.exit(1)
 
+# Seconds after a backup before the updated catalogs are written, so that a
+# burst of backups results in one write.
+CATALOG_SAVE_DELAY = 60
+
 
 class OpenDuckbillMain(init.InitData):
   """Class provides methods for doing the core functionalities."""
@@ -92,6 +112,14 @@ class OpenDuckbillMain(init.InitData):
     # Perform initial checks like duplicate paths, subdirectory check, path
     # exist etc.
     self.ConfigLoader()
+    if self.backupmethod == "RSYNC":
+      # One ssh connection, reused by everything which follows.
+      if self.sshmaster:
+        self.sshmaster.Start()
+      if not self.RemoteBootstrap():
+        sys.exit(1)
+      self.log.logger.info('Completed sanity checks.')
+      return True
     if self.IsBackupPartitionMounted():
       # Backup partition not mounted? then mount it.
       if not self.MountPartition():
@@ -122,7 +150,7 @@ class OpenDuckbillMain(init.InitData):
 
     Wrapper function which does following operations:
       - Create the global exclude file for backup
-      - Do a sequential initial backup entries
+      - Do an initial backup of the entries (in parallel)
       - Fork to background and become a daemon
     """
 
@@ -155,26 +183,94 @@ class OpenDuckbillMain(init.InitData):
             os.write(exlist_tmpfile, '- ' + exc_item + '/*\n')
           else:
             os.write(exlist_tmpfile, '- ' + exc_item + '\n')
-        os.close(exlist_tmpfile)
         self.log.logger.debug('Exclude file: %s', self.exlist_tmpname)
     except AttributeError, e:
       self.log.logger.warning('%s', e)
+    os.close(exlist_tmpfile)
 
   def BackupEntry(self):
     """Sync each source entries and backup partition (destination).
 
-    Performs the initial sequential backup process. For each entry in the list
+    Performs the initial backup process. For each entry in the list
     enlist (entries mentioned in config file), backup process is run to sync
-    the source and destination (backup partition)
+    the source and destination (backup partition). Up to "initialworkers"
+    entries are backed up at a time, largest entries (by number of files)
+    first. Entries with a catalog (see catalog.EntryCatalog) of their last
+    backup only transfer what changed since. Changes which were not backed
+    up when the daemon last exited are read back from the pending change
+    log (see pendinglog) and added to them. With methods LOCAL and NFS, the
+    index of the backup directory (see destindex) is read, and kept up to
+    date by the catalogs.
     """
 
     if self.backupmethod == "RSYNC":
       self.ssh_shell_var = [self.ssh_path, self.sshport,
                        self.sshuser, self.backupserver]
+      if self.sshmaster:
+        self.ssh_shell_var.append(self.sshmaster.ShellCommand())
+      rsync_version = min(self.rsync_version, self.remote_rsync_version)
+      if self.log.compression:
+        self.log.compression.skipcompress = rsync_version >= (3, 0)
     else:
       self.ssh_shell_var = None
+      rsync_version = self.rsync_version
+    # Deleted paths can be sent in a file list if rsync is new enough (on
+    # both ends with method RSYNC). Created here, tree sizes counted below
+    # are reused when planning backups.
+    self.planner = planner.TransferPlanner(
+        self.log, deletemissing=(rsync_version >= (3, 1)))
+
+    self.catalogs = {}
+    self.destindex = None
+    if not self.log.dryrun and self.backupmethod != "RSYNC":
+      self.destindex = destindex.DestinationIndex(self.backupdirpath)
+      if self.destindex.Load():
+        self.log.logger.debug('Index of the backup directory: %s paths',
+                              len(self.destindex))
+      else:
+        self.log.logger.info('No usable index of the backup directory,'
+                             ' starting a new one')
+    # Entry name => (mask, path, name) changes not backed up before the last
+    # exit.
+    self.replayed = {}
+    if not self.log.dryrun:
+      self.replayed = pendinglog.ReadLog()
+      if self.log.versionstore:
+        self.log.versionstore.Recover()
+    backups = self.PrepareBackups(self.enlist)
+    for startbackup, size, entrycatalog, replayed in backups:
+      self.catalogs[startbackup.name] = entrycatalog
+    results = backup.InitialBackup(backups, self.initialworkers, self.log,
+                                   transferplanner=self.planner).Run()
+    # Replayed changes of the entries which failed are kept pending.
+    for name in self.replayed.keys():
+      if name not in results or results[name][0] == 0:
+        del self.replayed[name]
+
+  def PrepareBackups(self, entries):
+    """Set up the initial backup of entries.
+
+    Reads the catalog of every entry, the changes replayed from the pending
+    change log and counts the size of recursive entries. Blocking.
+
+    Args:
+      entries: List - The entries.
+
+    Returns:
+      backups: List - Tuples passed to backup.InitialBackup.
+    """
 
-    for entry in self.enlist:
+    backups = []
+    for entry in entries:
+      entrycatalog = self.LoadCatalog(entry)
+      replayed = None
+      if entry['name'] in self.replayed:
+        pending = journal.EntryChanges(entry['path'])
+        for mask, path, name in self.replayed[entry['name']]:
+          pending.Replay(mask, path, name)
+        replayed = pending.journal.NetChanges()
+        self.log.logger.info('Entry %s: %s changes not backed up before the'
+                             ' last exit', entry['name'], len(replayed))
       # Print appropriate messsages and perform an initial full backup.
       startbackup = backup.Backup(self.backupdirpath,
                                   self.rsync_path,
@@ -182,7 +278,47 @@ class OpenDuckbillMain(init.InitData):
                                   entry, log_handle=self.log,
                                   dryrun=self.log.dryrun,
                                   sh_var=self.ssh_shell_var)
-      startbackup.VerifyBackup()
+      startbackup.localcopy = self.localcopy
+      if entry['recursive']:
+        size = self.planner.CountTree(entry['path'])
+      else:
+        size = 1
+      backups.append((startbackup, size, entrycatalog, replayed))
+    return backups
+
+  def LoadCatalog(self, entry):
+    """Read the catalog of an entry.
+
+    Args:
+      entry: Dictionary - The entry.
+
+    Returns:
+      entrycatalog: Object - catalog.EntryCatalog, to be kept in
+        self.catalogs. Not valid if there is no usable catalog (first run,
+        or configuration changed), in which case the entry is synced fully.
+    """
+
+    identity = {'path': entry['path'],
+                'recursive': entry['recursive'],
+                'exclude': entry.get('exclude'),
+                'include': entry.get('include'),
+                'globalexclude': self.excludelist,
+                'dest': self.backupdirpath,
+                'method': self.backupmethod}
+    entrycatalog = catalog.EntryCatalog(entry, identity)
+    entrycatalog.destindex = self.destindex
+    if entrycatalog.Load():
+      self.log.logger.debug('Catalog of %s: %s paths', entry['name'],
+                            len(entrycatalog))
+      if (self.destindex is not None and
+          not self.destindex.Owns(entry['name'])):
+        # New index, what the catalog lists is at the destination.
+        self.destindex.ReplaceEntry(entry['name'], entrycatalog.files,
+                                    time.time())
+    else:
+      self.log.logger.info('No usable catalog for entry %s, full sync',
+                           entry['name'])
+    return entrycatalog
 
   def CreateServerThread(self):
     """Create the server daemon.
@@ -191,9 +327,12 @@ class OpenDuckbillMain(init.InitData):
     become a daemon. Also stops logging to console and thus have no controlling
     terminal. Becomes daemon only if variable nofork is False (-F option in
     command line argumment). Also gets ready to receive following signals:
-    SIGINT, SIGQUIT, SIGTERM and SIGUSR1 (raised in StartAsyncBackupThread).
-    Finally, after becoming a daemon, invokes BackupServer function to start
-    timer threads and filesystem monitoring.
+    SIGINT, SIGQUIT, SIGTERM and SIGUSR1 (raised in StartAsyncBackupThread),
+    and SIGHUP, which reloads the config file (see ReloadConfig).
+    Signals are delivered through the event loop, so Cleanup never runs in the
+    middle of another callback. Finally, after becoming a daemon, invokes
+    BackupServer function to start the scheduler, timers and filesystem
+    monitoring.
 
     Ref: http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/278731
     for details on how to create a daemon.
@@ -223,43 +362,74 @@ class OpenDuckbillMain(init.InitData):
       else:
         os._exit(0)
 
-    signal.signal(signal.SIGINT, self.Cleanup)
-    signal.signal(signal.SIGQUIT, self.Cleanup)
-    signal.signal(signal.SIGTERM, self.Cleanup)
-    signal.signal(signal.SIGUSR1, self.Cleanup)
+    # Created after forking, worker threads do not survive a fork.
+    self.loop = eventloop.EventLoop(self.log)
+    self.loop.AddSignal(signal.SIGINT, self.Cleanup)
+    self.loop.AddSignal(signal.SIGQUIT, self.Cleanup)
+    self.loop.AddSignal(signal.SIGTERM, self.Cleanup)
+    self.loop.AddSignal(signal.SIGUSR1, self.Cleanup)
+    self.loop.AddSignal(signal.SIGHUP, self.ReloadConfig)
 
     self.kill_counter = 0
-    self.cur_accumlator = 0
-    self.prev_accumlator = 0
-    self.max_idlecount = 3
-    self.idlecount = 0
-    self.asyncthreads = []
+    self.asyncbackups = []
+    self.processor_handle = None
+    self.watch_handle = None
+    self.trigger = None
+    self.deltrigger = None
+    self.exiting = False
+    self.catalogtimer = None
+    self.pendinglog = None
+    self.takenids = {}
+    self.sshtimer = None
+    self.sshchecking = False
+    self.capacity = None
+    self.capacitytimer = None
+    self.probing = False
+    # AsyncBackup => {entry name: journal.EntryChanges} taken for it.
+    self.takenchanges = {}
+    self.snapshots = None
+    self.snapshottimer = None
+    self.expirytimer = None
+    self.snapshotting = False
+    # Something was backed up since the last snapshot.
+    self.snapshotchanged = True
+    self.polled = []
+    self.pollschedules = []
+    # Entry name => (watch descriptors, watches counted) of watched entries.
+    self.watches = {}
+    self.watchbudget = None
+    self.reloading = False
+    # Names of the entries added by a reload whose initial backup runs.
+    self.syncing = set()
+    # Exclude files replaced by a reload, which running backups may use.
+    self.staleexcludes = []
 
     self.BackupServer()
 
   def BackupServer(self):
-    """Goes into infinite loop and performs backup, when required.
-
-    BackupServer does the process of starting two timer threads, the trigger
-    timer and the entry deletor timer. Trigger (backup) timer thread sleeps for
-    timeout_value (syncinterval) seconds and then wakes up to invoke function
-    TriggerBackup, while entry deletor timer thread sleeps for
-    delthread_starttime seconds and wakes up to invoke StartDeletor function.
+    """Runs the event loop and performs backup, when required.
+
+    BackupServer does the process of starting the flush scheduler and the
+    entry deletor timer. The scheduler (trigger) keeps a loop timer at the
+    time the changes of an entry are due, which is "quietperiod" seconds
+    after the last filesystem event in the entry, but at most
+    timeout_value (syncinterval) seconds after its first pending change, and
+    then invokes function TriggerBackup. Nothing runs at all when there are
+    no changes. The entry deletor timer fires after delthread_starttime
+    seconds to invoke StartDeletor function.
     The entry deletor timer is enabled only if retainbackup is False (this
     can be set/unset in the config file, is not enabled if backup mehtod is
-    specified as RSYNC). The entry deletor thread is disabled if its no longer
+    specified as RSYNC). The entry deletor is disabled if its no longer
     required (No more files/directories to be removed).
 
-    The main thread goes into an infinite loop watching file system changes.
-    This is done by invoking function FileMonStart, followed by checking and
-    reading events happening in the monitored file(s)/directories. Main thread
-    exits if starting of file monitoring fails.
+    The main thread runs the event loop, which waits on the inotify
+    descriptor (see FileMonStart), the timers, the signals and the rsync
+    children all at once. Main thread exits if starting of file monitoring
+    fails.
     """
 
     self.timeout_value = self.syncinterval      # Global
-    self.max_accumlator = self.commitchanges    # Global
     self.maxbackupthreads = 3                   # Global
-    self.accumlator = 0
     self.alivecount_gl = 0
     # Time after which app will kill itself, if backups continue to fail.
     self.cutoff_counter = (10 * self.timeout_value)
@@ -267,48 +437,57 @@ class OpenDuckbillMain(init.InitData):
     if self.log.debug:
       self.DebugInfo()
       pass
-    # Init trigger (backup) timer
-    self.trigger = threading.Timer(self.timeout_value, self.TriggerBackup)
-    # Init and start entry deletor timer
-    if not self.retainbackup:
-      self.log.logger.debug('Entry deletor trigger thread going to sleep.')
-      self.deltrigger = threading.Timer(self.delthread_starttime,
-                                        self.StartDeletor)
-      self.deltrigger.start()
+    # Entries are rescanned when filesystem events have been lost.
+    self.rescanner = rescan.TreeRescanner(self.log)
+    self.rescanpending = set()
+    self.rescanning = False
+    # Entry name => time its changes were last taken for backup.
+    self.lastflush = {}
+    # Init trigger (backup) scheduler
+    self.trigger = scheduler.FlushScheduler(self.loop, self.quietperiod,
+                                            self.syncinterval,
+                                            self.TriggerBackup, self.log)
+    if not self.log.dryrun:
+      self.pendinglog = pendinglog.PendingLog(self.loop, self.log)
+      if not self.pendinglog.Start(self.replayed):
+        self.pendinglog = None
+    if self.destindex is not None:
+      reclaimfunc = self.UnscheduledBytes
+    else:
+      reclaimfunc = None
+    self.capacity = capacity.CapacityMonitor(self.ProbeFreeSpace,
+                                             self.minfreespace * 1024 * 1024,
+                                             self.log, reclaimfunc)
+    if self.snapshotinterval and not self.log.dryrun:
+      self.snapshots = snapshot.SnapshotManager(self.loop, self.backupdirpath,
+                                                self.snapshotdirpath,
+                                                self.rsync_path, self.log,
+                                                self.keephourly,
+                                                self.keepdaily,
+                                                self.keepweekly)
+      self.snapshots.Recover()
+    if self.log.versionstore and self.keepversions and not self.log.dryrun:
+      self.ScheduleVersionExpiry(self.quietperiod)
     # Start filesystem monitoring
+    self.monitorstart = time.time()
     self.notifier_handle, self.processor_handle = self.FileMonStart()
     if self.notifier_handle:
-      while True:
-        if not self.trigger.isAlive():
-          self.log.logger.debug('Backup trigger thread going to sleep.')
-          self.trigger = threading.Timer(self.timeout_value, self.TriggerBackup)
-          self.trigger.start()
-        if not self.retainbackup:
-          if not self.log.deletor_disable:
-            if not self.deltrigger.isAlive():
-              self.log.logger.debug('Entry deletor trigger thread going to'
-                                    ' sleep.')
-              self.deltrigger = threading.Timer(self.delthread_starttime,
-                                                self.StartDeletor)
-              self.deltrigger.start()
-          else:
-            if self.deltrigger.isAlive():
-              self.log.logger.warning('Disable entry deletor trigger thread.')
-              self.deltrigger.cancel()
-        try:
-          # Filesystem changes are checked and read here
-          self.notifier_handle.process_events()
-          if self.notifier_handle.check_events():
-            self.notifier_handle.read_events()
-        except KeyboardInterrupt:
-          self.log.logger.warning('Stop file monitoring.')
-          self.notifier_handle.stop()
-          self.log.logger.warning('Stop timer thread.')
-          if self.trigger.isAlive():
-            self.trigger.cancel()
-          break
-        except Exception, strerr:
-          print strerr
+      for item in self.enlist:
+        if item['name'] in self.replayed:
+          self.processor_handle.Replay(item, self.replayed[item['name']])
+          self.trigger.Notify(item['name'])
+      # Filesystem changes are read whenever the inotify descriptor is
+      # readable.
+      self.loop.AddReader(self.InotifyFd(), self.ReadFileEvents)
+      self.StartPolling()
+      self.ScheduleSshCheck()
+      self.ScheduleCapacityProbe(0)
+      self.ScheduleSnapshot()
+      # Write what the initial backups changed.
+      self.ScheduleCatalogSave()
+      # Init entry deletor timer
+      self.ScheduleDeletor()
+      self.loop.Run()
     else:
       msg = ('Failed to start file monitoring')
       self.log.logger.critical(msg)
@@ -326,6 +505,10 @@ class OpenDuckbillMain(init.InitData):
     field of that entry. Uses class FileMonEventProcessor for processing the
     events that occur in the monitored files/directories.
 
+    inotify needs one watch per directory. The directories of each entry are
+    counted against the watch budget (see WatchBudget); an entry which does
+    not fit is polled instead (see PollEntry).
+
     Returns:
       event_notifier: Object - to the Notifying system
       event_processor: Object - to class FileMonEventProcessor, which processes
@@ -334,70 +517,249 @@ class OpenDuckbillMain(init.InitData):
 
     avail_events = pyinotify.EventsCodes
     # Events to be monitored.
-    eventsmonitored = (avail_events.OP_FLAGS['IN_CLOSE_WRITE'] | avail_events.OP_FLAGS['IN_CREATE'] |
+    self.eventsmonitored = (avail_events.OP_FLAGS['IN_CLOSE_WRITE'] | avail_events.OP_FLAGS['IN_CREATE'] |
                        avail_events.OP_FLAGS['IN_DELETE'] | avail_events.OP_FLAGS['IN_MODIFY'] |
                        avail_events.OP_FLAGS['IN_MOVED_FROM'] | avail_events.OP_FLAGS['IN_MOVED_TO'] |
                        avail_events.OP_FLAGS['IN_ATTRIB'] | avail_events.OP_FLAGS['IN_MOVE_SELF'])
     # Start a event watcher
     event_watcher = pyinotify.WatchManager()
+    self.watch_handle = event_watcher
     # Create a event processor
-    event_processor = FileMonEventProcessor()
+    event_processor = FileMonEventProcessor(self.router, self.trigger.Notify,
+                                            self.HandleOverflow,
+                                            self.pendinglog)
     # Read change notifications and process events accordingly
     event_notifier = pyinotify.Notifier(event_watcher, event_processor)
+    self.watchbudget = self.WatchBudget()
+    self.polled = []
     for item in self.enlist:
-      if item['recursive']:
-        event_watcher.add_watch(item['path'], eventsmonitored, rec=True,
-                                auto_add=True)
-        self.log.logger.info('Start monitoring of %s [recursive]'
-                             % (item['path']))
-      else:
-        # Add path to be watched for filesystem changes
-        event_watcher.add_watch(item['path'], eventsmonitored)
-        self.log.logger.info('Start monitoring of %s', item['path'])
+      self.WatchEntry(item)
     return event_notifier, event_processor
 
-  def TriggerBackup(self):
-    """Triggers backup if required.
+  def WatchEntry(self, item):
+    """Start monitoring an entry, or mark it polled if it does not fit.
 
-    Function is responsible for determining whether its required to perform a
-    backup operation. This is done by looking at the variable accumlator, which
-    is a counter keeping track of file/directory modification events. If there
-    are indeed changes to be backed up, function StartAsyncBackupThread is
-    called. Calls function ShowResources if log.showresources is True (-R
-    option in command line)
+    The directories of the entry are counted against the watches left
+    (watchbudget).
+
+    Args:
+      item: Dictionary - The entry.
 
-    This function is invoked every time timer thread wakes up after sleeping
-    for syncinterval seconds.
+    Returns:
+      Boolean - True if the entry is watched, False if it is to be polled.
     """
 
-    self.accumlator = self.processor_handle.counter
-    self.paths_modified = self.processor_handle.changed_path
-    self.log.logger.debug('Backup trigger thread finished sleeping and wokeup.')
-    self.log.logger.debug('Paths modified %s, Accumlated changes: %s'
-                          % (self.paths_modified, self.accumlator))
-    if self.accumlator >= self.max_accumlator:
-      self.log.logger.info('Flushing %s accumlated changes to backup dir',
-                           self.accumlator)
-      self.StartAsyncBackupThread()
-    elif self.accumlator:
-      self.prev_accumlator = self.cur_accumlator
-      self.cur_accumlator = self.accumlator
-      if self.cur_accumlator == self.prev_accumlator:
-        self.idlecount += 1
-      else:
-        self.idlecount = 0
-      if self.idlecount >= self.max_idlecount:
-        self.log.logger.info('Idle filesystem, Flush all changes (%s)'
-                             ' accumlated till now', self.accumlator)
-        self.StartAsyncBackupThread()
+    budget = self.watchbudget
+    if item['recursive'] and budget is not None:
+      needed = rescan.CountDirectories(item['path'], budget)
+    else:
+      needed = 1
+    if budget is not None:
+      if needed > budget:
+        self.log.logger.warning('%s has more directories than inotify'
+                                ' watches left (%s), polling it instead',
+                                item['path'], budget)
+        self.polled.append(item)
+        return False
+      self.watchbudget -= needed
+    if item['recursive']:
+      descriptors = self.watch_handle.add_watch(item['path'],
+                                                self.eventsmonitored,
+                                                rec=True, auto_add=True)
+      self.log.logger.info('Start monitoring of %s [recursive]'
+                           % (item['path']))
+    else:
+      # Add path to be watched for filesystem changes
+      descriptors = self.watch_handle.add_watch(item['path'],
+                                                self.eventsmonitored)
+      self.log.logger.info('Start monitoring of %s', item['path'])
+    self.watches[item['name']] = (descriptors, needed)
+    return True
+
+  def UnwatchEntry(self, item):
+    """Stop monitoring (or polling) an entry, see WatchEntry."""
+
+    if item in self.polled:
+      self.polled.remove(item)
+      self.pollschedules = [schedule for schedule in self.pollschedules
+                            if schedule.entry is not item]
+      self.log.logger.info('Stop polling of %s', item['path'])
+      return
+    try:
+      descriptors, needed = self.watches.pop(item['name'])
+    except KeyError:
+      return
+    wd = descriptors.get(item['path'])
+    if wd is not None and wd >= 0:
+      # Removes the watches of the subdirectories too.
+      self.watch_handle.rm_watch(wd, rec=item['recursive'])
+    if self.watchbudget is not None:
+      self.watchbudget += needed
+    self.log.logger.info('Stop monitoring of %s', item['path'])
+
+  def WatchBudget(self):
+    """Returns the number of inotify watches openduckbill may use.
+
+    Global variable "maxwatches" if defined, otherwise half of the kernel
+    limit (the other half is left to other programs). None if unknown.
+    """
+
+    if self.maxwatches:
+      return self.maxwatches
+    try:
+      limitfile = file('/proc/sys/fs/inotify/max_user_watches', 'r')
+      try:
+        return int(limitfile.read()) / 2
+      finally:
+        limitfile.close()
+    except (IOError, ValueError), e:
+      self.log.logger.debug('inotify watch limit unknown: %s', e)
+      return None
+
+  def StartPolling(self):
+    """Start polling the entries which are not watched."""
+
+    self.pollschedules = []
+    for item in self.polled:
+      self.StartPollingEntry(item, self.monitorstart)
+
+  def StartPollingEntry(self, item, since):
+    """Start polling one entry, for changes made after time since."""
+
+    schedule = rescan.PollSchedule(item, self.syncinterval, since)
+    self.pollschedules.append(schedule)
+    self.log.logger.info('Start polling of %s every %s seconds or more',
+                         item['path'], schedule.interval)
+    self.loop.CallLater(schedule.interval, self.PollEntry, schedule)
+
+  def PollEntry(self, schedule):
+    """Scan a polled entry for changes, in a thread of its own."""
+
+    if self.exiting or schedule not in self.pollschedules:
+      # Stopped, or the entry was removed by a reload.
+      return
+    since = schedule.Started()
+    self.loop.RunLongTask(self.rescanner.ScanEntry, (schedule.entry, since),
+                          lambda result, error:
+                          self.PollDone(schedule, result, error), 'Poll')
+
+  def PollDone(self, schedule, result, error):
+    """Record the changes found in a polled entry and poll it again."""
+
+    if error is not None:
+      self.log.logger.error('Polling of %s failed: %s',
+                            schedule.entry['path'], error)
+      result = None
+    elif schedule not in self.pollschedules:
+      return
+    elif len(result) or not result.complete:
+      self.processor_handle.RecordRescan(result)
+      self.trigger.Notify(schedule.entry['name'])
+    interval = schedule.Finished(result)
+    self.log.logger.debug('Next poll of %s in %.0f seconds',
+                          schedule.entry['path'], interval)
+    self.loop.CallLater(interval, self.PollEntry, schedule)
+
+  def InotifyFd(self):
+    """Returns the inotify file descriptor of the event watcher."""
+
+    try:
+      return self.watch_handle.get_fd()
+    except AttributeError:
+      # Older pyinotify
+      return self.watch_handle._fd
+
+  def ReadFileEvents(self):
+    """Loop callback, reads and processes pending filesystem events."""
+
+    self.notifier_handle.read_events()
+    self.notifier_handle.process_events()
+
+  def HandleOverflow(self):
+    """The kernel dropped filesystem events, rescan the entries.
+
+    The inotify queue is shared by every watch, so every watched entry may
+    have missed changes. Overflows during a rescan are coalesced into one more
+    rescan.
+    """
+
+    self.log.logger.warning('Filesystem event queue overflowed, rescanning'
+                            ' entries for lost changes')
+    for item in self.enlist:
+      if item not in self.polled:
+        self.rescanpending.add(item['name'])
+    self.StartRescan()
+
+  def StartRescan(self):
+    """Rescan the entries marked dirty, in a thread of its own."""
+
+    if self.rescanning or not self.rescanpending or self.exiting:
+      return
+    entries = []
+    sinces = []
+    for item in self.enlist:
+      if item['name'] in self.rescanpending:
+        entries.append(item)
+        sinces.append(self.lastflush.get(item['name'], self.monitorstart))
+    self.rescanpending.clear()
+    self.rescanning = True
+    self.loop.RunLongTask(self.rescanner.ScanEntries, (entries, sinces),
+                          self.RescanDone, 'Rescan')
+
+  def RescanDone(self, results, error):
+    """Record the changes found by the rescan, as if events were received."""
+
+    self.rescanning = False
+    if error is not None:
+      self.log.logger.error('Rescan failed: %s', error)
+    else:
+      for result in results:
+        if len(result) or not result.complete:
+          self.processor_handle.RecordRescan(result)
+          self.trigger.Notify(result.entry['name'])
+    self.StartRescan()
+
+  def TriggerBackup(self, due):
+    """Triggers backup of the entries which are due.
+
+    Invoked by the scheduler (trigger) once entries have been quiet
+    for "quietperiod" seconds, or have waited "syncinterval" seconds since
+    their first pending change. Calls function StartAsyncBackupThread for
+    those entries. If the backup could not be started, the entries are
+    retried after timeout_value seconds. Calls function ShowResources if
+    log.showresources is True (-R option in command line)
+
+    Args:
+      due: List - (entry name, seconds since first pending change) tuples.
+    """
+
+    names = [name for name, latency in due]
+    self.log.logger.debug('Backup trigger woke up for: %s', names)
+    if self.snapshotting:
+      # The backup directory is not changed while a snapshot is taken.
+      for name in names:
+        self.trigger.Defer(name, self.quietperiod)
+      return
+    for name in names[:]:
+      if name in self.syncing:
+        # Added by a reload, backed up once its initial backup is done.
+        self.trigger.Defer(name, self.quietperiod)
+        names.remove(name)
+    if not names:
+      return
+    self.log.logger.info('Flushing accumlated changes of %s to backup dir',
+                         names)
+    if not self.StartAsyncBackupThread(names):
+      for name in names:
+        self.trigger.Defer(name, self.timeout_value)
     if self.log.showresources:
       self.ShowResources()
 
-  def StartAsyncBackupThread(self):
-    """Create new thread for backup.
+  def StartAsyncBackupThread(self, names=None):
+    """Start backup of the modified entries.
 
-    Start a separate thread which will perform backup of the modfied entry. How
-    it works is described below:
+    Start an asynchronous backup (backup.AsyncBackup) of the modfied
+    entries, run by the event loop. How it works is described below:
       - Checks whether the backup partition is still mounted (available for
       backups, if backup method is NFS).
         - If not, then performing a backup is impossible (level ERROR). Popup a
@@ -405,12 +767,12 @@ class OpenDuckbillMain(init.InitData):
           number of attempts to backup fail because the backup partition is
           unavailable, then issue a self-kill signal and exit.
       - If yes (backup partition available), then make sure the number of
-      active threads are less than the maximum permitted limit
-      (maxbackupthreads) and initiate a backup by starting the backup thread.
-        - If the maxmum threads are already active, then continue monitoring
-          the filesystem and don't start the backup thread. Instead, increase
+      active backups are less than the maximum permitted limit
+      (maxbackupthreads) and initiate a backup.
+        - If the maxmum backups are already active, then continue monitoring
+          the filesystem and don't start the backup. Instead, increase
           the timeout (syncinterval) value and wait for active number of
-          threads to be less than the maximum permitted limit.
+          backups to be less than the maximum permitted limit.
       - When backup method is specified as RSYNC, there is no check done to
         verify whether the remote end is available or not. The daemon will
         print error messages and continue to perform rsync for ever. (Unlike
@@ -419,20 +781,26 @@ class OpenDuckbillMain(init.InitData):
     Responsible for showing the GUI popup message box if backup partition is not
     available for backup. Removes the message box (if already active), if backup
     partition is available again.
+
+    Args:
+      names: List - Names of the entries to back up. All entries with
+        pending changes, if None.
+
+    Returns:
+      Boolean - True if the pending changes have been taken care of, False if
+        the backup has to be retried later.
     """
 
+    started = False
     if not self.IsBackupPartitionMounted():
-      alivecount = 0
-      for item in self.asyncthreads:
-        if item.isAlive():
-          alivecount += 1
-        else:
-          self.asyncthreads.remove(item)
-        self.alivecount_gl = alivecount
+      self.asyncbackups = [item for item in self.asyncbackups
+                           if item.IsActive()]
+      alivecount = len(self.asyncbackups)
+      self.alivecount_gl = alivecount
       if alivecount >= self.maxbackupthreads:
         # Increase timeout (syncinterval) to give some time for the existing
-        # active threads to finish their execution.
-        self.log.logger.warning('Maximum number (%s) of threads already'
+        # active backups to finish their execution.
+        self.log.logger.warning('Maximum number (%s) of backups already'
                                 ' running', alivecount)
         self.timeout_value += (self.timeout_value/2)
         self.log.logger.warning('Increased "syncinterval" to %s',
@@ -443,25 +811,59 @@ class OpenDuckbillMain(init.InitData):
                                   ' earlier: %s', self.exlist_tmpname)
           self.log.logger.warning('Trying to create exclude file again')
           self.CreateExclude()
-        asyncbackup = backup.AsyncBackup(self.backupdirpath,
-                                         self.rsync_path,
-                                         self.exlist_tmpname,
-                                         self.enlist,
-                                         self.paths_modified,
-                                         self.log,
-                                         sh_var=self.ssh_shell_var)
-        asyncbackup.start()
-        # Reset everything to start afresh, now that we've started a new
-        # thread to do backup.
-        self.asyncthreads.append(asyncbackup)
-        self.processor_handle.counter = 0
-        self.processor_handle.changed_path = []
-        self.cur_accumlator = 0
-        self.prev_accumlator = 0
-        self.idlecount = 0
+        # Take the pending changes, new events start afresh.
+        now = time.time()
+        if names is None:
+          for item in self.enlist:
+            self.lastflush[item['name']] = now
+        else:
+          for name in names:
+            self.lastflush[name] = now
+        self.paths_modified = []
+        netchanges = {}
+        takenids = {}
+        takenchanges = {}
+        for name, pending in self.processor_handle.TakeChanges(names):
+          self.paths_modified.extend(pending.changed_path.CoveringPaths())
+          entrychanges = pending.journal.NetChanges()
+          netchanges.update(entrychanges)
+          takenchanges[name] = pending
+          if self.pendinglog:
+            takenid = self.pendinglog.Taken(name)
+            if entrychanges:
+              takenids[name] = takenid
+            else:
+              self.pendinglog.Done(name, takenid)
+        if netchanges:
+          asyncbackup = backup.AsyncBackup(self.loop,
+                                           self.backupdirpath,
+                                           self.rsync_path,
+                                           self.exlist_tmpname,
+                                           self.enlist,
+                                           self.paths_modified,
+                                           self.log,
+                                           sh_var=self.ssh_shell_var,
+                                           router=self.router,
+                                           changes=netchanges,
+                                           transferplanner=self.planner,
+                                           donefunc=self.BackupDone,
+                                           catalogs=self.catalogs,
+                                           batch=self.batchtransfers,
+                                           localcopy=self.localcopy,
+                                           capacity=self.capacity)
+          self.takenids[asyncbackup] = takenids
+          self.takenchanges[asyncbackup] = takenchanges
+          asyncbackup.Start()
+          self.asyncbackups.append(asyncbackup)
+        else:
+          # Every change cancelled out (eg. temporary files created and
+          # removed)
+          self.log.logger.debug('Accumlated changes cancelled out, nothing to'
+                                ' back up')
+        started = True
         self.kill_counter = 0
         if alivecount:
-          self.log.logger.debug('Active threads: %s', alivecount)
+          self.log.logger.debug('Active backups: %s', alivecount)
         # Reduce the timeout (syncinterval) if all seems fine.
         if self.timeout_value > self.syncinterval:
           self.timeout_value -= (self.timeout_value/2)
@@ -475,12 +877,346 @@ class OpenDuckbillMain(init.InitData):
       self.RemGuiMsg()
       if not self.log.internal_disable:
         self.log.deletor_disable = False
+        self.ScheduleDeletor()
     else:
       # Backup partition not available. Print message to console/file and also
       # show a GUI message box to inform user.
       self.PartitionUnavail()
       self.log.deletor_disable = True
     self.kill_counter += self.syncinterval
+    return started
+
+  def BackupDone(self, asyncbackup):
+    """An asynchronous backup finished.
+
+    Marks the changes backed up as done in the pending change log, and
+    saves the updated catalogs soon. The changes of entries held back for
+    lack of space are put back, and retried after capacity.HOLD_DELAY
+    seconds.
+    """
+
+    if asyncbackup.fblist:
+      # The ssh master connection might be gone, check it right away.
+      self.ScheduleSshCheck(0)
+    takenchanges = self.takenchanges.pop(asyncbackup, {})
+    entrynames = [item['name'] for item in self.enlist]
+    for name in asyncbackup.held:
+      if name not in entrynames:
+        # Removed by a reload meanwhile.
+        continue
+      # Kept pending (and in the pending change log) until there is room.
+      self.processor_handle.Restore(name, takenchanges[name])
+      self.trigger.Defer(name, capacity.HOLD_DELAY)
+    self.ScheduleCapacityProbe(0)
+    takenids = self.takenids.pop(asyncbackup, {})
+    if self.pendinglog:
+      for name, takenid in takenids.iteritems():
+        if not asyncbackup.Failed(name):
+          self.pendinglog.Done(name, takenid)
+    self.ScheduleCatalogSave()
+    self.snapshotchanged = True
+
+  def ScheduleCatalogSave(self):
+    """Save the catalogs in CATALOG_SAVE_DELAY seconds, unless scheduled."""
+
+    if self.catalogtimer is None and not self.exiting:
+      self.catalogtimer = self.loop.CallLater(CATALOG_SAVE_DELAY,
+                                              self.SaveCatalogs)
+
+  def SaveCatalogs(self):
+    """Write the changed catalogs (and index) from a worker thread.
+
+    The contents are serialised here, so the worker does not read catalogs
+    which the loop keeps updating.
+    """
+
+    self.catalogtimer = None
+    dumps = []
+    for entrycatalog in self.catalogs.itervalues():
+      if entrycatalog.dirty:
+        entrycatalog.dirty = False
+        dumps.append((entrycatalog, entrycatalog.Dump()))
+    if self.destindex is not None and self.destindex.dirty:
+      self.destindex.dirty = False
+      dumps.append((self.destindex, self.destindex.Dump()))
+    if dumps:
+      self.loop.RunInThread(self.WriteCatalogs, (dumps,),
+                            self.CatalogsWritten)
+
+  def WriteCatalogs(self, dumps):
+    """Returns the catalogs (of (catalog, data) tuples) failed to write."""
+
+    failed = []
+    for entrycatalog, data in dumps:
+      if not entrycatalog.Write(data):
+        failed.append(entrycatalog)
+    return failed
+
+  def CatalogsWritten(self, failed, error):
+    if error:
+      self.log.logger.warning('Failed to write catalogs: %s', error)
+      return
+    for entrycatalog in failed:
+      self.log.logger.warning('Failed to write catalog %s',
+                              entrycatalog.filename)
+      entrycatalog.dirty = True
+
+  def ScheduleSshCheck(self, delay=sshmux.CHECK_INTERVAL):
+    """Check the ssh master connection (method RSYNC) in delay seconds."""
+
+    if not self.sshmaster or self.sshchecking or self.exiting:
+      return
+    if self.sshtimer:
+      self.sshtimer.Cancel()
+    self.sshtimer = self.loop.CallLater(delay, self.CheckSshMaster)
+
+  def CheckSshMaster(self):
+    """Check the ssh master connection, restarted if gone, in a worker."""
+
+    self.sshtimer = None
+    self.sshchecking = True
+    self.loop.RunInThread(self.sshmaster.Check, (), self.SshMasterChecked)
+
+  def SshMasterChecked(self, running, error):
+    self.sshchecking = False
+    if error is not None:
+      self.log.logger.error('ssh master connection check failed: %s', error)
+    self.ScheduleSshCheck()
+
+  def UnscheduledBytes(self):
+    """Returns the bytes at the destination no longer backed up (index)."""
+
+    trie = deletor.ScheduleTrie(self.enlist)
+    return self.destindex.UnscheduledBytes(trie.Classify, deletor.BACKED_UP)
+
+  def ProbeFreeSpace(self):
+    """Returns the bytes free at the destination. Blocking."""
+
+    if self.backupmethod == "RSYNC":
+      return capacity.RemoteFree(self.ssh_cmd, self.backupdirpath)
+    return capacity.LocalFree(self.backupdirpath)
+
+  def ScheduleCapacityProbe(self, delay=capacity.PROBE_INTERVAL):
+    """Probe the free space at the destination in delay seconds."""
+
+    if self.probing or self.exiting:
+      return
+    if self.capacitytimer:
+      self.capacitytimer.Cancel()
+    self.capacitytimer = self.loop.CallLater(delay, self.ProbeCapacity)
+
+  def ProbeCapacity(self):
+    self.capacitytimer = None
+    self.probing = True
+    self.loop.RunInThread(self.ProbeFreeSpace, (), self.CapacityProbed)
+
+  def CapacityProbed(self, free, error):
+    self.probing = False
+    if error is not None:
+      self.log.logger.warning('Failed to probe free space at the destination:'
+                              ' %s', error)
+    else:
+      self.capacity.Record(free)
+    self.ScheduleCapacityProbe()
+
+  def ScheduleSnapshot(self, delay=None):
+    """Arm the snapshot timer.
+
+    Args:
+      delay: Integer - Seconds until the next snapshot. By default,
+        "snapshotinterval" seconds after the newest generation.
+    """
+
+    if not self.snapshots or self.snapshottimer or self.exiting:
+      return
+    if delay is None:
+      delay = 0
+      last = self.snapshots.LastTime()
+      if last is not None:
+        delay = max(0, last + self.snapshotinterval - time.time())
+    self.snapshottimer = self.loop.CallLater(delay, self.TakeSnapshot)
+
+  def TakeSnapshot(self):
+    """Take a snapshot of the backup directory, once no backup runs."""
+
+    self.snapshottimer = None
+    for item in self.asyncbackups:
+      if item.IsActive():
+        self.ScheduleSnapshot(self.quietperiod)
+        return
+    if not self.snapshotchanged:
+      self.log.logger.debug('Nothing backed up since the last snapshot')
+      self.ScheduleSnapshot(self.snapshotinterval)
+      return
+    self.snapshotting = True
+    self.snapshotchanged = False
+    self.snapshots.Take(self.SnapshotTaken)
+
+  def SnapshotTaken(self, taken):
+    self.snapshotting = False
+    if taken:
+      self.ScheduleSnapshot()
+    else:
+      self.snapshotchanged = True
+      self.ScheduleSnapshot(self.snapshotinterval)
+
+  def ScheduleVersionExpiry(self, delay=versionstore.EXPIRE_INTERVAL):
+    """Arm the timer removing the versions older than "keepversions"."""
+
+    if self.exiting:
+      return
+    self.expirytimer = self.loop.CallLater(delay, self.ExpireVersions)
+
+  def ExpireVersions(self):
+    """Expire the version store, see versionstore.VersionStore.Expire."""
+
+    self.expirytimer = None
+    self.loop.RunLongTask(self.log.versionstore.Expire, (self.keepversions,),
+                          self.VersionsExpired, 'VersionExpiry')
+
+  def VersionsExpired(self, freed, error):
+    if error is not None:
+      self.log.logger.error('Version store expiry failed: %s', error)
+    self.ScheduleVersionExpiry()
+
+  def ReloadConfig(self, signo):
+    """Apply the changes made to the entries and excludes of the config file.
+
+    Invoked on SIGHUP. The config file is read again (see
+    init.InitData.ReloadEntryData) and compared with the running
+    configuration:
+      - Removed entries stop being monitored (or polled) and their pending
+        changes are dropped. Their backups are left in the backup directory.
+      - Added entries are monitored, then get an initial backup in a worker
+        thread. Their changes are backed up once it is done.
+      - An entry whose path, recursive, exclude or include key changed is
+        removed and added again. A changed priority is just taken.
+      - A changed exclude section regenerates the exclude file, which the
+        backups started from now on use.
+    Unchanged entries are not touched, so a reload costs the backup of the
+    entries added and nothing else. Changes to the other sections need a
+    restart.
+
+    Args:
+      signo: Integer - Signal number recieved (SIGHUP).
+    """
+
+    if self.exiting:
+      return
+    if self.reloading:
+      self.log.logger.warning('Initial backup of the entries added by the'
+                              ' last reload still running, not reloading')
+      return
+    config = self.ReloadEntryData()
+    if config is None:
+      self.log.logger.error('Config reload failed, keeping the current'
+                            ' configuration')
+      return
+    excludelist, entrylist, changed = config
+    for section in changed:
+      self.log.logger.warning('Changes to section "%s" need a restart',
+                              section)
+    current = {}
+    for item in self.enlist:
+      current[item['name']] = item
+    newlist = []
+    added = []
+    removed = []
+    for item in entrylist:
+      old = current.pop(item['name'], None)
+      if (old is not None and
+          self.EntrySettings(old) == self.EntrySettings(item)):
+        # Kept as is, the running backups refer to it.
+        old['priority'] = item['priority']
+        newlist.append(old)
+        continue
+      if old is not None:
+        removed.append(old)
+      added.append(item)
+      newlist.append(item)
+    removed.extend(current.values())
+    for item in removed:
+      self.RemoveEntry(item)
+    if excludelist != self.exclist:
+      # Running backups keep using the old file.
+      self.staleexcludes.append(self.exlist_tmpname)
+      self.CreateExclude()
+      self.log.logger.info('Exclude list changed, regenerated the exclude'
+                           ' file')
+    self.exclist = excludelist
+    self.enlist = newlist
+    self.router = pathtrie.EntryRouter(self.enlist)
+    self.processor_handle.router = self.router
+    for item in added:
+      if not self.WatchEntry(item):
+        self.StartPollingEntry(item, time.time())
+    self.log.logger.info('Config reloaded: %s entries added, %s removed',
+                         len(added), len(removed))
+    if added:
+      self.reloading = True
+      self.syncing = set([item['name'] for item in added])
+      self.loop.RunLongTask(self.SyncEntries, (added,),
+                            lambda result, error:
+                            self.EntriesSynced(added, result, error),
+                            'InitialSync')
+
+  def EntrySettings(self, item):
+    """Returns the keys which make an entry a different one on reload."""
+
+    return (item['path'], item['recursive'], item.get('exclude'),
+            item.get('include'))
+
+  def RemoveEntry(self, item):
+    """Stop monitoring an entry removed from the config file."""
+
+    name = item['name']
+    self.UnwatchEntry(item)
+    self.processor_handle.TakeChanges([name])
+    self.trigger.Forget(name)
+    self.rescanpending.discard(name)
+    self.lastflush.pop(name, None)
+    if self.pendinglog:
+      self.pendinglog.Done(name, self.pendinglog.Taken(name))
+    self.log.logger.info('Entry %s removed', name)
+
+  def SyncEntries(self, entries):
+    """Initial backup of the entries added by a reload. Blocking.
+
+    Returns:
+      Tuple - (backups, results) of backup.InitialBackup.
+    """
+
+    backups = self.PrepareBackups(entries)
+    results = backup.InitialBackup(backups, self.initialworkers, self.log,
+                                   transferplanner=self.planner).Run()
+    return backups, results
+
+  def EntriesSynced(self, entries, result, error):
+    """The initial backup of the entries added by a reload is done.
+
+    Entries whose initial backup failed are synced as a whole with the next
+    backup.
+    """
+
+    self.reloading = False
+    self.syncing.clear()
+    if error is not None:
+      self.log.logger.error('Initial backup of the added entries failed: %s',
+                            error)
+      backups, results = [], {}
+    else:
+      backups, results = result
+    for startbackup, size, entrycatalog, replayed in backups:
+      self.catalogs[startbackup.name] = entrycatalog
+    self.snapshotchanged = True
+    if self.exiting:
+      return
+    for item in entries:
+      if results.get(item['name'], (1, 0))[0]:
+        failed = rescan.RescanResult(item)
+        failed.complete = False
+        self.processor_handle.RecordRescan(failed)
+        self.trigger.Notify(item['name'])
 
   def PartitionUnavail(self):
     msg = "Won't be able to perform backup."
@@ -515,38 +1251,53 @@ class OpenDuckbillMain(init.InitData):
       # a backup.
       os.kill(os.getpid(), signal.SIGUSR1)
 
+  def ScheduleDeletor(self):
+    """Arm the entry deletor timer, unless armed, running or disabled."""
+
+    if self.retainbackup or self.log.deletor_disable or self.deltrigger:
+      return
+    self.log.logger.debug('Entry deletor trigger going to sleep.')
+    self.deltrigger = self.loop.CallLater(self.delthread_starttime,
+                                          self.StartDeletor)
+
   def StartDeletor(self):
-    """Starts the thread which removes un-needed files/directories.
+    """Starts the deletor, which removes un-needed files/directories.
 
-    Starts the deletor thread, which does the cleaning up operation of the
+    Starts the deletor, which does the cleaning up operation of the
     backup drive. Cleaning up is nothing but removing those files which are
     not part of the backup schedule (and older than retentiontime defined in
-    the config file). The operation is done in a separate thread called the
-    deletor thread. The deletor thread is started here. StartDeletor function
-    is invoked by the Timer thread after sleeping for a period of time. The
-    delthread_starttime variable is doubled everytime, since the deletor thread
+    the config file). The operation is done in a thread of its own (see
+    eventloop.EventLoop.RunLongTask). StartDeletor function is invoked by
+    the deletor timer (deltrigger) after sleeping for a period of time. The
+    delthread_starttime variable is doubled everytime, since the deletor
     is a resource hungry one (as it searches in the backup partition for
     file/directories recursively.) Deletion operation is not supported when
     backup method is RSYNC.
     """
 
     if not self.log.deletor_disable:
-      deletor_thread = deletor.EntryDeletor(self.backupdirpath,
-                                            self.enlist, self.retentiontime,
-                                            self.log,
-                                            show_files=self.log.showdelfiles)
-      if not deletor_thread.isAlive():
-        self.log.logger.debug('Starting unscheduled entry deletor thread')
-        deletor_thread.start()
-      else:
-        self.log.logger.debug('Unscheduled entry deletor thread is already'
-                              ' active')
+      deletor_thread = deletor.EntryDeletor(
+          self.backupdirpath, self.enlist, self.retentiontime, self.log,
+          show_files=self.log.showdelfiles, scanworkers=self.scanworkers,
+          index=self.destindex, reconcileinterval=self.reconcileinterval)
+      self.log.logger.debug('Starting unscheduled entry deletor')
+      self.loop.RunLongTask(deletor_thread.run, (), self.DeletorDone,
+                            'EntryDeletor')
       if self.delthread_starttime <= self.retentiontime:
         self.delthread_starttime += self.delthread_starttime
     else:
-      if self.deltrigger.isAlive():
-        self.log.logger.warning('(Start)Disable entry deletor trigger thread.')
-        self.deltrigger.cancel()
+      self.log.logger.warning('(Start)Disable entry deletor trigger.')
+      self.deltrigger = None
+
+  def DeletorDone(self, result, error):
+    """The deletor has finished, arm the timer again."""
+
+    if error is not None:
+      self.log.logger.error('Unscheduled entry deletor failed: %s', error)
+    self.deltrigger = None
+    if self.destindex is not None and self.destindex.dirty:
+      self.ScheduleCatalogSave()
+    self.ScheduleDeletor()
 
   def ShowGuiMsg(self, msg, title):
     """Display message box for level ERROR messages.
@@ -598,7 +1349,7 @@ class OpenDuckbillMain(init.InitData):
         pass
       self.gui_helperpid = None
 
-  def Cleanup(self, signo, stkframe):
+  def Cleanup(self, signo, stkframe=None):
     """Perform a clean exit.
 
     Responsible for performing all the cleanup operations when the application
@@ -606,17 +1357,19 @@ class OpenDuckbillMain(init.InitData):
     or after receiving a SIGINT, SIGQUIT, SIGTERM or SIGUSR1 signals. This
     function tries to close all open descriptors, remove the exclude file
     created in CreateExclude function, try to sync any pending filesystem
-    changes if possible, stop the file monitoring timer thread, stop the
-    deletor timer thread and shutdown logging system.
+    changes if possible, stop the backup scheduler, stop the
+    deletor timer and shutdown logging system.
 
     Filesystem changes are synced to backup partition only under following
     conditions are met:
-      - Variable accumlator has a non-zero value
+      - There are pending changes
       - The received signal is either of SIGINT, SIGQUIT, SIGTERM  and not
         SIGUSR1 or SIGKILL
       - Backup partition is still mounted (available for backup)
-      - Maximum number of threads active are less than value of
+      - Maximum number of backups active are less than value of
         maxbackupthreads
+    The event loop keeps running until the backups are done, then function
+    Quit is called. A second signal quits right away.
 
     Args:
       signo: Integer - Signal number recieved by the application which
@@ -625,9 +1378,30 @@ class OpenDuckbillMain(init.InitData):
     """
 
     self.log.logger.critical('Oops! Got signal %s', signo)
+    if self.exiting:
+      self.log.logger.warning('Not waiting for running backups.')
+      self.Quit()
+    self.exiting = True
     # If any GUI popup messages are active, kill it, because we're exiting.
     self.RemGuiMsg()
-    if self.accumlator:
+    self.log.logger.warning('Stop file monitoring.')
+    try:
+      # Stop file monitoring
+      self.loop.RemoveReader(self.InotifyFd())
+    except AttributeError, e:
+      self.log.logger.warning('File monitoring not yet started.')
+    self.log.logger.warning('Stop backup trigger.')
+    if self.trigger:
+      # Stop scheduler
+      self.trigger.Stop()
+    if self.deltrigger:
+      self.log.logger.warning('Stop entry deletor trigger.')
+      self.deltrigger.Cancel()
+    if self.expirytimer:
+      self.expirytimer.Cancel()
+      self.expirytimer = None
+    waitbackup = False
+    if self.processor_handle and self.processor_handle.HasChanges():
       if not self.IsBackupPartitionMounted():
         if not signo == signal.SIGUSR1:
           if not self.alivecount_gl >= self.maxbackupthreads:
@@ -635,14 +1409,12 @@ class OpenDuckbillMain(init.InitData):
                                     ' to backup partition')
             # Try to backup the pending changes
             self.StartAsyncBackupThread()
-            for item in self.asyncthreads:
-              if item.isAlive():
-                item.join()
+            waitbackup = True
           else:
-            self.log.logger.warning('Maximum number (%s) of threads already'
+            self.log.logger.warning('Maximum number (%s) of backups already'
                                     ' running', self.alivecount_gl)
             self.log.logger.warning('There are pending changes, and it is'
-                                    'possible that backup threads are running.'
+                                    'possible that backups are running.'
                                     'But not performing backup and quitting'
                                     ' now.')
         else:
@@ -651,6 +1423,41 @@ class OpenDuckbillMain(init.InitData):
       else:
         self.log.logger.warning('There are pending changes, but not performing'
                                 ' backup.')
+    if waitbackup:
+      self.QuitWhenIdle()
+    else:
+      self.Quit()
+
+  def QuitWhenIdle(self):
+    """Call Quit once every running backup has finished."""
+
+    for item in self.asyncbackups:
+      if item.IsActive():
+        self.loop.CallLater(1, self.QuitWhenIdle)
+        return
+    self.Quit()
+
+  def Quit(self):
+    """Save the catalogs, remove the exclude file, stop logging and exit."""
+
+    if self.pendinglog:
+      self.pendinglog.Close()
+    if self.sshmaster:
+      self.sshmaster.Stop()
+
+    if self.catalogtimer:
+      self.catalogtimer.Cancel()
+      self.catalogtimer = None
+    if self.snapshots:
+      self.snapshots.Stop()
+    for entrycatalog in self.catalogs.itervalues():
+      if not entrycatalog.Save():
+        self.log.logger.warning('Failed to write catalog %s',
+                                entrycatalog.filename)
+    if self.destindex is not None and not self.destindex.Save():
+      self.log.logger.warning('Failed to write catalog %s',
+                              self.destindex.filename)
+
     try:
       # Remove temporary exclude file
       os.remove(self.exlist_tmpname)
@@ -658,21 +1465,15 @@ class OpenDuckbillMain(init.InitData):
       self.log.logger.error('%s', e)
       self.log.logger.error('Failed to remove temporary exclude file.')
     self.log.logger.warning('Removed temporary exclude file.')
-    self.log.logger.warning('Stop file monitoring.')
+    for tmpname in self.staleexcludes:
+      try:
+        os.remove(tmpname)
+      except OSError:
+        pass
     try:
-      # Stop file monitoring
       self.notifier_handle.stop()
     except AttributeError, e:
-      self.log.logger.warning('File monitoring not yet started.')
-    self.log.logger.warning('Stop backup trigger thread.')
-    if self.trigger.isAlive():
-      # Stop timer thread
-      self.trigger.cancel()
-    if not self.retainbackup:
-      self.log.logger.warning('Stop entry deletor trigger thread.')
-      if self.deltrigger.isAlive():
-        # Stop timer thread
-        self.deltrigger.cancel()
+      pass
     self.log.logger.warning('Stop logging and quit!')
     # Stop logging
     self.log.LogStop()
@@ -681,6 +1482,12 @@ class OpenDuckbillMain(init.InitData):
   def ShowResources(self):
     """Print resource usage in DEBUG mode."""
 
+    flushes, avglatency, maxlatency = self.trigger.LatencyStats()
+    self.log.logger.debug('Flushes: %s, latency average %.1fs, maximum %.1fs',
+                          flushes, avglatency, maxlatency)
+    for schedule in self.pollschedules:
+      self.log.logger.debug('Polling %s every %.0f seconds',
+                            schedule.entry['path'], schedule.interval)
     rsrce_self = resource.getrusage(resource.RUSAGE_SELF)
     self.log.logger.debug('Resource usage (self), PID: %d', os.getpid())
     self.log.logger.debug('%s: %s', 'Time in user mode', rsrce_self[0])
@@ -704,10 +1511,24 @@ class OpenDuckbillMain(init.InitData):
 
     self.log.logger.debug('Rsync binary path = %s', self.rsync_path)
     self.log.logger.debug('Sync interval = %s', self.glist[1])
-    self.log.logger.debug('Commit changes = %s', self.glist[2])
+    self.log.logger.debug('Quiet period = %s', self.quietperiod)
+    self.log.logger.debug('Max inotify watches = %s', self.WatchBudget())
+    self.log.logger.debug('Initial backup workers = %s', self.initialworkers)
+    self.log.logger.debug('Batch transfers = %s', self.batchtransfers)
+    self.log.logger.debug('Local copy = %s', self.localcopy)
     self.log.logger.debug('Maintain backup files = %s', self.glist[6])
+    self.log.logger.debug('Version store = %s', self.versionstore)
+    self.log.logger.debug('Versions kept = %s', self.keepversions)
+    self.log.logger.debug('Minimum free space = %s MB', self.minfreespace)
+    self.log.logger.debug('Compression = %s', self.compression)
+    self.log.logger.debug('Snapshot interval = %s', self.snapshotinterval)
+    self.log.logger.debug('Snapshots kept (hourly, daily, weekly) = %s, %s,'
+                          ' %s', self.keephourly, self.keepdaily,
+                          self.keepweekly)
     self.log.logger.debug('Retain backups = %s', self.glist[5])
     self.log.logger.debug('Retention time = %s', self.glist[4])
+    self.log.logger.debug('Scan workers = %s', self.scanworkers)
+    self.log.logger.debug('Reconcile interval = %s', self.reconcileinterval)
     self.log.logger.debug('Exclude list = %s', self.exclist)
     self.log.logger.debug('Entry list = %s', self.enlist)
     self.log.logger.debug('Cutoff counter = %s', self.cutoff_counter)
@@ -726,6 +1547,7 @@ class OpenDuckbillMain(init.InitData):
       self.log.logger.debug('Remote path = %s', self.methlist[1])
       if self.sshport:
         self.log.logger.debug('SSH port = %s', self.sshport)
+      self.log.logger.debug('SSH master = %s', bool(self.sshmaster))
     elif self.backupmethod == "LOCAL":
       self.log.logger.debug('Local mount = %s', self.methlist[2])
 
@@ -739,24 +1561,132 @@ class FileMonEventProcessor(pyinotify.ProcessEvent):
   performs the necessary actions.
   """
 
-  def __init__(self):
+  def __init__(self, router, notify=None, overflow=None, changelog=None):
+    """Initialise the event counter and the pending changes.
+
+    Args:
+      router: Object - pathtrie.EntryRouter, finds the entry of an event.
+      notify: Function - Called with the entry name, for every event.
+      overflow: Function - Called when the kernel dropped events.
+      changelog: Object - pendinglog.PendingLog, every change is logged to.
+    """
+
     self.counter = 0
-    self.changed_path = []
+    self.router = router
+    self.notify = notify
+    self.overflow = overflow
+    self.changelog = changelog
+    # Entry name => journal.EntryChanges. Only used from the event loop.
+    self.pending = {}
 
   def process_default(self, event):
     """Gets invoked for every event being monitored.
 
-    Increments counter and keeps track of the modified list. This function
-    is invoked whenever an event being monitored (eventsmonitored) from
-    FileMonStart occurs.
+    Increments counter and records the event in the pending changes of the
+    entry it belongs to. The changes keep track of the modified paths (a
+    path below an already modified directory is not recorded again) and of
+    the net change of each modified file. The scheduler is then notified,
+    so that it can postpone the backup of the entry until it is quiet. This
+    function is invoked whenever an event being monitored (eventsmonitored)
+    from FileMonStart occurs.
 
     Args:
       event: Event Object
     """
 
     self.counter += 1
-    modpath = event.path
+    if event.mask & journal.IN_Q_OVERFLOW:
+      self.process_IN_Q_OVERFLOW(event)
+      return
+    entry = self.router.Route(journal.EventPathname(event))
+    if entry is None:
+      entry = self.router.Route(event.path)
+      if entry is None:
+        return
+    self.EntryPending(entry).RecordEvent(event)
+    if self.changelog:
+      self.changelog.LogEvent(entry['name'], event.mask, event.path,
+                              event.name)
+    if self.notify:
+      self.notify(entry['name'])
+
+  def process_IN_Q_OVERFLOW(self, event):
+    """Gets invoked when the kernel event queue overflowed."""
+
+    if self.overflow:
+      self.overflow()
+
+  def RecordRescan(self, result):
+    """Records the changes found by rescanning an entry.
+
+    Args:
+      result: Object - rescan.RescanResult
+    """
+
+    self.EntryPending(result.entry).RecordRescan(result)
+    if self.changelog:
+      for mask, path, name in pendinglog.RescanRecords(result):
+        self.changelog.LogEvent(result.entry['name'], mask, path, name)
+
+  def Replay(self, entry, changes):
+    """Records changes read back from the pending change log.
+
+    Args:
+      entry: Dictionary - The entry.
+      changes: List - (mask, path, name) changes, see pendinglog.ReadLog.
+    """
+
+    pending = self.EntryPending(entry)
+    for mask, path, name in changes:
+      pending.Replay(mask, path, name)
+
+  def Restore(self, name, pending):
+    """Put back changes taken for a backup which was not run.
+
+    Args:
+      name: String - Entry name.
+      pending: Object - journal.EntryChanges taken by TakeChanges.
+    """
+
     try:
-      self.changed_path.index(modpath)
-    except ValueError:
-      self.changed_path.append(modpath)
+      later = self.pending[name]
+    except KeyError:
+      self.pending[name] = pending
+      return
+    pending.Merge(later)
+    self.pending[name] = pending
+
+  def EntryPending(self, entry):
+    """Returns the pending changes of entry, created if required."""
+
+    try:
+      return self.pending[entry['name']]
+    except KeyError:
+      pending = journal.EntryChanges(entry['path'])
+      self.pending[entry['name']] = pending
+      return pending
+
+  def HasChanges(self):
+    """Returns True if there are changes waiting to be backed up."""
+
+    return bool(self.pending)
+
+  def TakeChanges(self, names=None):
+    """Remove and return pending changes.
+
+    Args:
+      names: List - Entry names, all entries if None.
+
+    Returns:
+      List - (entry name, journal.EntryChanges object) tuples.
+    """
+
+    if names is None:
+      names = self.pending.keys()
+    taken = []
+    for name in names:
+      try:
+        taken.append((name, self.pending.pop(name)))
+      except KeyError:
+        pass
+    return taken
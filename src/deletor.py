@@ -28,21 +28,383 @@ This module is responsible for removing any files/directories from
 the backup partition, if the file/directory is not more part of an active
 backup schedule or is not being backed up anymore (discontinued). This module
 is not active when backup method is RSYNC.
+
+The backup directory is swept in one pass: each directory is listed and
+every name in it lstat'ed once, classified against the entry list, aged and,
+if old enough, removed right away (directories once their contents have
+been processed). Subtrees backed up as a whole are not descended into, and
+only the directories still being walked are held in memory. The directories
+to be swept next are read ahead by a metascan.MetadataScanner, and the
+removals are done by a RemovalPool, so that the round trips of an NFS backup
+directory overlap. Paths are absolute: the working directory of the daemon
+is left alone, and backups run on meanwhile.
+
+With an index of the destination (see destindex), the backup directory is
+only walked every "reconcileinterval" seconds, to reconcile the index with
+it. In between, the paths to remove are taken from the index, and only
+those old enough are lstat'ed before being removed.
 """
 
+import collections
+import errno
 import os
-import re
 import stat
 import tempfile
 import threading
 import time
 
+import destindex
+import metascan
+import pathtrie
+
+# Classification of the paths found in the backup directory
+COVERED = 'covered'            # Backed up with everything below it
+SCHEDULED = 'scheduled'        # Backed up by an entry
+DISCONTINUED = 'discontinued'  # Below an entry path, not backed up anymore
+NOMATCH = 'nomatch'            # Not related to any entry
+PARENT = 'parent'              # Parent directory of an entry path
+# Classifications of the paths which are backed up.
+BACKED_UP = (COVERED, SCHEDULED, PARENT)
+
+# Bytes of report text (-s command line option) buffered before a write.
+REPORT_BUFFER = 65536
+# Removals queued, per removal thread.
+REMOVAL_QUEUE_FACTOR = 256
+
+
+class _ScopeNode(object):
+  """One component of an entry path stored in a ScheduleTrie."""
+
+  __slots__ = ('children', 'scopes')
+
+  def __init__(self):
+    self.children = {}
+    self.scopes = None
+
+
+class ScheduleTrie:
+  """Classifies paths of the backup directory against the entry list.
+
+  Entry paths are stored one component per node, with the scope of the
+  entry: the number of path components below the entry path which are still
+  backed up (None if unlimited):
+    - recursive directory entry: None
+    - non-recursive directory entry: 1
+    - file entry: 0
+  An entry whose source is gone is taken as a directory, so that its backup
+  is kept. Classifying a path walks down the trie (O(path depth)) instead of
+  matching it against every entry.
+  """
+
+  def __init__(self, entrylist):
+    """Build the trie.
+
+    Args:
+      entrylist: List - List of entries. Each entry is a dictionary.
+    """
+
+    self.tree = _ScopeNode()
+    for entry in entrylist:
+      node = self.tree
+      for part in pathtrie.SplitPath(entry['path']):
+        try:
+          node = node.children[part]
+        except KeyError:
+          child = _ScopeNode()
+          node.children[part] = child
+          node = child
+      if os.path.isfile(entry['path']):
+        scope = 0
+      elif entry['recursive']:
+        scope = None
+      else:
+        scope = 1
+      if node.scopes is None:
+        node.scopes = [scope]
+      else:
+        node.scopes.append(scope)
+
+  def Classify(self, path):
+    """Classify a path of the backup directory.
+
+    Args:
+      path: String - Source path the backed up file/directory stands for.
+
+    Returns:
+      String - COVERED if an entry backs path up with everything below it,
+        SCHEDULED if an entry backs path up, DISCONTINUED if path is below an
+        entry path but out of the scope of every such entry, PARENT if path
+        leads to an entry path and NOMATCH otherwise.
+    """
+
+    parts = pathtrie.SplitPath(path)
+    depth = len(parts)
+    node = self.tree
+    level = 0
+    scheduled = False
+    discontinued = False
+    while True:
+      if node.scopes:
+        for scope in node.scopes:
+          if scope is None:
+            return COVERED
+          if depth - level <= scope:
+            scheduled = True
+          else:
+            discontinued = True
+      if level == depth:
+        break
+      try:
+        node = node.children[parts[level]]
+      except KeyError:
+        break
+      level += 1
+    if scheduled:
+      return SCHEDULED
+    if discontinued:
+      return DISCONTINUED
+    if level == depth:
+      return PARENT
+    return NOMATCH
+
+
+class _DirectoryFrame:
+  """A directory of the backup directory being swept."""
+
+  def __init__(self, path, st, kind, removaldir):
+    """Initialise the frame.
+
+    Args:
+      path: String - Path relative to the backup directory, '' for itself.
+      st: Object - lstat result of the directory, None for the backup
+        directory.
+      kind: String - Classification of the directory (see
+        ScheduleTrie.Classify).
+      removaldir: Object - _RemovalDir of the directory, see RemovalPool.
+    """
+
+    self.path = path
+    self.st = st
+    self.kind = kind
+    self.removaldir = removaldir
+    # (path, lstat result, classification) of the subdirectories still to
+    # be swept.
+    self.subdirs = []
+    # True if something below the directory is backed up.
+    self.scheduled = False
+
+
+class _RemovalDir(object):
+  """A directory of the backup directory, removed once it is empty."""
+
+  __slots__ = ('path', 'parent', 'pending', 'remove')
+
+  def __init__(self, path, parent):
+    self.path = path
+    self.parent = parent
+    # Removals below the directory not done yet, plus one while it is being
+    # swept.
+    self.pending = 1
+    # rmdir the directory once nothing is pending anymore.
+    self.remove = False
+
+
+class RemovalPool:
+  """Removes files and directories with a pool of threads, bottom up.
+
+  Paths are absolute, so that the deletor never changes the working
+  directory of the daemon. A directory is removed once the removals of
+  everything below it are done (see _RemovalDir).
+  """
+
+  def __init__(self, root, loghandle, workers=metascan.SCAN_WORKERS,
+               removedfunc=None):
+    """Start the worker threads.
+
+    Args:
+      root: String - The backup directory, paths are relative to it.
+      loghandle: Object - Handle to the logging object.
+      workers: Integer - Number of worker threads. Calls in flight to the
+        server of root are limited along with those of the scanner.
+      removedfunc: Function - Called with the path of every file/directory
+        removed, from the worker threads.
+    """
+
+    self.root = root
+    self.loghandle = loghandle
+    self.removedfunc = removedfunc
+    self.slots = metascan.ServerSlots(metascan.ServerKey(root), workers)
+    self.maxqueued = workers * REMOVAL_QUEUE_FACTOR
+    self.lock = threading.Condition()
+    self.tasks = collections.deque()
+    self.removed = 0
+    self.stopped = False
+    self.top = _RemovalDir('', None)
+    self.workers = []
+    for number in xrange(workers):
+      worker = threading.Thread(target=self.Work, name='Remove-%d' % number)
+      worker.setDaemon(True)
+      worker.start()
+      self.workers.append(worker)
+
+  def Directory(self, path, parent):
+    """Returns the _RemovalDir of a directory which is going to be swept.
+
+    Args:
+      path: String - Path relative to the backup directory.
+      parent: Object - _RemovalDir of the parent directory.
+    """
+
+    self.lock.acquire()
+    try:
+      parent.pending += 1
+    finally:
+      self.lock.release()
+    return _RemovalDir(path, parent)
+
+  def RemoveFile(self, directory, path):
+    """Queue the removal of a file.
+
+    Waits while too many removals are queued, so that memory stays bounded.
+
+    Args:
+      directory: Object - _RemovalDir of the directory holding the file.
+      path: String - Path relative to the backup directory.
+    """
+
+    self.lock.acquire()
+    try:
+      while len(self.tasks) >= self.maxqueued and not self.stopped:
+        self.lock.wait()
+      directory.pending += 1
+      self.tasks.append((path, directory))
+      self.lock.notifyAll()
+    finally:
+      self.lock.release()
+
+  def Close(self, directory, remove):
+    """Everything below a directory has been swept.
+
+    Args:
+      directory: Object - _RemovalDir of the directory.
+      remove: Boolean - Remove the directory once it is empty.
+    """
+
+    self.lock.acquire()
+    try:
+      directory.remove = remove
+      self.Release(directory)
+    finally:
+      self.lock.release()
+
+  def Release(self, directory):
+    """A removal below directory is done. Called with the lock held."""
+
+    directory.pending -= 1
+    if directory.pending:
+      return
+    if directory.remove:
+      self.tasks.append((None, directory))
+      self.lock.notifyAll()
+    elif directory.parent is not None:
+      self.Release(directory.parent)
+    else:
+      self.lock.notifyAll()
+
+  def Wait(self):
+    """Wait until every removal is done, then stop the worker threads."""
+
+    self.Close(self.top, False)
+    self.lock.acquire()
+    try:
+      while self.top.pending and not self.stopped:
+        self.lock.wait()
+    finally:
+      self.lock.release()
+    self.Stop()
+
+  def Stop(self):
+    """Make the worker threads exit, dropping the queued removals."""
+
+    self.lock.acquire()
+    try:
+      self.stopped = True
+      self.tasks.clear()
+      self.lock.notifyAll()
+    finally:
+      self.lock.release()
+
+  def Work(self):
+    """Body of the worker threads."""
+
+    while True:
+      self.lock.acquire()
+      try:
+        while not (self.stopped or self.tasks):
+          self.lock.wait()
+        if self.stopped:
+          return
+        path, directory = self.tasks.popleft()
+        self.lock.notifyAll()
+      finally:
+        self.lock.release()
+      if path is None:
+        path = directory.path
+        removed = self.RemoveDirectory(path)
+        directory = directory.parent
+      else:
+        removed = self.Remove(path)
+      if removed and self.removedfunc:
+        self.removedfunc(path)
+      self.lock.acquire()
+      try:
+        if removed:
+          self.removed += 1
+        self.Release(directory)
+      finally:
+        self.lock.release()
+
+  def Remove(self, path):
+    """Removes a file. Returns True on success."""
+
+    self.slots.acquire()
+    try:
+      try:
+        os.remove(os.path.join(self.root, path))
+        return True
+      except OSError, e:
+        self.loghandle.logger.error('%s', e)
+        self.loghandle.logger.error('EntryDeletor: Failed to remove file: %s',
+                                    path)
+        return False
+    finally:
+      self.slots.release()
+
+  def RemoveDirectory(self, path):
+    """Removes an empty directory. Returns True on success."""
+
+    self.slots.acquire()
+    try:
+      try:
+        os.rmdir(os.path.join(self.root, path))
+        return True
+      except OSError, e:
+        # Ignore if directory is not empty
+        if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+          self.loghandle.logger.error('%s', e)
+          self.loghandle.logger.error('EntryDeletor: Failed to remove dir:'
+                                      ' %s', path)
+        return False
+    finally:
+      self.slots.release()
+
 
 class EntryDeletor(threading.Thread):
   """This class provides methods to remove files/directories from backup dir."""
 
   def __init__(self, backup_dir, entry_list, retention_time, loghandle,
-               show_files=False):
+               show_files=False, scanworkers=metascan.SCAN_WORKERS,
+               index=None, reconcileinterval=destindex.RECONCILE_INTERVAL):
     """Initialses deletor thread.
 
     Args:
@@ -52,6 +414,11 @@ class EntryDeletor(threading.Thread):
       loghandle: Object - Handle to the logging object.
       show_files: Boolean - Used to tell the module whether or not to log
         removed file/directory info.
+      scanworkers: Integer - Threads reading the backup directory.
+      index: Object - destindex.DestinationIndex of the backup directory,
+        None to always walk it.
+      reconcileinterval: Integer - Seconds between two walks of the backup
+        directory when there is an index.
     """
 
     threading.Thread.__init__(self, name='EntryDeletor')
@@ -60,7 +427,22 @@ class EntryDeletor(threading.Thread):
     self.retention_time = retention_time
     self.loghandle = loghandle
     self.show_files = show_files
+    self.scanworkers = scanworkers
+    self.index = index
+    self.reconcileinterval = reconcileinterval
+    # Path => destindex record of the unscheduled paths found by a walk,
+    # None when not reconciling the index.
+    self.unowned = None
+    # False once a walk failed to read part of the backup directory.
+    self.complete = True
+    self.trie = None
     self.fd = None
+    self.report = []
+    self.reportsize = 0
+    # Number of files/directories not part of the backup schedule, and of
+    # those removed.
+    self.removable = 0
+    self.removed = 0
 
   def run(self):
     """Starts the deletor thread.
@@ -70,22 +452,37 @@ class EntryDeletor(threading.Thread):
     retention_time (as specified in config file)
     """
 
-    if self.CreateDeleteList():
-      self.ComputeDeleteTime()
+    if self.index is None:
+      found = self.SweepBackupDir()
+    elif time.time() - self.index.reconciled >= self.reconcileinterval:
+      self.loghandle.logger.info('Reconciling the index of the backup'
+                                 ' directory.')
+      found = self.ReconcileIndex()
+    else:
+      found = self.SweepIndex()
+    if found:
+      if self.removed:
+        self.loghandle.logger.info('Removed %d old files/directories no'
+                                   ' longer backed up.', self.removed)
+      else:
+        self.loghandle.logger.info('Found no old files which could be'
+                                   ' removed.')
     else:
       self.loghandle.logger.info('No unscheduled files found in backup drive.')
       self.loghandle.deletor_disable = True
       self.loghandle.internal_disable = True
-    os.chdir('/tmp')
 
   def PrintToFile(self, opr, msg=''):
     """Print message passed to a file (if -s command line option is passed).
 
+    Messages are buffered, and written REPORT_BUFFER bytes at a time.
+
     Args:
       opr: String - Kind of operation to be done on a file
         'o' - Open file for writing
         'w' - Write to file
         'c' - Close file
+        'd' - Close and remove file (nothing to report)
       msg: String - The message to be printed to file.
 
     Returns:
@@ -104,309 +501,336 @@ class EntryDeletor(threading.Thread):
             self.loghandle.logger.warning('Opening failed; %s', e)
             self.show_files = False
             return
-          os.write(self.fd, '\nBEGIN =>' + time.ctime() + '\n')
+          self.PrintToFile('w', '\nBEGIN =>' + time.ctime() + '\n')
       if opr == 'w':
         if self.fd:
-          try:
-            os.write(self.fd, msg)
-          except OSError, e:
-            self.loghandle.logger.warning('Writing Failed; %s', e)
-            return
-      if opr == 'c':
+          self.report.append(msg)
+          self.reportsize += len(msg)
+          if self.reportsize >= REPORT_BUFFER:
+            return self.FlushReport()
+      if opr in ('c', 'd'):
         if self.fd:
-          try:
-            os.write(self.fd, '\nEND =>' + time.ctime() + '\n')
-          except OSError, e:
-            self.loghandle.logger.warning('Closing Failed; %s', e)
-            return
-
-  def CreateDeleteList(self):
-    """Function finds each file/directory not part of backup schedules.
+          if opr == 'c':
+            self.PrintToFile('w', '\nEND =>' + time.ctime() + '\n')
+            self.FlushReport()
+          os.close(self.fd)
+          self.fd = None
+          if opr == 'd':
+            try:
+              os.remove(self.fdname)
+            except OSError:
+              pass
 
-    Finds files/directories which are no more part of the backup schedules (not
-    listed in entry section of the config file).
+  def FlushReport(self):
+    """Write the buffered report messages.
 
     Returns:
-      ret_val: Boolean - True if there are files to be removed, else False.
+      False - On error
     """
 
-    tmpschedlist = []
-    tmpnoschedlist = []
-    filelist = []
+    data = ''.join(self.report)
+    self.report = []
+    self.reportsize = 0
     try:
-      os.chdir(self.backup_dir)
+      while data:
+        written = os.write(self.fd, data)
+        data = data[written:]
     except OSError, e:
-      self.loghandle.logger.info('%s', e)
-      self.PrintToFile('c')
+      self.loghandle.logger.warning('Writing Failed; %s', e)
       return False
-    # Find all file/directories in the backup directories, append them to a
-    # list
-    try:
-      contentlist = os.walk(self.backup_dir)
-    except StopIteration:
-      self.loghandle.logger.info('Nothing to list here.')
+
+  def SweepBackupDir(self):
+    """Remove old files/directories which are not part of backup schedules.
+
+    Finds files/directories which are no more part of the backup schedules
+    (not listed in entry section of the config file), or have been
+    discontinued, and removes those older than retention_time. Directories
+    are walked depth first, so that a directory is only removed once its
+    contents have been (only empty directories get removed). Paths are
+    relative to the backup partition. Also prints info to a logfile (if -s
+    command line option is specified)
+
+    Returns:
+      ret_val: Boolean - True if there are files to be removed, else False.
+    """
+
+    if not os.path.isdir(self.backup_dir):
+      self.loghandle.logger.info('%s: No such directory', self.backup_dir)
+      return False
+    self.PrintToFile('o')
+    self.trie = ScheduleTrie(self.entry_list)
+    self.localtime = time.mktime(time.localtime())
+    self.scanner = metascan.MetadataScanner(self.backup_dir, self.loghandle,
+                                            self.scanworkers, self.Descends)
+    self.remover = RemovalPool(self.backup_dir, self.loghandle,
+                               self.scanworkers, self.Removed)
     try:
-      toplevel = contentlist.next()
-    except StopIteration:
-      self.loghandle.logger.info('Nothing to list here.')
-    while 1:
-      for directory in toplevel[1]:
-        filelist.append(re.split(self.backup_dir,
-                                 (os.path.join(toplevel[0], directory)))[1])
-      for files in toplevel[2]:
-        filelist.append(re.split(self.backup_dir,
-                                 (os.path.join(toplevel[0], files)))[1])
-      try:
-        toplevel = contentlist.next()
-      except StopIteration:
-        break
+      stack = [self.OpenDirectory('', None, PARENT, self.remover.top)]
+      self.PrefetchAhead(stack)
+      while stack:
+        frame = stack[-1]
+        if frame.subdirs:
+          path, st, kind = frame.subdirs.pop()
+          stack.append(self.OpenDirectory(path, st, kind, frame.removaldir))
+          self.PrefetchAhead(stack)
+          continue
+        stack.pop()
+        if frame.scheduled and stack:
+          stack[-1].scheduled = True
+        if frame.st is not None:
+          self.CloseDirectory(frame)
+      self.remover.Wait()
+    finally:
+      self.scanner.Stop()
+      self.remover.Stop()
+    self.removed = self.remover.removed
+    if self.removable:
+      self.PrintToFile('c')
+      return True
+    self.PrintToFile('d')
+    return False
 
-    # Find all files/directories which are not part of the backup schedule
-    for file_item in filelist:
-      if file_item:
-        for item in self.entry_list:
-          if (re.match(item['path'], file_item)
-              or re.match(file_item, item['path'])):
-            try:
-              tmpschedlist.index(file_item)
-            except ValueError:
-              tmpschedlist.append(file_item)
-            try:
-              tmpnoschedlist.remove(file_item)
-            except ValueError:
-              pass
-          else:
-            try:
-              tmpschedlist.index(file_item)
-            except ValueError:
-              try:
-                tmpnoschedlist.index(file_item)
-              except ValueError:
-                tmpnoschedlist.append(file_item)
-
-    # Find all files/directories which has been discontinued from a previous
-    # backup schedule.
-    schedlist = []
-    discon_schedlist = []
-    for file_item in tmpschedlist:
-      if file_item:
-        for item in self.entry_list:
-          update = True
-          if re.match(item['path'], file_item):
-            basepath = item['path']
-            if os.path.isdir(basepath):
-              if not re.compile(basepath + '/').match(file_item):
-                if not basepath == file_item:
-                  update = False
-            elif os.path.isfile(basepath):
-              if not basepath == file_item:
-                update = False
-            if update:
-              if not item['recursive']:
-              #find files with trailing paths
-                trailpath = ''
-                try:
-                  trailpath = re.split('/', re.split(item['path'],
-                                                     file_item)[1], 2)[2]
-                except IndexError:
-                  try:
-                    schedlist.index(file_item)
-                  except ValueError:
-                    schedlist.append(file_item)
-                  try:
-                    discon_schedlist.remove(file_item)
-                  except ValueError:
-                    pass
-                if trailpath:
-                  try:
-                    schedlist.index(file_item)
-                  except ValueError:
-                    try:
-                      discon_schedlist.index(file_item)
-                    except ValueError:
-                      discon_schedlist.append(file_item)
-                else:
-                  try:
-                    schedlist.index(file_item)
-                  except ValueError:
-                    schedlist.append(file_item)
-                  try:
-                    discon_schedlist.remove(file_item)
-                  except ValueError:
-                    pass
-              else:
-                try:
-                  schedlist.index(file_item)
-                except ValueError:
-                  schedlist.append(file_item)
-                try:
-                  discon_schedlist.remove(file_item)
-                except ValueError:
-                  pass
-            else:
-              try:
-                schedlist.index(file_item)
-              except ValueError:
-                try:
-                  discon_schedlist.index(file_item)
-                except ValueError:
-                  discon_schedlist.append(file_item)
-
-    scheduled_noremovelist = []
-    notscheduled_removelist = []
-    notbackupedup_removelist = []
-
-    tmpdiscon_schedlist = []
-    tmpdiscon_schedlist.extend(discon_schedlist)
-
-    for disc_item in tmpdiscon_schedlist:
-      for sched_item in schedlist:
-        if re.compile(disc_item + '/').match(sched_item):
-          try:
-            discon_schedlist.remove(disc_item)
-          except ValueError:
-            pass
-
-    for item in schedlist:
-      scheduled_noremovelist.append(item.split('/', 1)[1])
-    for item in discon_schedlist:
-      notscheduled_removelist.append(item.split('/', 1)[1])
-    for item in tmpnoschedlist:
-      notbackupedup_removelist.append(item.split('/', 1)[1])
-
-    # Prepare the list of removable files/directories.
-    self.removablelist = []
-    self.removablelist.extend(notscheduled_removelist)
-    self.removablelist.extend(notbackupedup_removelist)
-
-    # Print some info about removable files (if -s option in command line is
-    # specified)
-    if self.removablelist:
-      if self.show_files:
-        self.PrintToFile('o')
-        for item in scheduled_noremovelist:
-          msg = '\nSCHEDULED        (NO REMOVE) %s' % item
-          self.PrintToFile('w', msg=msg)
-        for item in notscheduled_removelist:
-          msg = '\nDISCONTINUED BACKUP (REMOVE) %s' %  item
-          self.PrintToFile('w', msg=msg)
-        for item in notbackupedup_removelist:
-          msg = '\nNOMATCH             (REMOVE) %s' % item
-          self.PrintToFile('w', msg=msg)
-      ret_value = True
+  def OpenDirectory(self, path, st, kind, parent):
+    """List a directory, handle its files and queue its subdirectories.
+
+    Args:
+      path: String - Path relative to the backup directory, '' for itself.
+      st: Object - lstat result of the directory.
+      kind: String - Classification of the directory.
+      parent: Object - _RemovalDir of the parent directory, that of the
+        backup directory for itself.
+
+    Returns:
+      frame: Object - _DirectoryFrame of the directory.
+    """
+
+    if st is None:
+      removaldir = parent
     else:
-      ret_value = False
+      removaldir = self.remover.Directory(path, parent)
+    frame = _DirectoryFrame(path, st, kind, removaldir)
+    listing = self.scanner.List(path)
+    if listing.error:
+      self.loghandle.logger.warning('%s', listing.error)
+      self.complete = False
+      return frame
+    oldfiles = []
+    for name, item_st, error in listing.Entries():
+      if path:
+        item = path + '/' + name
+      else:
+        item = name
+      if error:
+        self.loghandle.logger.warning('%s', error)
+        self.complete = False
+        continue
+      if kind == NOMATCH:
+        # Nothing below a path unrelated to the entries is backed up.
+        item_kind = NOMATCH
+      else:
+        item_kind = self.trie.Classify('/' + item)
+      if stat.S_ISDIR(item_st.st_mode):
+        if item_kind == COVERED:
+          self.Report(item, item_st, item_kind)
+          frame.scheduled = True
+        else:
+          frame.subdirs.append((item, item_st, item_kind))
+      elif item_kind in (COVERED, SCHEDULED):
+        self.Report(item, item_st, item_kind)
+        frame.scheduled = True
+      elif item_kind != PARENT:
+        self.Unowned(item, item_st)
+        if self.Report(item, item_st, item_kind):
+          oldfiles.append((item, item_st))
+    # Subdirectories are popped from the end of the list.
+    frame.subdirs.reverse()
+    for item, item_st in oldfiles:
+      # Only files and symbolic links are removed.
+      if stat.S_ISREG(item_st.st_mode) or stat.S_ISLNK(item_st.st_mode):
+        self.remover.RemoveFile(frame.removaldir, item)
+    return frame
+
+  def Descends(self, path, st):
+    """Tells the scanner whether a directory is going to be swept."""
+
+    return self.trie.Classify('/' + path) != COVERED
+
+  def PrefetchAhead(self, stack):
+    """Have the directories to be swept next read ahead.
+
+    Args:
+      stack: List - _DirectoryFrame of the directories being swept.
+    """
 
-    return ret_value
+    for index in xrange(len(stack) - 1, -1, -1):
+      subdirs = stack[index].subdirs
+      for position in xrange(len(subdirs) - 1, -1, -1):
+        if not self.scanner.Prefetch(subdirs[position][0]):
+          return
 
-  def ComputeDeleteTime(self):
-    """Computes and verifies age of a file/directory.
+  def CloseDirectory(self, frame):
+    """Handle a directory once everything below it has been."""
 
-    This function checks ctime of each file in list removablelist and if the
-    ctime is greater than the retention_time (specified in config file), then
-    the file is marked for deletion. Also prints info to a logfile (if -s
-    command line option is specified)
+    remove = False
+    if frame.kind == SCHEDULED:
+      self.Report(frame.path, frame.st, frame.kind)
+    elif frame.kind != PARENT and not frame.scheduled:
+      # A discontinued directory still holding scheduled files is kept.
+      self.Unowned(frame.path, frame.st)
+      remove = self.Report(frame.path, frame.st, frame.kind)
+    self.remover.Close(frame.removaldir, remove)
+
+  def Unowned(self, item, st):
+    """Record an unscheduled path found while reconciling the index."""
+
+    if self.unowned is not None:
+      self.unowned['/' + item] = destindex.StatRecord(st)
+
+  def Removed(self, item):
+    """A path has been removed, called from the RemovalPool threads."""
+
+    if self.index is not None:
+      if self.unowned is not None:
+        self.unowned.pop('/' + item, None)
+      self.index.Discard('/' + item)
+
+  def ReconcileIndex(self):
+    """Sweep the backup directory, then reconcile the index with it.
+
+    Returns:
+      Boolean - See SweepBackupDir.
     """
 
-    msg = ('\n')
-    self.PrintToFile('w', msg=msg)
-    self.deletable_olditems = []
-    localtime = time.mktime(time.localtime())
+    started = time.time()
+    self.unowned = {}
+    found = self.SweepBackupDir()
+    # Paths which could not be read are left listed until the next walk.
+    if self.trie is not None and self.complete:
+      self.index.Reconcile(self.unowned, self.trie.Classify, BACKED_UP,
+                           started)
+    self.unowned = None
+    return found
 
-    # Compare each file and check if ctime is > retention_time.
-    for item in self.removablelist:
-      #lstat does not follow symlinks
-      try:
-        file_ctime = os.lstat(item)[stat.ST_CTIME]
-        file_mtime = os.lstat(item)[stat.ST_MTIME]
-      except OSError, e:
-        self.loghandle.logger.warning('%s', e)
-        continue
-      if (localtime - file_ctime) > self.retention_time:
-        msg = ('OLDER CTIME: %s (MTIME: %s) %s\n'
-               % (time.ctime(file_ctime), time.ctime(file_mtime), item))
-        self.PrintToFile('w', msg=msg)
-        self.deletable_olditems.append(item)
-      else:
-        msg = ('NEWER CTIME: %s (MTIME: %s) %s\n'
-               % (time.ctime(file_ctime), time.ctime(file_mtime), item))
-        self.PrintToFile('w', msg=msg)
-    if self.deletable_olditems:
-      self.loghandle.logger.info('Found some old files which could be removed.')
-      self.DeleteOldFiles()
-    else:
-      self.loghandle.logger.info('Found no old files which could be removed.')
-      self.PrintToFile('c')
+  def SweepIndex(self):
+    """Remove old files/directories listed in the index of the destination.
 
-  def DeleteOldFiles(self):
-    """Deletes old files.
-
-    As the name suggests, this function deletes old files which are also no
-    more being backedup (by being not part of the backup schedule). Any
-    file/directory present in the list deletable_olditems is to be removed. For
-    this the list is sorted so that the list starts with files and then
-    traverses the deletable directories from the innermost level to upwards.
-    This is required since we use os.remove for removing a file and os.rmdir for
-    removing directory. By having the list sorted, we ensure that only empty
-    directories get removed. Does a chdir to the backup partition before
-    removing files/directories. Also prints info to a logfile (if -s
-    command line option is specified)
+    Same as SweepBackupDir, without walking the backup directory: the
+    paths listed in the index are classified, and those not backed up and
+    last written more than retention_time ago are lstat'ed, to check their
+    ctime, then removed. Paths found gone are dropped from the index.
 
     Returns:
-      False - if fails to do a chdir.
+      ret_val: Boolean - True if there are files to be removed, else False.
     """
 
-    file_list = []
-    dir_list = []
-    sorted_olditems = []
-    for item in self.deletable_olditems:
-      item_mode = os.lstat(item)[stat.ST_MODE]
-      if (stat.S_ISREG(item_mode) or
-          stat.S_ISLNK(item_mode) or
-          stat.S_ISBLK(item_mode) or
-          stat.S_ISCHR(item_mode)):
-        try:
-          file_list.append(item)
-        except ValueError:
-          pass
-      elif stat.S_ISDIR(item_mode):
+    if not os.path.isdir(self.backup_dir):
+      self.loghandle.logger.info('%s: No such directory', self.backup_dir)
+      return False
+    self.PrintToFile('o')
+    self.trie = ScheduleTrie(self.entry_list)
+    self.localtime = time.mktime(time.localtime())
+    items = self.index.Items()
+    # Directories holding backed up paths are kept.
+    keepdirs = set()
+    candidates = []
+    for path, record in items:
+      kind = self.trie.Classify(path)
+      if kind in BACKED_UP:
+        parent = os.path.dirname(path)
+        while parent not in keepdirs and parent != '/':
+          keepdirs.add(parent)
+          parent = os.path.dirname(parent)
+      else:
+        candidates.append((path, record, kind))
+    del items
+    oldfiles = []
+    olddirs = []
+    for path, record, kind in candidates:
+      if path in keepdirs:
+        continue
+      item = path[1:]
+      st = destindex.RecordStat(record)
+      if (self.localtime - st.st_ctime) > self.retention_time:
+        # The index only tells when the path was last backed up.
         try:
-          dir_list.append(item)
-        except ValueError:
-          pass
-    # Sort list
-    sorted_olditems.extend(file_list)
-    dir_list.reverse()
-    sorted_olditems.extend(dir_list)
-    del file_list
-    del dir_list
-    del self.deletable_olditems
-    for item in sorted_olditems:
-      msg = ('\nSORTED OLD          (REMOVE) ' + item)
-      self.PrintToFile('w', msg=msg)
+          st = os.lstat(os.path.join(self.backup_dir, item))
+        except OSError:
+          self.index.Discard(path)
+          continue
+      if not self.Report(item, st, kind):
+        continue
+      if stat.S_ISDIR(st.st_mode):
+        olddirs.append(item)
+      elif stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode):
+        oldfiles.append(item)
+    del candidates
+    self.remover = RemovalPool(self.backup_dir, self.loghandle,
+                               self.scanworkers, self.Removed)
     try:
-      os.chdir(self.backup_dir)
-    except OSError, e:
-      self.loghandle.logger.info('%s', e)
+      # Parents first, so that a directory is removed after its contents.
+      olddirs.sort()
+      removaldirs = {}
+      for item in olddirs:
+        removaldirs[item] = self.remover.Directory(
+            item, self.RemovalParent(removaldirs, item))
+      for item in oldfiles:
+        self.remover.RemoveFile(self.RemovalParent(removaldirs, item), item)
+      for removaldir in removaldirs.itervalues():
+        self.remover.Close(removaldir, True)
+      self.remover.Wait()
+    finally:
+      self.remover.Stop()
+    self.removed = self.remover.removed
+    if self.removable:
       self.PrintToFile('c')
+      return True
+    self.PrintToFile('d')
+    return False
+
+  def RemovalParent(self, removaldirs, item):
+    """Returns the _RemovalDir of the closest directory above item removed."""
+
+    parent = os.path.dirname(item)
+    while parent:
+      try:
+        return removaldirs[parent]
+      except KeyError:
+        parent = os.path.dirname(parent)
+    return self.remover.top
+
+  def Report(self, item, st, kind):
+    """Report a classified file/directory and check its age.
+
+    Checks ctime of a file/directory not part of the backup schedule, and if
+    the ctime is greater than the retention_time (specified in config file),
+    the file is to be removed. Also prints info to a logfile (if -s command
+    line option is specified)
+
+    Args:
+      item: String - Path relative to the backup directory.
+      st: Object - lstat result of item.
+      kind: String - Classification of item.
+
+    Returns:
+      Boolean - True if item is to be removed.
+    """
+
+    if kind in (COVERED, SCHEDULED):
+      if self.show_files:
+        self.PrintToFile('w', 'SCHEDULED           (NO REMOVE) %s\n' % item)
       return False
-    # Start deletion process
-    for item in sorted_olditems:
-      if os.path.isfile(item) or os.path.islink(item):
-        try:
-          os.remove(item)
-        except OSError, e:
-          self.loghandle.logger.error('%s', e)
-          self.loghandle.logger.error('%s: Failed to remove file: %s',
-                                      self.getName(), item)
-      elif os.path.isdir(item):
-        try:
-          os.rmdir(item)
-        except OSError, e:
-          # Ignore if directory is not empty
-          if not e.errno == 39:
-            self.loghandle.logger.error('%s', e)
-            self.loghandle.logger.error('%s: Failed to remove dir: %s',
-                                        self.getName(), item)
-    os.chdir('/tmp')
-    self.PrintToFile('c')
+    self.removable += 1
+    old = (self.localtime - st.st_ctime) > self.retention_time
+    if self.show_files:
+      if kind == DISCONTINUED:
+        msg = 'DISCONTINUED BACKUP    (REMOVE) %s\n' % item
+      else:
+        msg = 'NOMATCH                (REMOVE) %s\n' % item
+      if old:
+        msg += '  OLDER CTIME: %s (MTIME: %s)\n' % (time.ctime(st.st_ctime),
+                                                  time.ctime(st.st_mtime))
+      else:
+        msg += '  NEWER CTIME: %s (MTIME: %s)\n' % (time.ctime(st.st_ctime),
+                                                  time.ctime(st.st_mtime))
+      self.PrintToFile('w', msg)
+    return old
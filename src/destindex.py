@@ -0,0 +1,394 @@
+#!/usr/bin/python2.4
+
+# Copyright 2008 Google Inc.
+# Author : Anoop Chandran <anoopj@google.com>
+#
+# openduckbill is a simple backup application. It offers support for
+# transferring data to a local backup directory, NFS. It also provides
+# file system monitoring of directories marked for backup. Please read
+# the README file for more details.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""On-disk index of what the backup directory holds.
+
+destindex keeps, for every path at the backup destination, the entry which
+backed it up, when it was last written there, its size, mtime and mode. It
+is kept up to date from the results of the backups (see
+catalog.EntryCatalog.Replace and Apply) instead of by reading the backup
+directory, so that:
+  - the entry deletor finds the files no longer backed up without walking
+    the backup directory (see deletor.EntryDeletor)
+  - the capacity monitor tells how much space they take
+  - openduckbill-restore knows which directories of its own index have not
+    changed since it last read them (see restore.TreeIndex)
+Paths no entry backs up anymore are kept under the owner UNOWNED. The index
+is a superset of the destination: files removed by rsync --delete while
+syncing a subtree are dropped, others stay listed until the deletor finds
+them gone. The deletor walks the whole backup directory every
+"reconcileinterval" seconds to replace the unowned part of the index with
+what it actually finds.
+
+Backups which failed, or whose changes were not recorded, may have changed
+anything below their sources: those are remembered as changed trees.
+
+The index is written along with the catalogs, so changes of the last
+daemon.CATALOG_SAVE_DELAY seconds before a crash are lost. Remove
+~/.openduckbill/destindex to have it rebuilt.
+"""
+
+import marshal
+import os
+import threading
+import time
+
+INDEX_VERSION = 1
+INDEX_FILE = '~/.openduckbill/destindex'
+# Owner of the paths found at the destination which no entry backs up.
+UNOWNED = ''
+# Default seconds between two walks of the whole backup directory.
+RECONCILE_INTERVAL = 7 * 86400
+
+# Record fields
+_TIME = 0    # Last written at the destination
+_SIZE = 1
+_MTIME = 2
+_MODE = 3
+
+
+def MetaRecord(meta, when):
+  """Returns the record of a catalog metadata tuple backed up at time when."""
+
+  return (int(when), meta[1], meta[2], meta[3])
+
+
+def StatRecord(st):
+  """Returns the record of an lstat result of a path at the destination."""
+
+  return (int(st.st_ctime), st.st_size, int(st.st_mtime), st.st_mode)
+
+
+def RecordStat(record):
+  """Returns an os.stat_result with the mode, size and times of a record."""
+
+  return os.stat_result((record[_MODE], 0, 0, 0, 0, 0, record[_SIZE],
+                         record[_MTIME], record[_MTIME], record[_TIME]))
+
+
+def RecordSize(record):
+  """Returns the size of a record."""
+
+  return record[_SIZE]
+
+
+class DestinationIndex:
+  """Index of one backup directory, see module docstring.
+
+  Updated from the event loop and from the entry deletor thread, so every
+  method takes the lock.
+  """
+
+  def __init__(self, backupdir, indexfile=INDEX_FILE):
+    """Initialise an empty index.
+
+    Args:
+      backupdir: String - The backup directory.
+      indexfile: String - Path of the index file.
+    """
+
+    self.backupdir = os.path.normpath(backupdir)
+    self.filename = os.path.expanduser(indexfile)
+    self.lock = threading.Lock()
+    # Owner (entry name or UNOWNED) => {path => record}
+    self.owners = {}
+    # Directory path => last time a path directly below it changed.
+    self.dirtimes = {}
+    # Path => last time anything at or below it may have changed.
+    self.treetimes = {}
+    # Time the index was started, and last reconciled with the destination.
+    self.created = time.time()
+    self.reconciled = 0
+    self.dirty = False
+
+  def __len__(self):
+    count = 0
+    for records in self.owners.itervalues():
+      count += len(records)
+    return count
+
+  def Load(self):
+    """Read the index file.
+
+    Returns:
+      Boolean - True if the index file belongs to the backup directory.
+    """
+
+    try:
+      indexfile = file(self.filename, 'rb')
+      try:
+        header = marshal.load(indexfile)
+        if (header.get('version') != INDEX_VERSION or
+            header.get('dest') != self.backupdir):
+          return False
+        owners = marshal.load(indexfile)
+        dirtimes = marshal.load(indexfile)
+        treetimes = marshal.load(indexfile)
+      finally:
+        indexfile.close()
+    except (IOError, EOFError, ValueError, TypeError, AttributeError):
+      return False
+    self.lock.acquire()
+    try:
+      self.owners = owners
+      self.dirtimes = dirtimes
+      self.treetimes = treetimes
+      self.created = header['created']
+      self.reconciled = header['reconciled']
+      self.dirty = False
+    finally:
+      self.lock.release()
+    return True
+
+  def Dump(self):
+    """Returns the index file contents."""
+
+    self.lock.acquire()
+    try:
+      header = {'version': INDEX_VERSION, 'dest': self.backupdir,
+                'created': self.created, 'reconciled': self.reconciled,
+                'saved': time.time()}
+      return (marshal.dumps(header) + marshal.dumps(self.owners) +
+              marshal.dumps(self.dirtimes) + marshal.dumps(self.treetimes))
+    finally:
+      self.lock.release()
+
+  def Write(self, data):
+    """Atomically replace the index file with data (see Dump).
+
+    Returns:
+      Boolean - True on success.
+    """
+
+    indexdir = os.path.dirname(self.filename)
+    tmpname = self.filename + '.tmp'
+    try:
+      if not os.path.isdir(indexdir):
+        os.makedirs(indexdir, 0700)
+      fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+      try:
+        while data:
+          written = os.write(fd, data)
+          data = data[written:]
+        os.fsync(fd)
+      finally:
+        os.close(fd)
+      os.rename(tmpname, self.filename)
+    except (IOError, OSError):
+      return False
+    return True
+
+  def Save(self):
+    """Write the index if it changed. Returns False on error."""
+
+    if not self.dirty:
+      return True
+    self.dirty = False
+    if not self.Write(self.Dump()):
+      self.dirty = True
+      return False
+    return True
+
+  def Owns(self, name):
+    """Checks whether paths of entry name are listed."""
+
+    self.lock.acquire()
+    try:
+      return name in self.owners
+    finally:
+      self.lock.release()
+
+  def Touch(self, path, when):
+    """A path changed at time when. Called with the lock held."""
+
+    self.dirtimes[os.path.dirname(path)] = when
+
+  def ReplaceEntry(self, name, files, when):
+    """An entry has been synced as a whole.
+
+    Paths the entry does not back up anymore are kept as unowned, they
+    might still be at the destination.
+
+    Args:
+      name: String - Entry name.
+      files: Dictionary - pathname => catalog metadata, see
+        catalog.EntryCatalog.Scan.
+      when: Float - Time of the backup.
+    """
+
+    self.lock.acquire()
+    try:
+      old = self.owners.get(name, {})
+      unowned = self.owners.setdefault(UNOWNED, {})
+      records = {}
+      for pathname, meta in files.iteritems():
+        record = MetaRecord(meta, when)
+        previous = old.pop(pathname, None)
+        if previous is None:
+          previous = unowned.pop(pathname, None)
+        if previous is None or previous[_SIZE:] != record[_SIZE:]:
+          self.Touch(pathname, when)
+        else:
+          record = previous
+        records[pathname] = record
+      for pathname in old:
+        # Possibly removed by the sync.
+        self.Touch(pathname, when)
+      unowned.update(old)
+      self.owners[name] = records
+      self.dirty = True
+    finally:
+      self.lock.release()
+
+  def ApplyEntry(self, name, removed, updates, when):
+    """Record a successful backup of part of an entry.
+
+    Called by catalog.EntryCatalog.Apply, which works out the paths gone
+    from the catalog, so that the cost is that of the backup.
+
+    Args:
+      name: String - Entry name.
+      removed: List - Paths removed at the destination.
+      updates: Dictionary - pathname => catalog metadata or None (deleted).
+      when: Float - Time of the backup.
+    """
+
+    self.lock.acquire()
+    try:
+      records = self.owners.setdefault(name, {})
+      for pathname in removed:
+        records.pop(pathname, None)
+        self.Touch(pathname, when)
+      for pathname, meta in updates.iteritems():
+        if meta is not None:
+          records[pathname] = MetaRecord(meta, when)
+          self.Touch(pathname, when)
+      self.dirty = True
+    finally:
+      self.lock.release()
+
+  def Unsure(self, paths, when):
+    """Backups of paths failed, or their changes were not recorded.
+
+    Args:
+      paths: List - Source paths of the backups.
+      when: Float - Time of the backups.
+    """
+
+    self.lock.acquire()
+    try:
+      for path in paths:
+        self.treetimes[path] = when
+        self.Touch(path, when)
+      self.dirty = True
+    finally:
+      self.lock.release()
+
+  def Discard(self, path):
+    """A path has been removed from the destination."""
+
+    self.lock.acquire()
+    try:
+      for records in self.owners.itervalues():
+        if records.pop(path, None) is not None:
+          self.Touch(path, time.time())
+          self.dirty = True
+    finally:
+      self.lock.release()
+
+  def Items(self):
+    """Returns a list of (path, record) tuples of every listed path."""
+
+    self.lock.acquire()
+    try:
+      items = []
+      for records in self.owners.itervalues():
+        items.extend(records.iteritems())
+      return items
+    finally:
+      self.lock.release()
+
+  def UnscheduledBytes(self, classify, scheduled):
+    """Returns the bytes of the listed paths not backed up anymore.
+
+    Args:
+      classify: Function - Returns the classification of a path, see
+        deletor.ScheduleTrie.Classify.
+      scheduled: Tuple - Classifications of the paths backed up.
+    """
+
+    total = 0
+    for path, record in self.Items():
+      if classify(path) not in scheduled:
+        total += record[_SIZE]
+    return total
+
+  def Unchanged(self, dirpath, since):
+    """Checks that nothing directly below dirpath changed after since.
+
+    Only meaningful if the index was started before since (see created).
+    """
+
+    self.lock.acquire()
+    try:
+      if self.dirtimes.get(dirpath, 0) >= since:
+        return False
+      path = dirpath
+      while True:
+        if self.treetimes.get(path, 0) >= since:
+          return False
+        parent = os.path.dirname(path)
+        if parent == path:
+          return True
+        path = parent
+    finally:
+      self.lock.release()
+
+  def Reconcile(self, unowned, classify, scheduled, when):
+    """Replace the unowned paths with those found walking the destination.
+
+    Args:
+      unowned: Dictionary - path => record (see StatRecord) of every path
+        found which is not backed up.
+      classify: Function - See UnscheduledBytes.
+      scheduled: Tuple - See UnscheduledBytes.
+      when: Float - Time the walk started.
+    """
+
+    self.lock.acquire()
+    try:
+      for name, records in self.owners.items():
+        if name == UNOWNED:
+          continue
+        for pathname in records.keys():
+          if classify(pathname) not in scheduled:
+            del records[pathname]
+        if not records:
+          del self.owners[name]
+      self.owners[UNOWNED] = unowned
+      self.reconciled = when
+      self.dirty = True
+    finally:
+      self.lock.release()
@@ -0,0 +1,429 @@
+#!/usr/bin/python2.4
+
+# Copyright 2008 Google Inc.
+# Author : Anoop Chandran <anoopj@google.com>
+#
+# openduckbill is a simple backup application. It offers support for
+# transferring data to a local backup directory, NFS. It also provides
+# file system monitoring of directories marked for backup. Please read
+# the README file for more details.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Single threaded event loop of the daemon.
+
+eventloop multiplexes everything the daemon waits for on one poll(2) call:
+  - readable file descriptors (the inotify descriptor)
+  - timers
+  - signals (delivered through a pipe, so that handlers never run in the
+    middle of other code)
+  - output and exit of child processes (rsync)
+Short blocking calls (planning a backup, writing catalogs) are handed to a
+small pool of worker threads, which report back to the loop. Long ones
+(walking directory trees, the entry deletor, initial syncs) get a thread of
+their own, so that they never hold back the backups.
+Every callback runs in the thread calling Run, so callbacks need no locking.
+"""
+
+import errno
+import fcntl
+import heapq
+import os
+import Queue
+import select
+import signal
+import subprocess
+import threading
+import time
+
+# Seconds between checks for the exit of a child which closed its output.
+CHILD_POLL_INTERVAL = 0.05
+# Bytes read from a descriptor at a time.
+READ_SIZE = 65536
+
+
+def SetNonBlocking(fd):
+  """Sets O_NONBLOCK on a file descriptor."""
+
+  flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+  fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class Timer:
+  """A callback scheduled on the loop. Returned by EventLoop.CallAt."""
+
+  def __init__(self, when, func, args):
+    self.when = when
+    self.func = func
+    self.args = args
+    self.cancelled = False
+
+  def Cancel(self):
+    """Do not run the callback."""
+
+    self.cancelled = True
+
+
+class ChildProcess:
+  """A child process run by the loop, see EventLoop.SpawnProcess."""
+
+  def __init__(self, loop, runcmd, callback):
+    """Start the child, with stdout and stderr read by the loop.
+
+    Args:
+      loop: Object - EventLoop.
+      runcmd: List - path to executable and its arguments.
+      callback: Function - Called with (exit value, output lines) once the
+        child has exited.
+
+    Raises:
+      OSError: The command could not be started.
+    """
+
+    self.loop = loop
+    self.runcmd = runcmd
+    self.callback = callback
+    self.lines = []
+    self.partial = ''
+    self.returncode = None
+    self.proc = subprocess.Popen(runcmd, bufsize=0, stdin=None,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, close_fds=True)
+    self.pid = self.proc.pid
+    self.fd = self.proc.stdout.fileno()
+    SetNonBlocking(self.fd)
+    loop.AddReader(self.fd, self.OnReadable)
+
+  def OnReadable(self):
+    """Collect output, wait for the exit on end of file."""
+
+    try:
+      data = os.read(self.fd, READ_SIZE)
+    except OSError, e:
+      if e.errno in (errno.EAGAIN, errno.EINTR):
+        return
+      data = ''
+    if data:
+      lines = (self.partial + data).split('\n')
+      self.partial = lines.pop()
+      for line in lines:
+        self.AddLine(line)
+      return
+    if self.partial:
+      self.AddLine(self.partial)
+      self.partial = ''
+    self.loop.RemoveReader(self.fd)
+    self.proc.stdout.close()
+    self.CheckExit()
+
+  def AddLine(self, line):
+    line = line.rstrip()
+    self.lines.append(line)
+    if self.loop.loghandle.debug:
+      self.loop.loghandle.logger.debug('Command output: %s', line)
+
+  def CheckExit(self):
+    """Reap the child, or look again a little later."""
+
+    returncode = self.proc.poll()
+    if returncode is None:
+      self.loop.CallLater(CHILD_POLL_INTERVAL, self.CheckExit)
+      return
+    self.returncode = returncode
+    self.callback(returncode, self.lines)
+
+  def Kill(self, signo=signal.SIGTERM):
+    """Send a signal to the child, if it is still running."""
+
+    if self.returncode is None:
+      try:
+        os.kill(self.pid, signo)
+      except OSError:
+        pass
+
+
+class WorkerPool:
+  """Threads running blocking calls on behalf of the loop."""
+
+  def __init__(self, loop, count):
+    """Start count worker threads.
+
+    Args:
+      loop: Object - EventLoop the results are delivered to.
+      count: Integer - Number of worker threads.
+    """
+
+    self.loop = loop
+    self.tasks = Queue.Queue()
+    self.busy = 0
+    self.workers = []
+    for number in xrange(count):
+      worker = threading.Thread(target=self.Work,
+                                name='Worker-%d' % number)
+      worker.setDaemon(True)
+      worker.start()
+      self.workers.append(worker)
+
+  def Submit(self, func, args, callback):
+    """Queue func(*args). callback(result, error) runs on the loop."""
+
+    self.busy += 1
+    self.tasks.put((func, args, callback))
+
+  def Work(self):
+    """Body of the worker threads."""
+
+    while True:
+      func, args, callback = self.tasks.get()
+      if func is None:
+        return
+      result = None
+      error = None
+      try:
+        result = func(*args)
+      except Exception, e:
+        error = e
+      self.loop.CallFromThread(self.Done, callback, result, error)
+
+  def Done(self, callback, result, error):
+    self.busy -= 1
+    if callback:
+      callback(result, error)
+
+  def Stop(self):
+    """Ask the worker threads to exit once the queued calls are done."""
+
+    for worker in self.workers:
+      self.tasks.put((None, None, None))
+
+
+class EventLoop:
+  """poll(2) based loop running timers, readers, signals and children."""
+
+  def __init__(self, loghandle, workers=2):
+    """Initialise the loop.
+
+    Args:
+      loghandle: Object - Handle to the logging object.
+      workers: Integer - Number of threads for blocking calls.
+    """
+
+    self.loghandle = loghandle
+    self.poller = select.poll()
+    self.readers = {}
+    self.timers = []
+    self.sequence = 0
+    self.running = False
+    self.signals = {}
+    self.threadcalls = []
+    self.threadlock = threading.Lock()
+    # Signals and calls from other threads wake the loop up through a pipe.
+    self.wakeread, self.wakewrite = os.pipe()
+    SetNonBlocking(self.wakeread)
+    SetNonBlocking(self.wakewrite)
+    self.AddReader(self.wakeread, self.OnWakeup)
+    self.pool = WorkerPool(self, workers)
+
+  def AddReader(self, fd, func):
+    """Call func() whenever fd is readable."""
+
+    self.readers[fd] = func
+    self.poller.register(fd, select.POLLIN | select.POLLPRI)
+
+  def RemoveReader(self, fd):
+    """Stop watching fd."""
+
+    try:
+      del self.readers[fd]
+      self.poller.unregister(fd)
+    except (KeyError, select.error):
+      pass
+
+  def CallAt(self, when, func, *args):
+    """Call func(*args) at time when (time.time() seconds).
+
+    Returns:
+      Object - Timer, which can be cancelled.
+    """
+
+    timer = Timer(when, func, args)
+    self.sequence += 1
+    heapq.heappush(self.timers, (when, self.sequence, timer))
+    return timer
+
+  def CallLater(self, delay, func, *args):
+    """Call func(*args) in delay seconds."""
+
+    return self.CallAt(time.time() + delay, func, *args)
+
+  def CallFromThread(self, func, *args):
+    """Call func(*args) on the loop. Safe to use from any thread."""
+
+    self.threadlock.acquire()
+    try:
+      self.threadcalls.append((func, args))
+    finally:
+      self.threadlock.release()
+    self.Wakeup('\0')
+
+  def RunInThread(self, func, args=(), callback=None):
+    """Run a blocking func(*args) in a worker thread.
+
+    callback(result, error) is called on the loop once func returned; error
+    is the exception raised by func, or None.
+    """
+
+    self.pool.Submit(func, args, callback)
+
+  def RunLongTask(self, func, args=(), callback=None, name='Task'):
+    """Run a long blocking func(*args) in a thread of its own.
+
+    Same as RunInThread, without taking a worker thread for the duration.
+    """
+
+    thread = threading.Thread(target=self.LongTask,
+                              args=(func, args, callback), name=name)
+    thread.setDaemon(True)
+    thread.start()
+
+  def LongTask(self, func, args, callback):
+    """Body of the threads of RunLongTask."""
+
+    result = None
+    error = None
+    try:
+      result = func(*args)
+    except Exception, e:
+      error = e
+    if callback:
+      self.CallFromThread(callback, result, error)
+
+  def SpawnProcess(self, runcmd, callback):
+    """Start a child process, see ChildProcess.
+
+    Returns:
+      Object - ChildProcess, None if the command could not be started, in
+        which case callback is called with exit value 1.
+    """
+
+    try:
+      return ChildProcess(self, runcmd, callback)
+    except OSError, e:
+      self.loghandle.logger.error('%s', e)
+      self.CallLater(0, callback, 1, [])
+      return None
+
+  def AddSignal(self, signo, func):
+    """Call func(signo) on the loop whenever signal signo is received."""
+
+    self.signals[signo] = func
+    signal.signal(signo, self.OnSignal)
+
+  def OnSignal(self, signo, stkframe):
+    """Signal handler, only wakes the loop up."""
+
+    self.Wakeup(chr(signo))
+
+  def Wakeup(self, byte):
+    try:
+      os.write(self.wakewrite, byte)
+    except OSError:
+      # Pipe full, the loop is going to wake up anyway.
+      pass
+
+  def OnWakeup(self):
+    """Dispatch received signals and calls from other threads."""
+
+    try:
+      data = os.read(self.wakeread, READ_SIZE)
+    except OSError:
+      data = ''
+    for byte in data:
+      signo = ord(byte)
+      if signo:
+        try:
+          func = self.signals[signo]
+        except KeyError:
+          continue
+        self.Dispatch(func, (signo,))
+    self.threadlock.acquire()
+    try:
+      calls = self.threadcalls
+      self.threadcalls = []
+    finally:
+      self.threadlock.release()
+    # A failing call must not drop the ones queued after it.
+    for func, args in calls:
+      self.Dispatch(func, args)
+
+  def RunTimers(self):
+    """Run the timers which are due.
+
+    Returns:
+      Float - Seconds until the next timer, None if there is none.
+    """
+
+    while self.timers:
+      when, sequence, timer = self.timers[0]
+      if timer.cancelled:
+        heapq.heappop(self.timers)
+        continue
+      delay = when - time.time()
+      if delay > 0:
+        return delay
+      heapq.heappop(self.timers)
+      self.Dispatch(timer.func, timer.args)
+    return None
+
+  def Dispatch(self, func, args=()):
+    """Run a callback, a failing callback does not stop the loop."""
+
+    try:
+      func(*args)
+    except (SystemExit, KeyboardInterrupt):
+      raise
+    except Exception, e:
+      self.loghandle.logger.error('%s failed: %s', func, e)
+
+  def Run(self):
+    """Run callbacks until Stop is called."""
+
+    self.running = True
+    while self.running:
+      delay = self.RunTimers()
+      if not self.running:
+        break
+      if delay is None:
+        timeout = None
+      else:
+        timeout = int(delay * 1000) + 1
+      try:
+        ready = self.poller.poll(timeout)
+      except select.error, e:
+        if e[0] == errno.EINTR:
+          continue
+        raise
+      for fd, event in ready:
+        try:
+          func = self.readers[fd]
+        except KeyError:
+          continue
+        self.Dispatch(func)
+
+  def Stop(self):
+    """Make Run return, after the current callback."""
+
+    self.running = False
+    self.pool.Stop()
@@ -105,3 +105,26 @@ class CommandHelper:
       pass
       #stderr_l.close()
     return runretval
+
+  def RunCommandOutput(self, runcmd):
+    """Uses subprocess.Popen to run the command and collect its output.
+
+    Args:
+      runcmd: List - path to executable and its arguments.
+
+    Returns:
+      Tuple - (exit value of the command, output (stdout and stderr) of the
+        command as a string)
+    """
+
+    try:
+      run_proc = subprocess.Popen(runcmd, bufsize=-1,
+                                  executable=None, stdin=None,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT)
+      output = run_proc.communicate()[0]
+      runretval = run_proc.returncode
+    except OSError, e:
+      self.logmsg.logger.error('%s', e)
+      return 1, ''
+    return runretval, output
@@ -36,6 +36,12 @@ import sys
 
 import logger
 import helper
+import destindex
+import metascan
+import pathtrie
+import compression
+import sshmux
+import versionstore
 
 try:
   import yaml
@@ -73,10 +79,16 @@ class InitData:
     # Make sure we have rsync available
     self.log.logger.debug('Looking for rsync executable.')
     self.rsync_path = 'rsync'
-    if verify.RunCommandPopen([self.rsync_path, '--version']):
+    retval, output = verify.RunCommandOutput([self.rsync_path, '--version'])
+    if retval:
       self.log.logger.error('Cannot find a rsync executable.')
       self.log.logger.error('Make sure rsync is in your $PATH')
       sys.exit(1)
+    self.rsync_version = self.RsyncVersion(output)
+    self.log.logger.debug('rsync version %s', self.rsync_version)
+    # Set for backup method RSYNC.
+    self.sshmaster = None
+    self.remote_rsync_version = None
     # Make sure we have mount and umount commands available
     self.mountbinary = "mount"
     self.log.logger.debug('Looking for mount command.')
@@ -100,6 +112,25 @@ class InitData:
       self.log.logger.warning('Cannot find GUI Helper %s', self.gui_helper)
       self.noguihelper = True
 
+  def RsyncVersion(self, output):
+    """Find the rsync version from the output of "rsync --version".
+
+    Args:
+      output: String - Output of "rsync --version"
+
+    Returns:
+      Tuple - Version numbers, eg. (3, 1, 2). (0,) if not found.
+    """
+
+    match = re.search(r'version\s+(\d+)\.(\d+)(?:\.(\d+))?', output)
+    if not match:
+      return (0,)
+    version = []
+    for number in match.groups():
+      if number is not None:
+        version.append(int(number))
+    return tuple(version)
+
   def ConfigLoader(self):
     """Read config file.
 
@@ -114,6 +145,8 @@ class InitData:
     prompted to enter the path to the config file by using command line
     argument passing.
 
+    Also builds the entry router (pathtrie.EntryRouter) from the entry list.
+
     Returns:
       Lists - four lists, globallist, methodlist, excludelist and entrylist
         are returned, which on the other hand are created by calling
@@ -121,12 +154,27 @@ class InitData:
     """
 
     self.log.logger.info('==> Using config file: %s', self.config_file)
+    self.configdata = self.ReadConfigFile()
+    self.glist, self.methlist = self.InitGlobalData()
+    self.exclist = self.InitExcludeData()
+    self.enlist = self.InitEntryData()
+    # Built once, used to find the entry owning a modified path.
+    self.router = pathtrie.EntryRouter(self.enlist)
+    return
+
+  def ReadConfigFile(self):
+    """Parse the yaml formatted config file, exits on error.
+
+    Returns:
+      configdata: Dictionary - Contents of the config file.
+    """
 
     if os.access(self.config_file, os.F_OK|os.R_OK):
       try:
         readhandle = file(self.config_file, 'r')
       except IOError, e:
         self.log.logger.error('%s, %s', self.config_file, e.strerror)
+        sys.exit(1)
     else:
       self.log.logger.warning('Unable to use config file: %s',
                               self.config_file)
@@ -140,17 +188,54 @@ class InitData:
         self.log.logger.error('%s, %s', self.config_file, e.strerror)
         sys.exit(1)
     try:
-      self.configdata = yaml.load(readhandle)
+      configdata = yaml.load(readhandle)
       readhandle.close()
     except (yaml.scanner.ScannerError, yaml.parser.ParserError,
             yaml.constructor.ConstructorError), e:
       self.log.logger.error('Error in configuration file: %s, %s',
                             self.config_file, e)
       sys.exit(1)
-    self.glist, self.methlist = self.InitGlobalData()
-    self.exclist = self.InitExcludeData()
-    self.enlist = self.InitEntryData()
-    return
+    if not isinstance(configdata, dict):
+      self.log.logger.error('Error in configuration file: %s, no sections'
+                            ' defined', self.config_file)
+      sys.exit(1)
+    return configdata
+
+  def ReloadEntryData(self):
+    """Read the exclude and entry sections of the config file again.
+
+    Used when the running daemon is asked to reload its configuration
+    (SIGHUP). Errors which stop the program at startup only make the reload
+    fail; the current configuration is then left untouched. The other
+    sections are not applied, the names of those which changed are returned
+    so that the caller can tell a restart is needed.
+
+    Returns:
+      Tuple - (excludelist, entrylist, changed sections) as returned by
+        InitExcludeData and InitEntryData, None if the config file has
+        errors.
+    """
+
+    olddata = self.configdata
+    oldexcludes = self.excludelist
+    oldentries = self.entrylist
+    self.log.logger.info('==> Reloading config file: %s', self.config_file)
+    try:
+      self.configdata = self.ReadConfigFile()
+      self.excludelist = None
+      excludelist = self.InitExcludeData()
+      entrylist = self.InitEntryData()
+    except SystemExit:
+      self.configdata = olddata
+      self.excludelist = oldexcludes
+      self.entrylist = oldentries
+      return None
+    changed = []
+    for section in olddata.keys() + self.configdata.keys():
+      if (section not in ('exclude', 'entry') and section not in changed and
+          olddata.get(section) != self.configdata.get(section)):
+        changed.append(section)
+    return excludelist, entrylist, changed
 
   def InitGlobalData(self):
     """Read global data from config.
@@ -163,12 +248,38 @@ class InitData:
         - Defaults to 300 seconds, if not provided
       - Verify value provided for commitchanges
         - Defaults to 64, if not provided
+      - Verify value provided for quietperiod
+        - Defaults to 10 seconds (at most syncinterval), if not provided
+      - Verify value provided for maxwatches
+        - Defaults to half of the kernel limit, if not provided
+      - Verify value provided for initialworkers
+        - Defaults to 3, if not provided
+      - Verify value provided for batchtransfers
+        - Defaults to True, if not provided
+      - Verify value provided for localcopy
+        - Defaults to True, if not provided
       - Verify value provided for maintainprevious
         - Defaults to False, if not provided
+      - Verify value provided for versionstore
+        - Defaults to False, if not provided
+      - Verify value provided for keepversions
+        - Defaults to 2592000 (30 days), if not provided
+      - Verify value provided for compression
+        - Defaults to "auto", if not provided
+      - Verify value provided for minfreespace
+        - Defaults to 256 (MB), if not provided
+      - Verify value provided for snapshotinterval
+        - Defaults to 0 (no snapshots), if not provided
+      - Verify values provided for keephourly, keepdaily, keepweekly
+        - Default to 24, 7 and 4, if not provided
       - Verify value provided for retainbackup
         - Defaults to True, if not provided
       - Verify value provided for retentiontime
         - Defaults to 604800 (seven days), if not provided
+      - Verify value provided for scanworkers
+        - Defaults to 8, if not provided
+      - Verify value provided for reconcileinterval
+        - Defaults to 604800 (seven days), if not provided
 
     Returns:
       globallist: List - List of global parameters declared in Global section
@@ -242,9 +353,80 @@ class InitData:
         raise KeyError
     except KeyError:
       self.commitchanges = 64
-      self.log.logger.warning('Please define a valid global variable'
-                              ' "commitchanges"')
-      self.log.logger.warning('Using default: %s', self.commitchanges)
+      # Obsolete (see quietperiod), only complain about invalid values.
+      if 'commitchanges' in self.configdata['global']:
+        self.log.logger.warning('Please define a valid global variable'
+                                ' "commitchanges"')
+        self.log.logger.warning('Using default: %s', self.commitchanges)
+    self.quietperiod = min(10, self.syncinterval)
+    try:
+      quietperiod = self.configdata['global']['quietperiod']
+      if quietperiod is not None:
+        try:
+          quietperiod = int(quietperiod)
+        except ValueError:
+          quietperiod = 0
+        if quietperiod < 1 or quietperiod > self.syncinterval:
+          self.log.logger.warning('Please define a valid global variable'
+                                  ' "quietperiod" (1 - syncinterval)')
+          self.log.logger.warning('Using default: %s seconds',
+                                  self.quietperiod)
+        else:
+          self.quietperiod = quietperiod
+    except KeyError:
+      pass
+    self.maxwatches = None
+    try:
+      maxwatches = self.configdata['global']['maxwatches']
+      if maxwatches is not None:
+        try:
+          maxwatches = int(maxwatches)
+        except ValueError:
+          maxwatches = 0
+        if maxwatches < 1:
+          self.log.logger.warning('Please define a valid global variable'
+                                  ' "maxwatches"')
+          self.log.logger.warning('Using default: half of the kernel limit')
+        else:
+          self.maxwatches = maxwatches
+    except KeyError:
+      pass
+    self.initialworkers = 3
+    try:
+      initialworkers = self.configdata['global']['initialworkers']
+      if initialworkers is not None:
+        try:
+          initialworkers = int(initialworkers)
+        except ValueError:
+          initialworkers = 0
+        if initialworkers < 1:
+          self.log.logger.warning('Please define a valid global variable'
+                                  ' "initialworkers"')
+          self.log.logger.warning('Using default: %s', self.initialworkers)
+        else:
+          self.initialworkers = initialworkers
+    except KeyError:
+      pass
+    self.batchtransfers = True
+    try:
+      batchtransfers = self.configdata['global']['batchtransfers']
+      if not self.CheckKeyValue(batchtransfers):
+        self.log.logger.warning('Invalid "batchtransfers" key value defined')
+        self.log.logger.warning('Assuming "yes"')
+      else:
+        self.batchtransfers = batchtransfers
+    except KeyError:
+      pass
+    self.localcopy = True
+    try:
+      localcopy = self.configdata['global']['localcopy']
+      if not self.CheckKeyValue(localcopy):
+        self.log.logger.warning('Invalid "localcopy" key value defined')
+        self.log.logger.warning('Assuming "yes"')
+      else:
+        self.localcopy = localcopy
+    except KeyError:
+      pass
     try:
       maintainprevious = self.configdata['global']['maintainprevious']
       if not self.CheckKeyValue(maintainprevious):
@@ -254,6 +436,26 @@ class InitData:
       self.log.logger.warning('Assuming "no"')
       maintainprevious = False
     self.log.maintainprevious = maintainprevious
+    self.versionstore = False
+    try:
+      usestore = self.configdata['global']['versionstore']
+      if not self.CheckKeyValue(usestore):
+        self.log.logger.warning('Invalid "versionstore" key value defined')
+        self.log.logger.warning('Assuming "no"')
+      else:
+        self.versionstore = usestore
+    except KeyError:
+      pass
+    if self.versionstore and not maintainprevious:
+      self.log.logger.warning('"versionstore" has no effect without'
+                              ' "maintainprevious"')
+      self.versionstore = False
+    if self.versionstore and self.backupmethod == "RSYNC":
+      self.log.logger.warning('Version store is not supported yet, in backup'
+                              ' method: RSYNC. Keeping ".odb~" files.')
+      self.versionstore = False
+    self.keepversions = self.CountKeyValue('keepversions',
+                                           versionstore.KEEP_VERSIONS, 0)
     try:
       self.retainbackup = self.configdata['global']['retainbackup']
       if not self.CheckKeyValue(self.retainbackup):
@@ -267,7 +469,8 @@ class InitData:
         self.log.logger.warning('Deleting old files is not supported yet, in'
                                 ' backup method: RSYNC.')
         self.retainbackup = True
-    if maintainprevious:
+    if maintainprevious and not self.versionstore:
+      # Old files could not be told apart from ".odb~" files.
       self.log.logger.warning('Disabling "retainbackup"')
       self.retainbackup = True
     try:
@@ -283,6 +486,10 @@ class InitData:
       self.log.logger.warning('Please define a valid global variable'
                               ' "retentiontime"')
       self.log.logger.warning('Using default: %s', self.retentiontime)
+    self.scanworkers = self.CountKeyValue('scanworkers',
+                                          metascan.SCAN_WORKERS, 1)
+    self.reconcileinterval = self.CountKeyValue(
+        'reconcileinterval', destindex.RECONCILE_INTERVAL, 0)
     self.fuserbinary = '/usr/bin/fusermount'
     self.globallist = []
     self.methodlist = []
@@ -292,6 +499,42 @@ class InitData:
     else:
       self.backupdirpath = os.path.join(self.localmount, self.user,
                                         '__backups__', self.hostname)
+    self.minfreespace = self.CountKeyValue('minfreespace', 256, 0)
+    self.snapshotinterval = self.CountKeyValue('snapshotinterval', 0, 0)
+    self.keephourly = self.CountKeyValue('keephourly', 24, 0)
+    self.keepdaily = self.CountKeyValue('keepdaily', 7, 0)
+    self.keepweekly = self.CountKeyValue('keepweekly', 4, 0)
+    self.snapshotdirpath = None
+    if self.snapshotinterval:
+      if self.backupmethod == "RSYNC":
+        self.log.logger.warning('Snapshots are not supported yet, in backup'
+                                ' method: RSYNC.')
+        self.snapshotinterval = 0
+      else:
+        self.snapshotdirpath = os.path.join(self.localmount, self.user,
+                                            '__snapshots__', self.hostname)
+    self.compression = 'auto'
+    try:
+      usecompression = self.configdata['global']['compression']
+      if usecompression != 'auto' and not self.CheckKeyValue(usecompression):
+        self.log.logger.warning('Invalid "compression" key value defined')
+        self.log.logger.warning('Assuming "auto"')
+      else:
+        self.compression = usecompression
+    except KeyError:
+      pass
+    # Only used with backup method RSYNC, see backup.Backup.
+    self.log.compression = None
+    if self.compression == 'auto':
+      self.log.compression = compression.CompressionAdvisor(self.log)
+    elif self.compression:
+      self.log.compression = compression.CompressionAdvisor(self.log,
+                                                            always=True)
+    self.log.versionstore = None
+    if self.versionstore:
+      self.log.versionstore = versionstore.VersionStore(
+          os.path.join(self.localmount, self.user, '__versions__',
+                       self.hostname), self.log)
     self.globallist.extend([self.backupmethod, self.syncinterval,
                             self.commitchanges, self.backupdirpath,
                             self.retentiontime, self.retainbackup,
@@ -384,6 +627,20 @@ class InitData:
         sys.exit(1)
       self.ssh_cmd = [self.ssh_path, '-l', self.sshuser, '-p', self.sshport,
                       self.backupserver]
+      try:
+        sshmaster = self.configdata[method]['sshmaster']
+      except KeyError:
+        sshmaster = True
+      if not self.CheckKeyValue(sshmaster):
+        self.log.logger.warning('Invalid "sshmaster" key value defined')
+        self.log.logger.warning('Assuming "yes"')
+        sshmaster = True
+      if sshmaster:
+        # Every ssh command goes through one persistent connection.
+        self.sshmaster = sshmux.SshMaster(self.ssh_path, self.sshuser,
+                                          self.sshport, self.backupserver,
+                                          self.help_execute, self.log)
+        self.ssh_cmd = self.sshmaster.Command([])
 
 
   def CheckKeyValue(self, param):
@@ -408,6 +665,35 @@ class InitData:
       return False
     return True
 
+  def CountKeyValue(self, key, default, minimum):
+    """Returns the integer value of an optional global parameter.
+
+    Args:
+      key: String - Name of the parameter in the global section.
+      default: Integer - Value used if the parameter is not given, or invalid.
+      minimum: Integer - Smallest valid value.
+
+    Returns:
+      Integer - The value of the parameter, or default.
+    """
+
+    try:
+      value = self.configdata['global'][key]
+    except KeyError:
+      return default
+    if value is None:
+      return default
+    try:
+      value = int(value)
+    except ValueError:
+      value = minimum - 1
+    if value < minimum:
+      self.log.logger.warning('Please define a valid global variable "%s"',
+                              key)
+      self.log.logger.warning('Using default: %s', default)
+      return default
+    return value
+
   def InitExcludeData(self):
     """Read exclude file/directories from config.
 
@@ -449,6 +735,8 @@ class InitData:
       - Check whether at least one valid entry is defined
       - Check if recursive key is specified and is valid (True|False)
         - If not specified, default it to False
+      - Check if priority key is a valid number
+        - If not specified, default it to 0
       - Make sure, no two entries have same path specified for backup. (Marks
         as duplicate)
       - Make sure that directories in an entry specified for backup is not
@@ -464,6 +752,7 @@ class InitData:
           'recursive': True|False    # Boolean
           'exclude':                 # List - Optional
           'include':                 # List - Optional
+          'priority': Number         # Integer - Optional, default 0
         }
     """
 
@@ -504,6 +793,12 @@ class InitData:
                                     ' defined for entry: %s', item['name'])
             self.log.logger.warning('Assuming "recursive" key to be "no"')
             item['recursive'] = False
+          try:
+            item['priority'] = int(item.get('priority') or 0)
+          except (TypeError, ValueError):
+            self.log.logger.warning('Invalid "priority" defined for entry:'
+                                    ' %s, assuming 0', item['name'])
+            item['priority'] = 0
           if os.access(path, os.F_OK|os.R_OK):
             self.entrylist.append(item)
           else:
@@ -598,21 +893,26 @@ class InitData:
     local_mountpoint = self.localmount
     mountreq = mount
     # We use this instead of os.path.ismount, since we need to find the
-    # filesystem type too.
-    dfcmd = 'df -h ' + local_mountpoint
-    dfhandle = os.popen(dfcmd, 'r')
-    dfhandle.readline()  # Skip first line
-    try:
-      filesystem = dfhandle.readline().split(None, 5)[0]
-    except IndexError:
-      filesystem = None
+    # filesystem type too. The mount table is read first, since df waits for
+    # the NFS server.
+    source = metascan.MountSource(local_mountpoint)
+    if source is not None:
+      filesystem = source[0]
+    else:
+      dfcmd = 'df -h ' + local_mountpoint
+      dfhandle = os.popen(dfcmd, 'r')
+      dfhandle.readline()  # Skip first line
+      try:
+        filesystem = dfhandle.readline().split(None, 5)[0]
+      except IndexError:
+        filesystem = None
+      dfhandle.close()
     if filesystem == self.remote_info:
       pass
     elif filesystem != self.remote_info:
       self.log.logger.warning('%s defined in configfile is not mounted'
                               ' in %s', self.remotemount, local_mountpoint)
       mountreq = True
-    dfhandle.close()
     return mountreq
 
   def UnmountPartition(self):
@@ -681,6 +981,41 @@ class InitData:
       sys.exit(1)
     return retval
 
+  def RemoteBootstrap(self):
+    """Verify and create the backup directory structure on the rsync server.
+
+    Does in one ssh invocation what VerifyBackupDirStruct and
+    CreateBackupDirStruct do for the other backup methods, and also finds
+    the version of rsync on the server (remote_rsync_version).
+
+    Returns:
+      Boolean - True if the backup directory exists or has been created.
+    """
+
+    userpath = os.path.dirname(os.path.dirname(self.backupdirpath))
+    backupdir = sshmux.ShellQuote(self.backupdirpath)
+    script = ('if test -d %s; then echo exists;'
+              ' elif mkdir -p -m 0700 %s && chmod 0700 %s; then echo created;'
+              ' else exit 1; fi; rsync --version 2>/dev/null | head -n 1;'
+              ' exit 0' % (backupdir, backupdir,
+                           sshmux.ShellQuote(userpath)))
+    cmd = []
+    cmd.extend(self.ssh_cmd)
+    cmd.append(script)
+    self.log.logger.debug(cmd)
+    retval, output = self.help_execute.RunCommandOutput(cmd)
+    if retval:
+      self.log.logger.error('%s', output.strip())
+      self.log.logger.error('Unable to create backup directory structure '
+                            'in rsync server')
+      return False
+    if 'created' in output.split():
+      self.log.logger.info('Created backup directory structure in rsync '
+                           'server.')
+    self.remote_rsync_version = self.RsyncVersion(output)
+    self.log.logger.debug('Remote rsync version %s', self.remote_rsync_version)
+    return True
+
   def VerifyBackupDirStruct(self, structok=False):
     """Verify backup directory structure in backup partition.
 
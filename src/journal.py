@@ -0,0 +1,354 @@
+#!/usr/bin/python2.4
+
+# Copyright 2008 Google Inc.
+# Author : Anoop Chandran <anoopj@google.com>
+#
+# openduckbill is a simple backup application. It offers support for
+# transferring data to a local backup directory, NFS. It also provides
+# file system monitoring of directories marked for backup. Please read
+# the README file for more details.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Per file change journal.
+
+journal keeps one record per modified file/directory (full pathname) and
+coalesces the filesystem events received for it into one net operation.
+For example:
+  - IN_CREATE followed by IN_DELETE is dropped (nothing to back up)
+  - any number of IN_MODIFY followed by IN_CLOSE_WRITE is one update
+  - an editor writing a temporary file and renaming it over the original is
+    one update of the original (the temporary file cancels out)
+"""
+
+import os
+
+import pathtrie
+
+# inotify event masks (see inotify(7)). Numeric values are used so that this
+# module does not depend on the pyinotify version installed.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+# Not an inotify mask: the listing of a directory changed in a way not known
+# from events (see ChangeJournal.RecordListing).
+LISTING_CHANGED = 0
+
+# Net operations
+OP_CREATE = 'create'    # Did not exist before, exists now
+OP_UPDATE = 'update'    # Contents changed (or replaced)
+OP_ATTRIB = 'attrib'    # Only metadata changed
+OP_DELETE = 'delete'    # Existed before, gone now
+OP_SYNCDIR = 'syncdir'  # Directory listing changed, children unknown
+
+# Record fields
+_EXISTED = 0    # True, False or None (unknown)
+_EXISTS = 1
+_CONTENT = 2
+_ISDIR = 3
+_LISTING = 4    # Listing changed in a way not known from events (rescan)
+
+
+def EventPathname(event):
+  """Returns the full pathname of a pyinotify event."""
+
+  if event.name:
+    return os.path.join(event.path, event.name)
+  return event.path
+
+
+class ChangeJournal:
+  """Keeps the net change of every modified path since the last flush."""
+
+  def __init__(self):
+    """Initialise an empty journal."""
+
+    self.Clear()
+
+  def __len__(self):
+    return len(self.records)
+
+  def Clear(self):
+    """Forget all recorded changes."""
+
+    self.records = {}
+    # Directory path => set of recorded pathnames directly below it. Used to
+    # drop records below a deleted directory.
+    self.children = {}
+    self.events = 0
+
+  def RecordEvent(self, event):
+    """Records a pyinotify event.
+
+    Args:
+      event: Event Object
+    """
+
+    self.Record(event.mask, EventPathname(event))
+
+  def Record(self, mask, pathname):
+    """Coalesce one event into the record of pathname.
+
+    Args:
+      mask: Integer - inotify event mask.
+      pathname: String - Full path of the file/directory the event is for.
+    """
+
+    self.events += 1
+    isdir = bool(mask & IN_ISDIR)
+    try:
+      record = self.records[pathname]
+    except KeyError:
+      if mask & IN_CREATE:
+        existed = False
+      elif mask & IN_MOVED_TO:
+        # Might have replaced an existing file.
+        existed = None
+      else:
+        existed = True
+      record = self._NewRecord(pathname, existed, isdir)
+
+    if mask & (IN_DELETE | IN_MOVED_FROM | IN_DELETE_SELF | IN_MOVE_SELF):
+      if record[_ISDIR] or isdir:
+        self._DropBelow(pathname)
+      if record[_EXISTED] is False:
+        # Created and removed since the last flush: nothing to do.
+        self._Drop(pathname)
+        return
+      record[_EXISTS] = False
+      record[_CONTENT] = False
+    elif mask & (IN_CREATE | IN_MOVED_TO | IN_MODIFY | IN_CLOSE_WRITE):
+      record[_EXISTS] = True
+      record[_CONTENT] = True
+    elif mask & IN_ATTRIB:
+      record[_EXISTS] = True
+    if mask & (IN_CREATE | IN_MOVED_TO):
+      record[_ISDIR] = isdir
+    elif isdir:
+      record[_ISDIR] = True
+
+  def _NewRecord(self, pathname, existed, isdir):
+    """Add a record for pathname."""
+
+    record = [existed, True, False, isdir, False]
+    self.records[pathname] = record
+    parent = os.path.dirname(pathname)
+    try:
+      self.children[parent].add(pathname)
+    except KeyError:
+      self.children[parent] = set([pathname])
+    return record
+
+  def RecordListing(self, dirpath):
+    """Record that the listing of a directory changed in an unknown way.
+
+    Used when events have been lost: the directory has to be synced with
+    deletion of extraneous files at the destination, since the removed
+    names are not known.
+
+    Args:
+      dirpath: String - Full path of the directory.
+    """
+
+    self.events += 1
+    try:
+      record = self.records[dirpath]
+    except KeyError:
+      record = self._NewRecord(dirpath, True, True)
+    record[_EXISTS] = True
+    record[_ISDIR] = True
+    record[_LISTING] = True
+
+  def RecordOperation(self, pathname, operation, isdir):
+    """Coalesce a net operation (see NetChanges) into the record of pathname.
+
+    Used to merge the changes of a later journal into this one.
+    """
+
+    if operation == OP_SYNCDIR:
+      self.RecordListing(pathname)
+      return
+    if isdir:
+      flags = IN_ISDIR
+    else:
+      flags = 0
+    if operation == OP_CREATE:
+      self.Record(IN_CREATE | flags, pathname)
+    elif operation == OP_UPDATE:
+      self.Record(IN_MODIFY | flags, pathname)
+    elif operation == OP_ATTRIB:
+      self.Record(IN_ATTRIB | flags, pathname)
+    elif operation == OP_DELETE:
+      self.Record(IN_DELETE | flags, pathname)
+
+  def _Drop(self, pathname):
+    """Remove the record of pathname."""
+
+    del self.records[pathname]
+    parent = os.path.dirname(pathname)
+    try:
+      siblings = self.children[parent]
+      siblings.discard(pathname)
+      if not siblings:
+        del self.children[parent]
+    except KeyError:
+      pass
+
+  def _DropBelow(self, dirpath):
+    """Remove the records of everything below a removed directory.
+
+    A deleted (or moved away) directory is removed as a whole at the backup
+    destination, so changes recorded below it are of no use anymore.
+    """
+
+    stack = [dirpath]
+    while stack:
+      try:
+        below = self.children.pop(stack.pop())
+      except KeyError:
+        continue
+      for pathname in below:
+        del self.records[pathname]
+        stack.append(pathname)
+
+  def Operation(self, pathname):
+    """Returns the net operation recorded for pathname, or None."""
+
+    try:
+      record = self.records[pathname]
+    except KeyError:
+      return None
+    return self._NetOp(record)
+
+  def _NetOp(self, record):
+    """Computes the net operation of a record."""
+
+    if not record[_EXISTS]:
+      return OP_DELETE
+    if record[_LISTING]:
+      return OP_SYNCDIR
+    if record[_EXISTED] is False:
+      return OP_CREATE
+    if record[_CONTENT] or record[_EXISTED] is None:
+      return OP_UPDATE
+    return OP_ATTRIB
+
+  def NetChanges(self):
+    """Returns the net changes recorded.
+
+    Returns:
+      Dictionary - pathname => (operation, isdir). operation is one of
+        OP_CREATE, OP_UPDATE, OP_ATTRIB, OP_DELETE or OP_SYNCDIR.
+    """
+
+    changes = {}
+    for pathname, record in self.records.iteritems():
+      changes[pathname] = (self._NetOp(record), record[_ISDIR])
+    return changes
+
+  def Counts(self):
+    """Returns a dictionary operation => number of paths, for messages."""
+
+    counts = {OP_CREATE: 0, OP_UPDATE: 0, OP_ATTRIB: 0, OP_DELETE: 0,
+              OP_SYNCDIR: 0}
+    for record in self.records.itervalues():
+      counts[self._NetOp(record)] += 1
+    return counts
+
+
+class EntryChanges:
+  """Changes of one entry waiting to be backed up."""
+
+  def __init__(self, entrypath):
+    """Initialise empty change records for the entry.
+
+    Args:
+      entrypath: String - Path of the entry.
+    """
+
+    self.counter = 0
+    self.changed_path = pathtrie.ChangedPathSet([entrypath])
+    self.journal = ChangeJournal()
+
+  def RecordEvent(self, event):
+    """Records a pyinotify event in the path set and in the journal."""
+
+    self.counter += 1
+    self.changed_path.Add(event.path)
+    self.journal.RecordEvent(event)
+
+  def RecordRescan(self, result):
+    """Records the changes found by a rescan (see rescan.TreeRescanner).
+
+    Args:
+      result: Object - rescan.RescanResult of the entry.
+    """
+
+    if not result.complete:
+      # Too many changes to list, sync the whole entry.
+      self.counter += 1
+      self.changed_path.Add(result.entry['path'])
+      self.journal.RecordListing(result.entry['path'])
+      return
+    for pathname in result.files:
+      self.counter += 1
+      self.changed_path.Add(os.path.dirname(pathname))
+      self.journal.Record(IN_MODIFY, pathname)
+    for dirpath in result.dirs:
+      self.counter += 1
+      self.changed_path.Add(dirpath)
+      self.journal.RecordListing(dirpath)
+
+  def Merge(self, later):
+    """Add the changes recorded by later (made after these) to these.
+
+    Args:
+      later: Object - EntryChanges of the same entry.
+    """
+
+    self.counter += later.counter
+    for path in later.changed_path.CoveringPaths():
+      self.changed_path.Add(path)
+    changes = later.journal.NetChanges().items()
+    # Parents first, so that a deleted directory drops its children.
+    changes.sort()
+    for pathname, (operation, isdir) in changes:
+      self.journal.RecordOperation(pathname, operation, isdir)
+
+  def Replay(self, mask, path, name):
+    """Records a change read back from the pending change log.
+
+    Args:
+      mask: Integer - inotify event mask, or LISTING_CHANGED.
+      path: String - Directory of the change (event path).
+      name: String - Name in path, or empty.
+    """
+
+    self.counter += 1
+    self.changed_path.Add(path)
+    if mask == LISTING_CHANGED:
+      self.journal.RecordListing(path)
+    elif name:
+      self.journal.Record(mask, os.path.join(path, name))
+    else:
+      self.journal.Record(mask, path)
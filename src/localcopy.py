@@ -0,0 +1,370 @@
+#!/usr/bin/python2.4
+
+# Copyright 2008 Google Inc.
+# Author : Anoop Chandran <anoopj@google.com>
+#
+# openduckbill is a simple backup application. It offers support for
+# transferring data to a local backup directory, NFS. It also provides
+# file system monitoring of directories marked for backup. Please read
+# the README file for more details.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""In-process transfer of a few changed paths to a local backup directory.
+
+With backup methods LOCAL and NFS, a flush of a handful of known files does
+not need an rsync process: localcopy copies each path of the file list to
+the backup directory, keeping what rsync keeps (permissions, times, owner,
+group, symlinks and devices) and following the rsync options used by
+backup.Backup:
+  - --update: a file newer at the destination is left alone
+  - unchanged files (same size and mtime) are not copied again
+  - --delete-missing-args: paths gone from the source are removed
+  - --force: a directory replaced by a file (or the opposite) is removed
+  - -b --suffix: the previous version is kept (maintainprevious)
+  - -b --backup-dir: the previous version is moved to a staging directory
+    of the version store (see versionstore)
+  - include/exclude patterns are matched against the name of each path,
+    as rsync does for --files-from
+Files are written to a temporary file in the destination directory and
+renamed over the old version, so a file at the destination is always
+complete. Non-regular files other than devices are skipped, as rsync
+does without --specials.
+"""
+
+import errno
+import fnmatch
+import os
+import shutil
+import stat
+import tempfile
+
+# Largest file list transferred in-process. rsync is used beyond that.
+MAX_PATHS = 256
+# Bytes read and written at a time.
+COPY_BLOCK = 1024 * 1024
+# Exit value for a transfer with errors, the one of rsync for a partial
+# transfer.
+PARTIAL_TRANSFER = 23
+
+
+def SimplePattern(pattern):
+  """Checks whether a pattern only matches names (no "/" nor "**")."""
+
+  return '**' not in pattern and '/' not in pattern.rstrip('/')
+
+
+def Excluded(rules, name, isdir):
+  """Apply include/exclude rules to a name, the first matching rule wins.
+
+  Args:
+    rules: List - ('+' or '-', pattern) tuples. Patterns ending with "/"
+      only match directories.
+    name: String - File name.
+    isdir: Boolean - name is a directory.
+
+  Returns:
+    Boolean - True if name is excluded.
+  """
+
+  for action, pattern in rules:
+    if pattern.endswith('/'):
+      if not isdir:
+        continue
+      pattern = pattern.rstrip('/')
+    if fnmatch.fnmatchcase(name, pattern):
+      return action == '-'
+  return False
+
+
+class LocalCopier:
+  """Copies paths to the backup directory, see module docstring."""
+
+  def __init__(self, backupdir, loghandle, backupsuffix=None,
+               versiondir=None):
+    """Initialise the copier.
+
+    Args:
+      backupdir: String - Backup directory, source paths are copied below
+        it with their full path.
+      loghandle: Object - Handle to the logging object.
+      backupsuffix: String - Suffix of the kept previous versions, None to
+        not keep them.
+      versiondir: String - Directory the previous versions are moved to
+        (with their full path) instead, None to not move them.
+    """
+
+    self.backupdir = backupdir.rstrip('/')
+    self.loghandle = loghandle
+    self.backupsuffix = backupsuffix
+    self.versiondir = versiondir
+    # A file newer at the destination is left alone (--update).
+    self.update = True
+    self.lines = []
+    # Destination directories whose times have to be restored at the end.
+    self.touched = set()
+    self.changed = 0
+
+  def Transfer(self, paths, deletemissing, rulesfunc):
+    """Copy paths to the backup directory. Blocking.
+
+    Args:
+      paths: List - Absolute source paths, parents before children.
+      deletemissing: Boolean - Remove the paths gone from the source.
+      rulesfunc: Function - Returns the include/exclude rules of a path.
+
+    Returns:
+      Tuple - (exit value, error lines). The exit value is 0 or
+        PARTIAL_TRANSFER, the lines name the failed path like rsync does.
+    """
+
+    self.lines = []
+    self.touched = set()
+    self.changed = 0
+    for path in paths:
+      try:
+        self.TransferPath(path, deletemissing, rulesfunc(path))
+      except (IOError, OSError), e:
+        self.Error('transfer', path, e)
+    dirs = list(self.touched)
+    dirs.sort()
+    dirs.reverse()
+    for dirpath in dirs:
+      try:
+        st = os.lstat(dirpath)
+        os.utime(self.Destination(dirpath), (st.st_atime, st.st_mtime))
+      except OSError:
+        pass
+    self.loghandle.logger.debug('In-process copy of %s paths: %s changes at'
+                                ' the destination', len(paths), self.changed)
+    if self.lines:
+      return PARTIAL_TRANSFER, self.lines
+    return 0, self.lines
+
+  def Error(self, action, path, error):
+    line = 'localcopy: %s "%s" failed: %s' % (action, path, error)
+    self.loghandle.logger.warning('%s', line)
+    self.lines.append(line)
+
+  def Destination(self, path):
+    return self.backupdir + path
+
+  def TransferPath(self, path, deletemissing, rules):
+    """Copy (or remove) one path."""
+
+    dest = self.Destination(path)
+    try:
+      st = os.lstat(path)
+    except OSError, e:
+      if e.errno != errno.ENOENT or not deletemissing:
+        raise
+      if Excluded(rules, os.path.basename(path), False):
+        return
+      self.Remove(dest)
+      self.changed += 1
+      self.touched.add(os.path.dirname(path))
+      return
+    mode = st.st_mode
+    if Excluded(rules, os.path.basename(path), stat.S_ISDIR(mode)):
+      return
+    self.MakeParents(os.path.dirname(path))
+    if stat.S_ISDIR(mode):
+      self.CopyDirectory(path, dest, st)
+    elif stat.S_ISREG(mode):
+      self.CopyFile(path, dest, st)
+    elif stat.S_ISLNK(mode):
+      self.CopyLink(path, dest, st)
+    elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+      self.CopyDevice(path, dest, st)
+    else:
+      self.loghandle.logger.debug('Skipping non-regular file %s', path)
+      return
+    self.touched.add(os.path.dirname(path))
+
+  def MakeParents(self, dirpath):
+    """Create the missing parents at the destination, like rsync -R."""
+
+    missing = []
+    while dirpath != '/' and not os.path.isdir(self.Destination(dirpath)):
+      missing.append(dirpath)
+      dirpath = os.path.dirname(dirpath)
+    missing.reverse()
+    for dirpath in missing:
+      self.CopyDirectory(dirpath, self.Destination(dirpath), os.lstat(dirpath))
+
+  def Remove(self, dest):
+    """Remove a path at the destination, keeping a previous version."""
+
+    try:
+      st = os.lstat(dest)
+    except OSError, e:
+      if e.errno == errno.ENOENT:
+        return
+      raise
+    if self.Keep(dest, st):
+      return
+    if stat.S_ISDIR(st.st_mode):
+      shutil.rmtree(dest)
+    else:
+      os.remove(dest)
+
+  def Replace(self, tmpname, dest):
+    """Rename tmpname over dest, removing a directory in the way."""
+
+    try:
+      st = os.lstat(dest)
+    except OSError:
+      st = None
+    if st is not None and not self.Keep(dest, st):
+      if stat.S_ISDIR(st.st_mode):
+        shutil.rmtree(dest)
+    os.rename(tmpname, dest)
+    self.changed += 1
+
+  def Keep(self, dest, st):
+    """Keep the previous version of dest, if previous versions are kept.
+
+    Args:
+      dest: String - Path at the destination.
+      st: Object - lstat result of dest.
+
+    Returns:
+      Boolean - True if dest has been moved away.
+    """
+
+    if self.versiondir:
+      # A whole directory is moved, rsync keeps the files below it too.
+      kept = self.versiondir + dest[len(self.backupdir):]
+      if not os.path.isdir(os.path.dirname(kept)):
+        os.makedirs(os.path.dirname(kept))
+      os.rename(dest, kept)
+      return True
+    if self.backupsuffix and not stat.S_ISDIR(st.st_mode):
+      os.rename(dest, dest + self.backupsuffix)
+      return True
+    return False
+
+  def SetAttributes(self, target, st, link=False):
+    """Set the owner, permissions and times of st on target."""
+
+    try:
+      if link:
+        os.lchown(target, st.st_uid, st.st_gid)
+      else:
+        os.chown(target, st.st_uid, st.st_gid)
+    except OSError:
+      # Only the super-user can give files away, keep at least the group.
+      try:
+        if not link:
+          os.chown(target, -1, st.st_gid)
+      except OSError:
+        pass
+    if not link:
+      os.chmod(target, stat.S_IMODE(st.st_mode))
+      os.utime(target, (st.st_atime, st.st_mtime))
+
+  def CopyDirectory(self, path, dest, st):
+    try:
+      destst = os.lstat(dest)
+    except OSError:
+      destst = None
+    if destst is not None and not stat.S_ISDIR(destst.st_mode):
+      self.Remove(dest)
+      destst = None
+    if destst is None:
+      os.mkdir(dest, 0700)
+      self.changed += 1
+    self.SetAttributes(dest, st)
+    self.touched.add(path)
+
+  def CopyFile(self, path, dest, st):
+    try:
+      destst = os.lstat(dest)
+    except OSError:
+      destst = None
+    if destst is not None and stat.S_ISREG(destst.st_mode):
+      if self.update and int(destst.st_mtime) > int(st.st_mtime):
+        # --update
+        return
+      if (destst.st_size == st.st_size and
+          int(destst.st_mtime) == int(st.st_mtime)):
+        # Unchanged, only the attributes might differ.
+        self.SetAttributes(dest, st)
+        return
+    srcfd = os.open(path, os.O_RDONLY)
+    try:
+      tmpfd, tmpname = tempfile.mkstemp(
+          '', '.' + os.path.basename(path) + '.', os.path.dirname(dest))
+      try:
+        try:
+          while True:
+            data = os.read(srcfd, COPY_BLOCK)
+            if not data:
+              break
+            while data:
+              written = os.write(tmpfd, data)
+              data = data[written:]
+        finally:
+          os.close(tmpfd)
+        self.SetAttributes(tmpname, st)
+        self.Replace(tmpname, dest)
+      except (IOError, OSError):
+        try:
+          os.remove(tmpname)
+        except OSError:
+          pass
+        raise
+    finally:
+      os.close(srcfd)
+
+  def CopyLink(self, path, dest, st, target=None):
+    if target is None:
+      target = os.readlink(path)
+    try:
+      if os.readlink(dest) == target:
+        self.SetAttributes(dest, st, link=True)
+        return
+    except OSError:
+      pass
+    tmpname = self.TempName(dest)
+    os.symlink(target, tmpname)
+    try:
+      self.SetAttributes(tmpname, st, link=True)
+      self.Replace(tmpname, dest)
+    except OSError:
+      os.remove(tmpname)
+      raise
+
+  def CopyDevice(self, path, dest, st):
+    tmpname = self.TempName(dest)
+    os.mknod(tmpname, st.st_mode, st.st_rdev)
+    try:
+      self.SetAttributes(tmpname, st)
+      self.Replace(tmpname, dest)
+    except OSError:
+      os.remove(tmpname)
+      raise
+
+  def TempName(self, dest):
+    """Returns an unused name next to dest, for a link or device node."""
+
+    dirname, name = os.path.split(dest)
+    number = 0
+    while True:
+      tmpname = os.path.join(dirname, '.%s.%d.odbtmp' % (name, number))
+      if not os.path.lexists(tmpname):
+        return tmpname
+      number += 1
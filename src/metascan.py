@@ -0,0 +1,350 @@
+#!/usr/bin/python2.4
+
+# Copyright 2008 Google Inc.
+# Author : Anoop Chandran <anoopj@google.com>
+#
+# openduckbill is a simple backup application. It offers support for
+# transferring data to a local backup directory, NFS. It also provides
+# file system monitoring of directories marked for backup. Please read
+# the README file for more details.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""Parallel metadata scanner for backup directories.
+
+On NFS every listdir and lstat is a round trip to the server, so walking a
+backup directory one call after the other spends its time waiting. metascan
+keeps several calls in flight instead: a pool of worker threads lists the
+directories the caller is going to ask for next and lstat's their names in
+chunks, while the caller consumes the listings in its own order (List).
+Directories are read ahead both when the caller says it is going to list
+them (Prefetch) and when they are found in a listing read ahead (the caller
+tells which subdirectories it descends into). The number of calls in flight
+to one server is limited for the whole process (see ServerKey), so that a
+scan does not starve the backups, and the number of listings read ahead is
+bounded, which bounds memory.
+"""
+
+import collections
+import os
+import stat
+import threading
+
+MOUNTS_FILE = '/proc/mounts'
+# Default number of worker threads of a scanner.
+SCAN_WORKERS = 8
+# Names lstat'ed by one task.
+STAT_CHUNK = 32
+# Directory listings read ahead, per worker.
+AHEAD_FACTOR = 8
+
+# Server key => threading.Semaphore, see ServerSlots.
+_servers = {}
+_serverslock = threading.Lock()
+
+
+def MountSource(path, mountsfile=MOUNTS_FILE):
+  """Find the filesystem holding path, without accessing it.
+
+  Unlike df or os.statvfs, reading the mount table does not wait for an NFS
+  server.
+
+  Args:
+    path: String - Absolute path.
+    mountsfile: String - Mount table to read.
+
+  Returns:
+    Tuple - (device, mount point, filesystem type), None if the mount table
+      could not be read.
+  """
+
+  try:
+    mounts = file(mountsfile)
+    try:
+      lines = mounts.readlines()
+    finally:
+      mounts.close()
+  except IOError:
+    return None
+  path = os.path.normpath(path)
+  found = None
+  for line in lines:
+    fields = line.split()
+    if len(fields) < 3:
+      continue
+    # Spaces and tabs in mount points are escaped in octal.
+    mountpoint = fields[1].replace('\\040', ' ').replace('\\011', '\t')
+    if (path == mountpoint or mountpoint == '/' or
+        path.startswith(mountpoint + '/')):
+      if found is None or len(mountpoint) >= len(found[1]):
+        found = (fields[0], mountpoint, fields[2])
+  return found
+
+
+def ServerKey(path):
+  """Returns a key naming the server (or local device) holding path."""
+
+  source = MountSource(os.path.abspath(path))
+  if source is None:
+    return 'unknown'
+  device, mountpoint, fstype = source
+  if fstype.startswith('nfs') and ':' in device:
+    return 'nfs:' + device.split(':', 1)[0]
+  return 'local:' + device
+
+
+def ServerSlots(key, limit):
+  """Returns the semaphore limiting the calls in flight to a server.
+
+  Args:
+    key: String - See ServerKey.
+    limit: Integer - Calls in flight allowed, used by the first caller only.
+  """
+
+  _serverslock.acquire()
+  try:
+    try:
+      return _servers[key]
+    except KeyError:
+      slots = threading.Semaphore(limit)
+      _servers[key] = slots
+      return slots
+  finally:
+    _serverslock.release()
+
+
+class DirectoryListing:
+  """The names of one directory with their lstat results."""
+
+  def __init__(self, path):
+    """Initialise an empty listing.
+
+    Args:
+      path: String - Path of the directory, relative to the scanned root.
+    """
+
+    self.path = path
+    self.names = []
+    # lstat result, or the OSError raised, of each name.
+    self.stats = []
+    self.error = None
+    self.pending = 1
+    self.done = False
+
+  def Entries(self):
+    """Returns (name, lstat result or None, OSError or None) tuples."""
+
+    entries = []
+    for index in xrange(len(self.names)):
+      result = self.stats[index]
+      if isinstance(result, OSError):
+        entries.append((self.names[index], None, result))
+      else:
+        entries.append((self.names[index], result, None))
+    return entries
+
+
+def ChildPath(path, name):
+  """Returns the relative path of name in directory path ('' for the root)."""
+
+  if path:
+    return path + '/' + name
+  return name
+
+
+class MetadataScanner:
+  """Lists directories and lstat's their names with a pool of threads.
+
+  Paths are relative to the scanned root, '' being the root itself.
+  """
+
+  def __init__(self, root, loghandle, workers=SCAN_WORKERS, descend=None):
+    """Start the worker threads.
+
+    Args:
+      root: String - Directory being scanned.
+      loghandle: Object - Handle to the logging object.
+      workers: Integer - Number of worker threads, also the number of calls
+        in flight allowed to the server of root.
+      descend: Function - Called with (path, lstat result) of the
+        subdirectories found, returns True if the caller is going to list
+        them. None if subdirectories are not to be read ahead.
+    """
+
+    self.root = root
+    self.loghandle = loghandle
+    self.descend = descend
+    self.slots = ServerSlots(ServerKey(root), workers)
+    self.maxahead = workers * AHEAD_FACTOR
+    self.lock = threading.Condition()
+    # Listings read ahead and not consumed yet, path => DirectoryListing
+    self.listings = {}
+    # Pending lstat chunks are done first, so that started listings
+    # complete before more are started. Listings waited for are put in
+    # front of the read ahead ones.
+    self.stattasks = collections.deque()
+    self.listtasks = collections.deque()
+    self.stopped = False
+    self.workers = []
+    for number in xrange(workers):
+      worker = threading.Thread(target=self.Work,
+                                name='MetaScan-%d' % number)
+      worker.setDaemon(True)
+      worker.start()
+      self.workers.append(worker)
+
+  def Prefetch(self, path):
+    """Start reading a directory which is going to be listed.
+
+    Returns:
+      Boolean - False if enough listings are read ahead already.
+    """
+
+    self.lock.acquire()
+    try:
+      return self.ReadAhead(path)
+    finally:
+      self.lock.release()
+
+  def ReadAhead(self, path):
+    """See Prefetch. Called with the lock held."""
+
+    if path in self.listings:
+      return True
+    if self.stopped or len(self.listings) >= self.maxahead:
+      return False
+    listing = DirectoryListing(path)
+    self.listings[path] = listing
+    self.listtasks.append(listing)
+    self.lock.notifyAll()
+    return True
+
+  def List(self, path):
+    """Returns the listing of a directory, waiting for it if required.
+
+    Returns:
+      Object - DirectoryListing. Its error is the OSError raised by listdir,
+        if any.
+    """
+
+    self.lock.acquire()
+    try:
+      try:
+        listing = self.listings.pop(path)
+      except KeyError:
+        listing = DirectoryListing(path)
+        self.listtasks.appendleft(listing)
+        self.lock.notifyAll()
+      while not listing.done:
+        self.lock.wait()
+      return listing
+    finally:
+      self.lock.release()
+
+  def Stop(self):
+    """Make the worker threads exit, dropping the queued work."""
+
+    self.lock.acquire()
+    try:
+      self.stopped = True
+      self.listings = {}
+      self.stattasks.clear()
+      self.listtasks.clear()
+      self.lock.notifyAll()
+    finally:
+      self.lock.release()
+
+  def Work(self):
+    """Body of the worker threads."""
+
+    while True:
+      self.lock.acquire()
+      try:
+        while not (self.stopped or self.stattasks or self.listtasks):
+          self.lock.wait()
+        if self.stopped:
+          return
+        if self.stattasks:
+          task = self.stattasks.popleft()
+        else:
+          task = (self.listtasks.popleft(), None, None)
+      finally:
+        self.lock.release()
+      listing, start, end = task
+      if start is None:
+        self.ReadDirectory(listing)
+      else:
+        self.StatNames(listing, start, end)
+
+  def ReadDirectory(self, listing):
+    """List a directory and queue the lstat of its names."""
+
+    self.slots.acquire()
+    try:
+      try:
+        names = os.listdir(os.path.join(self.root, listing.path))
+      except OSError, e:
+        names = []
+        listing.error = e
+    finally:
+      self.slots.release()
+    self.lock.acquire()
+    try:
+      listing.names = names
+      listing.stats = [None] * len(names)
+      for start in xrange(0, len(names), STAT_CHUNK):
+        listing.pending += 1
+        self.stattasks.append((listing, start,
+                               min(start + STAT_CHUNK, len(names))))
+      self.lock.notifyAll()
+      self.Finished(listing)
+    finally:
+      self.lock.release()
+
+  def StatNames(self, listing, start, end):
+    """lstat the names of a listing from start to end."""
+
+    subdirs = []
+    for index in xrange(start, end):
+      path = ChildPath(listing.path, listing.names[index])
+      self.slots.acquire()
+      try:
+        try:
+          st = os.lstat(os.path.join(self.root, path))
+        except OSError, e:
+          st = e
+      finally:
+        self.slots.release()
+      listing.stats[index] = st
+      if (self.descend and not isinstance(st, OSError) and
+          stat.S_ISDIR(st.st_mode) and self.descend(path, st)):
+        subdirs.append(path)
+    self.lock.acquire()
+    try:
+      for path in subdirs:
+        if not self.ReadAhead(path):
+          break
+      self.Finished(listing)
+    finally:
+      self.lock.release()
+
+  def Finished(self, listing):
+    """A task of listing is done. Called with the lock held."""
+
+    listing.pending -= 1
+    if not listing.pending:
+      listing.done = True
+      self.lock.notifyAll()
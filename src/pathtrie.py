@@ -0,0 +1,346 @@
+#!/usr/bin/python2.4
+
+# Copyright 2008 Google Inc.
+# Author : Anoop Chandran <anoopj@google.com>
+#
+# openduckbill is a simple backup application. It offers support for
+# transferring data to a local backup directory, NFS. It also provides
+# file system monitoring of directories marked for backup. Please read
+# the README file for more details.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Path tries used to keep track of modified paths and route them to entries.
+
+pathtrie stores filesystem paths one component per node, so that adding a
+path, checking for a duplicate or finding a recorded parent directory costs
+a walk down the path (O(path depth)) instead of a scan of every path seen so
+far. Entry paths (from the entry section of the config file) are marked as
+roots in the trie; a recorded directory never hides a path which belongs to
+another entry below it.
+"""
+
+import os
+
+# Rough per object sizes (bytes) used to estimate memory usage without
+# walking the trie.
+NODE_OVERHEAD = 200
+ENTRY_OVERHEAD = 40
+
+
+def SplitPath(path):
+  """Splits an absolute path into its components.
+
+  Args:
+    path: String - Filesystem path, "/" separated.
+
+  Returns:
+    List - Path components, empty for "/".
+  """
+
+  return [part for part in path.split('/') if part]
+
+
+def JoinPath(parts):
+  """Inverse of SplitPath."""
+
+  return '/' + '/'.join(parts)
+
+
+class _PathNode(object):
+  """One component of a path stored in the trie."""
+
+  __slots__ = ('children', 'terminal', 'root')
+
+  def __init__(self):
+    self.children = {}
+    self.terminal = False
+    self.root = False
+
+
+class ChangedPathSet:
+  """Set of modified directory paths which folds paths into their parents.
+
+  A recorded path covers every path below it, as long as both belong to the
+  same entry. Adding a path which is already covered is a no-op, and
+  recording a directory drops the paths already recorded below it. The
+  set therefore always holds the minimal list of directories which need to
+  be synced.
+  """
+
+  def __init__(self, roots=None):
+    """Initialise an empty set.
+
+    Args:
+      roots: List - Entry paths. Folding never crosses an entry path, so a
+        modified parent directory of one entry does not swallow changes made
+        in another entry.
+    """
+
+    if roots:
+      self.roots = list(roots)
+    else:
+      self.roots = []
+    self.Clear()
+
+  def __len__(self):
+    return self.count
+
+  def __contains__(self, path):
+    return self.IsCovered(path)
+
+  def Clear(self):
+    """Forget all recorded paths, keeping the entry roots."""
+
+    self.tree = _PathNode()
+    self.seen = set()
+    self.count = 0
+    self.added = 0
+    self.nodes = 1
+    self.keybytes = 0
+    self.seenbytes = 0
+    for path in self.roots:
+      node = self.tree
+      for part in SplitPath(path):
+        node = self._Child(node, part)
+      node.root = True
+
+  def _Child(self, node, part):
+    """Returns child node named part, creating it if required."""
+
+    try:
+      return node.children[part]
+    except KeyError:
+      child = _PathNode()
+      node.children[part] = child
+      self.nodes += 1
+      self.keybytes += len(part)
+      return child
+
+  def Add(self, path):
+    """Record a modified path.
+
+    Args:
+      path: String - Absolute path of the modified directory.
+
+    Returns:
+      Boolean - True if path was recorded, False if it was already covered
+        by a recorded path.
+    """
+
+    self.added += 1
+    if path in self.seen:
+      return False
+    self.seen.add(path)
+    self.seenbytes += len(path)
+    node = self.tree
+    covered = node.terminal
+    for part in SplitPath(path):
+      child = node.children.get(part)
+      if child is None:
+        if covered:
+          return False
+        child = self._Child(node, part)
+      node = child
+      if node.root:
+        # A new entry starts here, parents of the entry do not cover it.
+        covered = node.terminal
+      elif node.terminal:
+        covered = True
+    if covered:
+      return False
+    node.terminal = True
+    self.count += 1
+    self._Prune(node)
+    return True
+
+  def _Prune(self, node):
+    """Drop recorded paths below node, stopping at entry roots.
+
+    Args:
+      node: Object - Trie node which has just been recorded.
+
+    Returns:
+      Boolean - True if node still has children (leading to entry roots).
+    """
+
+    for part, child in node.children.items():
+      if child.root:
+        continue
+      if child.terminal:
+        child.terminal = False
+        self.count -= 1
+      if not self._Prune(child):
+        del node.children[part]
+        self.nodes -= 1
+        self.keybytes -= len(part)
+    return bool(node.children)
+
+  def IsCovered(self, path):
+    """Checks whether path, or a parent directory of it, has been recorded.
+
+    Args:
+      path: String - Absolute path.
+
+    Returns:
+      Boolean - True if a backup of the recorded paths includes path.
+    """
+
+    node = self.tree
+    covered = node.terminal
+    for part in SplitPath(path):
+      try:
+        node = node.children[part]
+      except KeyError:
+        return covered
+      if node.root:
+        covered = node.terminal
+      elif node.terminal:
+        covered = True
+    return covered
+
+  def CoveringPaths(self):
+    """Returns the minimal sorted list of directories covering all changes."""
+
+    paths = []
+    stack = [(self.tree, [])]
+    while stack:
+      node, parts = stack.pop()
+      if node.terminal:
+        paths.append(JoinPath(parts))
+      for part, child in node.children.iteritems():
+        stack.append((child, parts + [part]))
+    paths.sort()
+    return paths
+
+  def MemoryUsage(self):
+    """Returns an estimate (bytes) of the memory held by the set."""
+
+    return (self.nodes * NODE_OVERHEAD + self.keybytes +
+            len(self.seen) * ENTRY_OVERHEAD + self.seenbytes)
+
+  def Stats(self):
+    """Returns a dictionary of counters, for debug messages."""
+
+    return {'paths': self.count,
+            'added': self.added,
+            'distinct': len(self.seen),
+            'nodes': self.nodes,
+            'memory': self.MemoryUsage()}
+
+
+class _EntryNode(object):
+  """One component of an entry path stored in the router."""
+
+  __slots__ = ('children', 'index')
+
+  def __init__(self):
+    self.children = {}
+    self.index = None
+
+
+class EntryRouter:
+  """Maps modified paths to the entry which backs them up.
+
+  The router is built once from the entry list. Looking up a path walks the
+  trie of entry paths (O(path depth)) and returns the deepest entry whose
+  scope includes the path:
+    - recursive entry: the entry path and everything below it
+    - non-recursive entry: the entry path and its direct children
+    - file entry: the file itself
+  """
+
+  def __init__(self, entrylist):
+    """Build the router.
+
+    Args:
+      entrylist: List - List of entries. Each entry is a dictionary.
+    """
+
+    self.entrylist = entrylist
+    self.tree = _EntryNode()
+    # Number of path components below the entry path which are still part
+    # of the entry, None if unlimited.
+    self.scope = []
+    for index in xrange(len(entrylist)):
+      entry = entrylist[index]
+      node = self.tree
+      for part in SplitPath(entry['path']):
+        try:
+          node = node.children[part]
+        except KeyError:
+          child = _EntryNode()
+          node.children[part] = child
+          node = child
+      node.index = index
+      if entry['recursive']:
+        self.scope.append(None)
+      elif os.path.isdir(entry['path']):
+        self.scope.append(1)
+      else:
+        self.scope.append(0)
+
+  def RouteIndex(self, path):
+    """Returns the position in entrylist of the entry owning path, or None."""
+
+    node = self.tree
+    found = None
+    parts = SplitPath(path)
+    depth = len(parts)
+    level = 0
+    while True:
+      if node.index is not None:
+        scope = self.scope[node.index]
+        if scope is None or depth - level <= scope:
+          found = node.index
+      if level == depth:
+        break
+      try:
+        node = node.children[parts[level]]
+      except KeyError:
+        break
+      level += 1
+    return found
+
+  def Route(self, path):
+    """Returns the entry owning path, or None if no entry backs it up."""
+
+    index = self.RouteIndex(path)
+    if index is None:
+      return None
+    return self.entrylist[index]
+
+  def RouteAll(self, pathslist):
+    """Groups paths by owning entry.
+
+    Args:
+      pathslist: List - Modified paths.
+
+    Returns:
+      List - (entry, paths) tuples, in the order of entrylist. Paths not
+        backed up by any entry are left out.
+    """
+
+    grouped = {}
+    for path in pathslist:
+      index = self.RouteIndex(path)
+      if index is not None:
+        try:
+          grouped[index].append(path)
+        except KeyError:
+          grouped[index] = [path]
+    indexes = grouped.keys()
+    indexes.sort()
+    return [(self.entrylist[index], grouped[index]) for index in indexes]
@@ -0,0 +1,421 @@
+#!/usr/bin/python2.4
+
+# Copyright 2008 Google Inc.
+# Author : Anoop Chandran <anoopj@google.com>
+#
+# openduckbill is a simple backup application. It offers support for
+# transferring data to a local backup directory, NFS. It also provides
+# file system monitoring of directories marked for backup. Please read
+# the README file for more details.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""Crash-safe log of the changes waiting to be backed up.
+
+Pending changes are kept in memory (journal.EntryChanges) until they are
+flushed, and would be lost if the daemon is killed (SIGKILL, out of memory,
+power loss). pendinglog appends every change to ~/.openduckbill/pending.log
+before it can be lost, and marks it done once the backup of its entry
+succeeded. At startup the changes which were not done are read back and
+backed up again.
+
+The log is append only. Records are buffered and written with one fsync per
+COMMIT_DELAY seconds at most (group commit), from a worker thread, so that a
+burst of filesystem events costs one disk flush. Every write is a block of
+records with its length and checksum; a block torn by a crash is ignored.
+Once nothing is pending the log is truncated, and it is rewritten with only
+the pending records when it grows beyond COMPACT_SIZE bytes.
+"""
+
+import marshal
+import os
+import struct
+import threading
+import zlib
+
+import journal
+
+LOG_FILE = '~/.openduckbill/pending.log'
+# Seconds records are buffered before being written.
+COMMIT_DELAY = 1
+# Size (bytes) above which the log is compacted.
+COMPACT_SIZE = 4 * 1024 * 1024
+
+# Record types:
+#   (REC_EVENT, entry name, event mask, path, name) - a change
+#   (REC_TAKEN, entry name, id) - the changes so far are being backed up
+#   (REC_DONE, entry name, id) - the backup of the changes taken as id
+#     succeeded
+REC_EVENT = 'e'
+REC_TAKEN = 't'
+REC_DONE = 'd'
+
+# Block header: length and CRC-32 of the marshalled records.
+_HEADER = '>II'
+_HEADER_SIZE = struct.calcsize(_HEADER)
+
+
+def RescanRecords(result):
+  """Returns the (mask, path, name) changes of a rescan.RescanResult.
+
+  Mirrors journal.EntryChanges.RecordRescan.
+  """
+
+  if not result.complete:
+    return [(journal.LISTING_CHANGED, result.entry['path'], '')]
+  changes = []
+  for pathname in result.files:
+    changes.append((journal.IN_MODIFY, os.path.dirname(pathname),
+                    os.path.basename(pathname)))
+  for dirpath in result.dirs:
+    changes.append((journal.LISTING_CHANGED, dirpath, ''))
+  return changes
+
+
+def EncodeBlock(records):
+  """Returns the log block holding records."""
+
+  data = marshal.dumps(records)
+  return struct.pack(_HEADER, len(data), zlib.crc32(data) & 0xffffffff) + data
+
+
+def ReadBlocks(logfile):
+  """Yields the record lists of the complete blocks of an open log file."""
+
+  while True:
+    header = logfile.read(_HEADER_SIZE)
+    if len(header) < _HEADER_SIZE:
+      return
+    length, crc = struct.unpack(_HEADER, header)
+    data = logfile.read(length)
+    if len(data) < length or zlib.crc32(data) & 0xffffffff != crc:
+      return
+    try:
+      records = marshal.loads(data)
+    except (EOFError, ValueError, TypeError):
+      return
+    if not isinstance(records, list):
+      return
+    yield records
+
+
+def ReadLog(filename=LOG_FILE):
+  """Read back the changes which are not done.
+
+  Args:
+    filename: String - Path of the log.
+
+  Returns:
+    pending: Dictionary - entry name => list of (mask, path, name) changes,
+      oldest first.
+  """
+
+  current, taken = ReadRecords(filename)
+  pending = {}
+  for entryname, segments in taken.iteritems():
+    ids = segments.keys()
+    ids.sort()
+    for takenid in ids:
+      pending.setdefault(entryname, []).extend(segments[takenid])
+  for entryname, changes in current.iteritems():
+    pending.setdefault(entryname, []).extend(changes)
+  return pending
+
+
+def ReadRecords(filename):
+  """Read the changes of a log which are not done.
+
+  Returns:
+    Tuple - (entry name => changes not taken yet, entry name => {id: changes
+      taken as id and not done}).
+  """
+
+  current = {}
+  taken = {}
+  try:
+    logfile = file(os.path.expanduser(filename), 'rb')
+  except IOError:
+    return current, taken
+  try:
+    for records in ReadBlocks(logfile):
+      for record in records:
+        if record[0] == REC_EVENT:
+          try:
+            current[record[1]].append(record[2:])
+          except KeyError:
+            current[record[1]] = [record[2:]]
+        elif record[0] == REC_TAKEN:
+          changes = current.pop(record[1], None)
+          if changes:
+            taken.setdefault(record[1], {})[record[2]] = changes
+        elif record[0] == REC_DONE:
+          try:
+            del taken[record[1]][record[2]]
+          except KeyError:
+            pass
+  finally:
+    logfile.close()
+  return current, taken
+
+
+def EventRecords(entryname, changes):
+  """Returns the REC_EVENT records of (mask, path, name) changes."""
+
+  return [(REC_EVENT, entryname, mask, path, name)
+          for mask, path, name in changes]
+
+
+class PendingLog:
+  """Appends the pending changes to the log, from the event loop."""
+
+  def __init__(self, loop, loghandle, filename=LOG_FILE,
+               commitdelay=COMMIT_DELAY, compactsize=COMPACT_SIZE):
+    """Initialise the log, see Start.
+
+    Args:
+      loop: Object - eventloop.EventLoop.
+      loghandle: Object - Handle to the logging object.
+      filename: String - Path of the log.
+      commitdelay: Integer - Seconds records are buffered.
+      compactsize: Integer - Size (bytes) above which the log is compacted.
+    """
+
+    self.loop = loop
+    self.loghandle = loghandle
+    self.filename = os.path.expanduser(filename)
+    self.commitdelay = commitdelay
+    self.compactsize = compactsize
+    self.fd = None
+    # Serialises file access between the worker thread and Close.
+    self.filelock = threading.Lock()
+    self.buffer = []
+    self.timer = None
+    self.committing = False
+    self.size = 0
+    self.nextid = 1
+    # Entry names with changes not taken yet.
+    self.current = set()
+    # Entry name => set of ids taken and not done.
+    self.outstanding = {}
+
+  def Start(self, pending):
+    """Replace the log with the given pending changes and open it.
+
+    Args:
+      pending: Dictionary - entry name => list of (mask, path, name)
+        changes, see ReadLog.
+
+    Returns:
+      Boolean - True on success, False if the log can not be written (the
+        changes are then not logged).
+    """
+
+    records = []
+    for entryname, changes in pending.iteritems():
+      self.current.add(entryname)
+      records.extend(EventRecords(entryname, changes))
+    data = ''
+    if records:
+      data = EncodeBlock(records)
+    logdir = os.path.dirname(self.filename)
+    tmpname = self.filename + '.tmp'
+    try:
+      if not os.path.isdir(logdir):
+        os.makedirs(logdir, 0700)
+      self.WriteFile(tmpname, data)
+      os.rename(tmpname, self.filename)
+      self.fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND)
+    except (IOError, OSError), e:
+      self.loghandle.logger.error('Pending change log %s: %s', self.filename,
+                                  e)
+      return False
+    self.size = len(data)
+    return True
+
+  def LogEvent(self, entryname, mask, path, name):
+    """Append a change of an entry."""
+
+    if self.fd is None:
+      return
+    self.current.add(entryname)
+    self.Append((REC_EVENT, entryname, mask, path, name))
+
+  def Taken(self, entryname):
+    """The changes of an entry so far are about to be backed up.
+
+    Returns:
+      takenid: Integer - To be passed to Done, None if nothing was logged.
+    """
+
+    if self.fd is None or entryname not in self.current:
+      return None
+    self.current.discard(entryname)
+    takenid = self.nextid
+    self.nextid += 1
+    self.outstanding.setdefault(entryname, set()).add(takenid)
+    self.Append((REC_TAKEN, entryname, takenid))
+    return takenid
+
+  def Done(self, entryname, takenid):
+    """The changes taken as takenid have been backed up."""
+
+    if self.fd is None or takenid is None:
+      return
+    try:
+      self.outstanding[entryname].discard(takenid)
+      if not self.outstanding[entryname]:
+        del self.outstanding[entryname]
+    except KeyError:
+      pass
+    self.Append((REC_DONE, entryname, takenid))
+
+  def HasPending(self):
+    """Returns True if some logged changes are not done."""
+
+    return bool(self.current or self.outstanding)
+
+  def Append(self, record):
+    self.buffer.append(record)
+    if self.timer is None and not self.committing:
+      self.timer = self.loop.CallLater(self.commitdelay, self.Commit)
+
+  def Commit(self):
+    """Timer callback, write the buffered records in a worker thread."""
+
+    self.timer = None
+    if not self.buffer or self.fd is None:
+      return
+    data = EncodeBlock(self.buffer)
+    self.buffer = []
+    self.size += len(data)
+    if not self.HasPending():
+      compact = 'truncate'
+      self.size = 0
+    elif self.size > self.compactsize:
+      compact = 'rewrite'
+    else:
+      compact = None
+    self.committing = True
+    self.loop.RunInThread(self.WriteBlock, (data, compact), self.Committed)
+
+  def Committed(self, size, error):
+    """The records have been written, write what came in meanwhile."""
+
+    self.committing = False
+    if error is not None:
+      self.loghandle.logger.error('Failed to write pending change log: %s',
+                                  error)
+    elif size is not None:
+      self.size = size
+    if self.buffer and self.timer is None:
+      self.timer = self.loop.CallLater(self.commitdelay, self.Commit)
+
+  def WriteBlock(self, data, compact):
+    """Append a block and flush it to disk. Runs in a worker thread.
+
+    Args:
+      data: String - Encoded block.
+      compact: String - 'truncate' to empty the log afterwards (nothing is
+        pending), 'rewrite' to compact it, or None.
+
+    Returns:
+      size: Integer - Size of the log after compaction, None if unchanged.
+    """
+
+    self.filelock.acquire()
+    try:
+      if self.fd is None:
+        return None
+      if compact == 'truncate':
+        # The block only completes changes, none of it has to be kept.
+        os.ftruncate(self.fd, 0)
+        os.fsync(self.fd)
+        return 0
+      self.WriteAll(self.fd, data)
+      os.fsync(self.fd)
+      if compact == 'rewrite':
+        return self.Rewrite()
+      return None
+    finally:
+      self.filelock.release()
+
+  def Rewrite(self):
+    """Replace the log with its pending records. Called with filelock held.
+
+    Changes being backed up keep their REC_TAKEN record, for the REC_DONE
+    record to come.
+
+    Returns:
+      Integer - New size of the log.
+    """
+
+    current, taken = ReadRecords(self.filename)
+    records = []
+    for entryname, segments in taken.iteritems():
+      for takenid, changes in segments.iteritems():
+        records.extend(EventRecords(entryname, changes))
+        records.append((REC_TAKEN, entryname, takenid))
+    for entryname, changes in current.iteritems():
+      records.extend(EventRecords(entryname, changes))
+    data = ''
+    if records:
+      data = EncodeBlock(records)
+    tmpname = self.filename + '.tmp'
+    self.WriteFile(tmpname, data)
+    os.rename(tmpname, self.filename)
+    os.close(self.fd)
+    self.fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND)
+    return len(data)
+
+  def WriteFile(self, filename, data):
+    """Create filename with data, flushed to disk."""
+
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    try:
+      self.WriteAll(fd, data)
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+
+  def WriteAll(self, fd, data):
+    while data:
+      written = os.write(fd, data)
+      data = data[written:]
+
+  def Close(self):
+    """Write the buffered records and close the log. Blocking."""
+
+    if self.timer:
+      self.timer.Cancel()
+      self.timer = None
+    self.filelock.acquire()
+    try:
+      if self.fd is None:
+        return
+      try:
+        if not self.HasPending():
+          os.ftruncate(self.fd, 0)
+        elif self.buffer:
+          self.WriteAll(self.fd, EncodeBlock(self.buffer))
+        os.fsync(self.fd)
+        os.close(self.fd)
+      except OSError, e:
+        self.loghandle.logger.error('Failed to write pending change log: %s',
+                                    e)
+      self.buffer = []
+      self.fd = None
+    finally:
+      self.filelock.release()
@@ -0,0 +1,277 @@
+#!/usr/bin/python2.4
+
+# Copyright 2008 Google Inc.
+# Author : Anoop Chandran <anoopj@google.com>
+#
+# openduckbill is a simple backup application. It offers support for
+# transferring data to a local backup directory, NFS. It also provides
+# file system monitoring of directories marked for backup. Please read
+# the README file for more details.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Decides how the changes of an entry are transferred.
+
+planner looks at the net changes (journal) and the modified directories
+(pathtrie) of every entry and picks one of three transfer modes:
+  - MODE_LIST: pass the exact changed paths to rsync (--files-from)
+  - MODE_ROOTS: sync a few subtree roots recursively
+  - MODE_FULL: sync the whole entry
+The exact list is used whenever it is small enough and rsync can express
+every change in it (not the case for directories rescanned after lost
+events, whose removed children are unknown). Otherwise the subtree roots
+are compared to the whole entry using the (cached) number of files below
+them.
+"""
+
+import os
+import time
+
+import journal
+import pathtrie
+
+MODE_LIST = 'list'
+MODE_ROOTS = 'roots'
+MODE_FULL = 'full'
+
+# Largest number of paths passed to rsync in a file list.
+MAX_LIST_PATHS = 1024
+# Largest number of subtree roots passed to one rsync.
+MAX_ROOTS = 8
+# Tree sizes are counted up to this many files/directories.
+MAX_TREE_COUNT = 100000
+# Seconds for which a counted tree size is reused.
+TREE_COUNT_TTL = 3600
+
+
+class TransferPlan:
+  """How the changes of one entry are to be transferred."""
+
+  def __init__(self, entry, mode, sources=None, filelist=None, deletes=0):
+    """Initialise the plan.
+
+    Args:
+      entry: Dictionary - The entry.
+      mode: String - MODE_LIST, MODE_ROOTS or MODE_FULL.
+      sources: List - Subtree roots (MODE_ROOTS).
+      filelist: List - Exact paths to transfer (MODE_LIST).
+      deletes: Integer - Number of deleted paths in filelist.
+    """
+
+    self.entry = entry
+    self.mode = mode
+    self.sources = sources
+    self.filelist = filelist
+    self.deletes = deletes
+
+
+class TransferPlanner:
+  """Chooses a transfer mode for each modified entry."""
+
+  def __init__(self, loghandle, deletemissing=False,
+               maxlistpaths=MAX_LIST_PATHS, maxroots=MAX_ROOTS):
+    """Initialise the planner.
+
+    Args:
+      loghandle: Object - Handle to the logging object.
+      deletemissing: Boolean - True if rsync supports --delete-missing-args,
+        which lets a file list carry deleted paths.
+      maxlistpaths: Integer - Largest file list.
+      maxroots: Integer - Largest number of subtree roots.
+    """
+
+    self.loghandle = loghandle
+    self.deletemissing = deletemissing
+    self.maxlistpaths = maxlistpaths
+    self.maxroots = maxroots
+    self.treecounts = {}
+
+  def Plan(self, router, changes, pathslist):
+    """Plan the transfer of every entry with net changes.
+
+    Args:
+      router: Object - pathtrie.EntryRouter.
+      changes: Dictionary - Net changes, see journal.ChangeJournal.NetChanges
+      pathslist: List - Modified directories (pathtrie.ChangedPathSet).
+
+    Returns:
+      List - TransferPlan objects, in entry list order.
+    """
+
+    covering = {}
+    for entry, paths in router.RouteAll(pathslist):
+      covering[entry['name']] = paths
+    plans = []
+    for entry, names in router.RouteAll(changes.keys()):
+      entrychanges = {}
+      for name in names:
+        entrychanges[name] = changes[name]
+      plans.append(self.PlanEntry(entry, entrychanges,
+                                  covering.get(entry['name'], [])))
+    return plans
+
+  def PlanEntry(self, entry, changes, covering):
+    """Choose the transfer mode of one entry.
+
+    Args:
+      entry: Dictionary - The entry.
+      changes: Dictionary - Net changes of the entry.
+      covering: List - Modified directories of the entry.
+
+    Returns:
+      plan: Object - TransferPlan
+    """
+
+    filelist = self.BuildFileList(entry, changes)
+    if filelist is not None:
+      plan = TransferPlan(entry, MODE_LIST, filelist=filelist[0],
+                          deletes=filelist[1])
+    elif not entry['recursive']:
+      # A non-recursive entry is a single directory listing.
+      plan = TransferPlan(entry, MODE_FULL)
+    else:
+      roots = self.CoarsenRoots(entry, covering)
+      if not roots or roots == [entry['path']]:
+        plan = TransferPlan(entry, MODE_FULL)
+      else:
+        fullcost = self.CountTree(entry['path'])
+        rootscost = 0
+        for root in roots:
+          rootscost += self.CountTree(root)
+        self.loghandle.logger.debug('Entry %s: %s roots cost %s, full cost %s',
+                                    entry['name'], len(roots), rootscost,
+                                    fullcost)
+        if rootscost * 2 <= fullcost:
+          plan = TransferPlan(entry, MODE_ROOTS, sources=roots)
+        else:
+          plan = TransferPlan(entry, MODE_FULL)
+    self.loghandle.logger.debug('Entry %s: %s net changes, transfer mode %s',
+                                entry['name'], len(changes), plan.mode)
+    return plan
+
+  def BuildFileList(self, entry, changes):
+    """Build the exact list of paths to transfer.
+
+    New directories of recursive entries are expanded, since their contents
+    may have been created before the directory was watched. Deleted paths
+    are left out when the destination keeps them anyway (maintainprevious
+    without the version store), as the other modes do.
+
+    Args:
+      entry: Dictionary - The entry.
+      changes: Dictionary - Net changes of the entry.
+
+    Returns:
+      Tuple - (sorted list of paths, number of deleted paths), or None if
+        the changes can not be sent as a file list.
+    """
+
+    if len(changes) > self.maxlistpaths:
+      return None
+    keepdeleted = (self.loghandle.maintainprevious and
+                   not self.loghandle.versionstore)
+    paths = []
+    deletes = 0
+    for pathname, (operation, isdir) in changes.iteritems():
+      if operation == journal.OP_SYNCDIR:
+        # Removed names are unknown, needs a recursive sync with --delete.
+        return None
+      if operation == journal.OP_DELETE:
+        if keepdeleted:
+          continue
+        if not self.deletemissing:
+          return None
+        deletes += 1
+      elif (isdir and entry['recursive'] and
+            operation in (journal.OP_CREATE, journal.OP_UPDATE)):
+        if not self.ExpandDirectory(pathname, paths):
+          return None
+      paths.append(pathname)
+      if len(paths) > self.maxlistpaths:
+        return None
+    paths.sort()
+    return paths, deletes
+
+  def ExpandDirectory(self, dirpath, paths):
+    """Append everything below dirpath to paths.
+
+    Args:
+      dirpath: String - Directory path.
+      paths: List - Paths collected so far.
+
+    Returns:
+      Boolean - False if the file list grew too large.
+    """
+
+    for root, dirs, files in os.walk(dirpath):
+      for name in dirs + files:
+        paths.append(os.path.join(root, name))
+      if len(paths) > self.maxlistpaths:
+        return False
+    return True
+
+  def CoarsenRoots(self, entry, covering):
+    """Reduce the modified directories of an entry to at most maxroots.
+
+    The deepest directories are replaced by their parent directory (never
+    going above the entry path) until few enough remain.
+
+    Args:
+      entry: Dictionary - The entry.
+      covering: List - Modified directories of the entry.
+
+    Returns:
+      List - Sorted subtree roots.
+    """
+
+    roots = covering
+    while len(roots) > self.maxroots:
+      deepest = 0
+      for root in roots:
+        deepest = max(deepest, len(pathtrie.SplitPath(root)))
+      folded = pathtrie.ChangedPathSet()
+      for root in roots:
+        if len(pathtrie.SplitPath(root)) == deepest and root != entry['path']:
+          root = os.path.dirname(root)
+        folded.Add(root)
+      roots = folded.CoveringPaths()
+    return roots
+
+  def CountTree(self, path):
+    """Count files/directories below path, up to MAX_TREE_COUNT.
+
+    Counts are cached for TREE_COUNT_TTL seconds.
+
+    Args:
+      path: String - Directory path.
+
+    Returns:
+      count: Integer - Number of files and directories.
+    """
+
+    now = time.time()
+    try:
+      counted, count = self.treecounts[path]
+      if now - counted < TREE_COUNT_TTL:
+        return count
+    except KeyError:
+      pass
+    count = 0
+    for root, dirs, files in os.walk(path):
+      count += len(dirs) + len(files)
+      if count >= MAX_TREE_COUNT:
+        break
+    self.treecounts[path] = (now, count)
+    return count
@@ -0,0 +1,249 @@
+#!/usr/bin/python2.4
+
+# Copyright 2008 Google Inc.
+# Author : Anoop Chandran <anoopj@google.com>
+#
+# openduckbill is a simple backup application. It offers support for
+# transferring data to a local backup directory, NFS. It also provides
+# file system monitoring of directories marked for backup. Please read
+# the README file for more details.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Finds changes by scanning entries instead of waiting for events.
+
+Used in two cases:
+  - When the kernel inotify queue overflows (IN_Q_OVERFLOW), events are
+    dropped and nothing tells which files changed.
+  - Entries with more directories than inotify watches available are not
+    watched at all, but polled (see PollSchedule).
+rescan walks the entry and compares the inode times of every file and
+directory with the time the entry was last flushed (or polled):
+  - a file with a newer mtime/ctime was modified (or created)
+  - a directory with a newer mtime/ctime had names added or removed, so its
+    listing has to be synced with deletion at the destination
+The scan stops as soon as the entry has more changes than can be listed;
+the whole entry is synced then, which is what rsync would have to do anyway.
+"""
+
+import os
+import stat
+import time
+
+import planner
+
+# Seconds subtracted from the last flush time, to cover events which were
+# still queued in the kernel when the changes were taken and coarse inode
+# time granularity.
+RESCAN_SLACK = 5
+# A polled entry is never scanned more than one tenth of the time.
+POLL_DUTY_FACTOR = 10
+# Maximum polling interval, as a multiple of the minimum one.
+POLL_MAX_FACTOR = 16
+
+
+def CountDirectories(path, limit):
+  """Count the directories below path (path included), up to limit + 1.
+
+  Args:
+    path: String - Directory path.
+    limit: Integer - Counting stops once above limit.
+
+  Returns:
+    count: Integer - Number of directories, limit + 1 if there are more.
+  """
+
+  count = 0
+  for root, dirs, files in os.walk(path):
+    count += 1
+    if count > limit:
+      break
+  return count
+
+
+class PollSchedule:
+  """Adaptive polling interval of one polled entry.
+
+  The interval is halved (down to mininterval) after a scan which found
+  changes, and doubled (up to POLL_MAX_FACTOR * mininterval) after a scan
+  which found none, so that cold trees are rarely scanned. It is also kept
+  above POLL_DUTY_FACTOR times the duration of the last scan.
+  """
+
+  def __init__(self, entry, mininterval, since):
+    """Initialise the schedule.
+
+    Args:
+      entry: Dictionary - The entry.
+      mininterval: Integer - Shortest interval (seconds).
+      since: Float - Time since which changes are to be found.
+    """
+
+    self.entry = entry
+    self.mininterval = mininterval
+    self.maxinterval = mininterval * POLL_MAX_FACTOR
+    self.interval = mininterval
+    self.since = since
+    self.scanstart = None
+
+  def Started(self):
+    """A scan starts, returns the time since which to look for changes."""
+
+    self.scanstart = time.time()
+    return self.since
+
+  def Finished(self, result):
+    """A scan finished, adapt the interval.
+
+    Args:
+      result: Object - RescanResult, None if the scan failed.
+
+    Returns:
+      interval: Float - Seconds until the next scan.
+    """
+
+    duration = time.time() - self.scanstart
+    if result is not None:
+      # Changes made during the scan are found by the next one.
+      self.since = self.scanstart
+      if len(result) or not result.complete:
+        self.interval = max(self.mininterval, self.interval / 2)
+      else:
+        self.interval = min(self.maxinterval, self.interval * 2)
+    self.interval = max(self.interval, duration * POLL_DUTY_FACTOR)
+    return self.interval
+
+
+class RescanResult:
+  """Changes found in one entry."""
+
+  def __init__(self, entry):
+    """Initialise an empty result.
+
+    Args:
+      entry: Dictionary - The entry.
+    """
+
+    self.entry = entry
+    self.files = []
+    self.dirs = []
+    self.complete = True
+    self.scanned = 0
+
+  def __len__(self):
+    return len(self.files) + len(self.dirs)
+
+
+class TreeRescanner:
+  """Finds the files and directories of entries changed since a given time."""
+
+  def __init__(self, loghandle, maxchanges=planner.MAX_LIST_PATHS):
+    """Initialise the rescanner.
+
+    Args:
+      loghandle: Object - Handle to the logging object.
+      maxchanges: Integer - Largest number of changes collected per entry,
+        the entry is synced as a whole beyond that.
+    """
+
+    self.loghandle = loghandle
+    self.maxchanges = maxchanges
+
+  def ScanEntries(self, entries, sinces):
+    """Rescan entries. Blocking, meant to run in a worker thread.
+
+    Args:
+      entries: List - Entries to scan.
+      sinces: List - For each entry, time of the last flush.
+
+    Returns:
+      List - RescanResult objects, one per entry.
+    """
+
+    results = []
+    for index in xrange(len(entries)):
+      results.append(self.ScanEntry(entries[index], sinces[index]))
+    return results
+
+  def ScanEntry(self, entry, since):
+    """Find the changes made in an entry after time since.
+
+    Args:
+      entry: Dictionary - The entry.
+      since: Float - Time of the last flush of the entry.
+
+    Returns:
+      result: Object - RescanResult
+    """
+
+    result = RescanResult(entry)
+    since -= RESCAN_SLACK
+    try:
+      rootstat = os.lstat(entry['path'])
+    except OSError, e:
+      self.loghandle.logger.warning('Rescan of %s: %s', entry['name'], e)
+      return result
+    if not stat.S_ISDIR(rootstat.st_mode):
+      result.scanned = 1
+      if self.IsNewer(rootstat, since):
+        result.files.append(entry['path'])
+      return result
+    stack = [(entry['path'], rootstat)]
+    while stack:
+      dirpath, dirstat = stack.pop()
+      result.scanned += 1
+      if self.IsNewer(dirstat, since):
+        result.dirs.append(dirpath)
+      try:
+        names = os.listdir(dirpath)
+      except OSError, e:
+        # Removed meanwhile, or not readable.
+        self.loghandle.logger.debug('Rescan: %s', e)
+        continue
+      for name in names:
+        pathname = os.path.join(dirpath, name)
+        try:
+          st = os.lstat(pathname)
+        except OSError:
+          continue
+        if stat.S_ISDIR(st.st_mode):
+          if entry['recursive']:
+            stack.append((pathname, st))
+          elif self.IsNewer(st, since):
+            # Only the directory itself belongs to a non-recursive entry.
+            result.files.append(pathname)
+        else:
+          result.scanned += 1
+          if self.IsNewer(st, since):
+            result.files.append(pathname)
+      if len(result) > self.maxchanges:
+        result.complete = False
+        result.files = []
+        result.dirs = []
+        break
+    if result.complete:
+      self.loghandle.logger.debug('Rescan of %s: %s inodes, %s files and %s'
+                                  ' directories changed', entry['name'],
+                                  result.scanned, len(result.files),
+                                  len(result.dirs))
+    else:
+      self.loghandle.logger.debug('Rescan of %s: more than %s changes, full'
+                                  ' sync', entry['name'], self.maxchanges)
+    return result
+
+  def IsNewer(self, st, since):
+    """Checks whether an inode changed after time since."""
+
+    return st.st_mtime >= since or st.st_ctime >= since
@@ -0,0 +1,956 @@
+#!/usr/bin/python2.4
+
+# Copyright 2008 Google Inc.
+# Author : Anoop Chandran <anoopj@google.com>
+#
+# openduckbill is a simple backup application. It offers support for
+# transferring data to a local backup directory, NFS. It also provides
+# file system monitoring of directories marked for backup. Please read
+# the README file for more details.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""Restores backed up files, optionally as they were at a given time.
+
+restore is the command line restore tool, installed as openduckbill-restore:
+
+  openduckbill-restore [options] <path or pattern> ...
+
+Paths are the source paths which were backed up (eg. /home/odbuser/Documents).
+In patterns, "*", "?" and "[...]" match within one path component and "**"
+matches any number of components. A matched directory is restored with
+everything below it. Files are restored to their original place, or below
+the directory given with -d.
+
+Finding what to restore does not walk the backup directory: an index of the
+backup tree (the listing of every directory, see TreeIndex) is kept in
+~/.openduckbill/restore. When it is loaded, only the directories whose ctime
+changed are listed again. The ctime of a directory changes whenever a name
+in it is created, replaced (backups write a temporary file and rename it)
+or removed, and rsync cannot set it back as it does the mtime. Directories
+are stat'ed and listed by several threads, which matters most over NFS.
+When restoring from the backup directory, the index the daemon keeps of it
+(see destindex) tells which directories had nothing backed up or removed in
+them since the last update, and those are not even stat'ed. Changes made
+by hand in the backup directory, or by the daemon in the last minute, are
+not seen then: -r reads everything again.
+
+Older versions:
+  - -t <time> restores what was backed up at that time. With the version
+    store (see versionstore), a file is restored from the first version
+    displaced after that time, or from the backup directory if it did not
+    change since. Files modified after that time (by their mtime) did not
+    exist then and are left out. Without it, the newest snapshot taken at
+    or before that time (see snapshot) is restored.
+  - -P restores the previous versions kept with the ".odb~" suffix
+    (maintainprevious without the version store).
+
+Files are copied by a pool of threads with localcopy, which keeps what the
+backup keeps (permissions, times, owner, group, symlinks and devices). As
+with the backup (rsync --update), a file newer at the destination is left
+alone unless -f is given, and unchanged files are not copied again, so an
+interrupted restore can simply be run again. Progress is printed every few
+seconds.
+
+Only backup directories reachable as a local path can be restored from
+(backup methods LOCAL and NFS, or -b).
+"""
+
+import fnmatch
+import getopt
+import logging
+import marshal
+import os
+import platform
+import pwd
+import stat
+import sys
+import threading
+import time
+
+import capacity
+import destindex
+import localcopy
+import snapshot
+import versionstore
+
+INDEX_VERSION = 1
+INDEX_DIR = '~/.openduckbill/restore'
+DEFAULT_CONFIG = '~/.openduckbill/config.yaml'
+# Threads listing directories when the index is updated.
+INDEX_WORKERS = 8
+# Threads copying files.
+RESTORE_WORKERS = 8
+# Seconds between two progress lines.
+PROGRESS_INTERVAL = 5
+# Suffix of the previous versions kept by maintainprevious.
+BACKUP_SUFFIX = '.odb~'
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S',
+                '%Y-%m-%dT%H:%M', snapshot.NAME_FORMAT, '%Y-%m-%d')
+GLOB_CHARS = '*?['
+
+# Metadata fields
+_MODE = 0
+_SIZE = 1
+_MTIME = 2
+
+
+def StatMeta(st):
+  """Returns the index metadata tuple of an lstat result."""
+
+  return (st.st_mode, st.st_size, int(st.st_mtime))
+
+
+def ParseTime(text):
+  """Returns the time (seconds) of a date and time, None if not valid."""
+
+  for timeformat in TIME_FORMATS:
+    try:
+      return time.mktime(time.strptime(text, timeformat))
+    except (ValueError, OverflowError):
+      continue
+  return None
+
+
+def PathParts(path):
+  """Returns the components of an absolute path."""
+
+  return [part for part in os.path.normpath(path).split('/') if part]
+
+
+def HasGlob(part):
+  """Checks whether a path component is a pattern."""
+
+  for char in GLOB_CHARS:
+    if char in part:
+      return True
+  return False
+
+
+def MatchParts(patternparts, parts):
+  """Match path components against pattern components, see module docstring.
+
+  Args:
+    patternparts: List - Components of the pattern.
+    parts: List - Components of the path.
+
+  Returns:
+    Boolean - True if the path matches.
+  """
+
+  if not patternparts:
+    return not parts
+  first = patternparts[0]
+  if first == '**':
+    for skip in xrange(len(parts) + 1):
+      if MatchParts(patternparts[1:], parts[skip:]):
+        return True
+    return False
+  if not parts or not fnmatch.fnmatchcase(parts[0], first):
+    return False
+  return MatchParts(patternparts[1:], parts[1:])
+
+
+def Covers(patternparts, parts):
+  """Checks whether a pattern matches a path or one of its parents."""
+
+  for length in xrange(len(parts), -1, -1):
+    if MatchParts(patternparts, parts[:length]):
+      return True
+  return False
+
+
+class StatInfo:
+  """lstat like metadata of a version kept in the version store."""
+
+  def __init__(self, meta):
+    """Initialise from a manifest value, see versionstore.WriteManifest."""
+
+    digest, mode, size, mtime, uid, gid, target = meta
+    self.st_mode = mode
+    self.st_size = size
+    self.st_mtime = mtime
+    self.st_atime = mtime
+    self.st_uid = uid
+    self.st_gid = gid
+    self.st_rdev = 0
+    self.target = target
+
+
+class RestoreLog:
+  """Log handle (see logger.LogArgManager) of the restore tool.
+
+  Messages go to the standard error.
+  """
+
+  def __init__(self, debug=False):
+    self.debug = debug
+    self.logger = logging.getLogger('openduckbill-restore')
+    if not self.logger.handlers:
+      handler = logging.StreamHandler()
+      handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+      self.logger.addHandler(handler)
+    if debug:
+      self.logger.setLevel(logging.DEBUG)
+    else:
+      self.logger.setLevel(logging.INFO)
+
+
+class TreeIndex:
+  """Listing of every directory of a backup tree, see module docstring."""
+
+  def __init__(self, root, indexdir=INDEX_DIR, workers=INDEX_WORKERS):
+    """Initialise an empty index.
+
+    Args:
+      root: String - Backup directory (or snapshot), source paths are found
+        below it with their full path.
+      indexdir: String - Directory holding the index files.
+      workers: Integer - Threads listing directories.
+    """
+
+    self.root = root.rstrip('/')
+    self.filename = os.path.join(os.path.expanduser(indexdir),
+                                 self.root.replace('/', '_') + '.index')
+    self.workers = max(1, workers)
+    # Directory path => (ctime, {name: metadata tuple})
+    self.dirs = {}
+    # Time the last update started, None if never updated.
+    self.updated = None
+    self.known = {}
+    self.unchanged = None
+    self.queue = []
+    self.active = 0
+    self.listed = 0
+    self.condition = None
+
+  def __len__(self):
+    return len(self.dirs)
+
+  def RealPath(self, path):
+    """Returns where a source path is found in the backup tree."""
+
+    if path == '/':
+      return self.root + '/'
+    return self.root + path
+
+  def Load(self):
+    """Read the index file. Returns True if it can be used."""
+
+    try:
+      indexfile = file(self.filename, 'rb')
+      try:
+        header = marshal.load(indexfile)
+        if (header.get('version') != INDEX_VERSION or
+            header.get('root') != self.root):
+          return False
+        self.dirs = marshal.load(indexfile)
+        self.updated = header.get('updated')
+      finally:
+        indexfile.close()
+    except (IOError, EOFError, ValueError, TypeError, AttributeError):
+      return False
+    return True
+
+  def Save(self):
+    """Atomically replace the index file. Returns False on error."""
+
+    header = {'version': INDEX_VERSION, 'root': self.root,
+              'updated': self.updated}
+    data = marshal.dumps(header) + marshal.dumps(self.dirs)
+    indexdir = os.path.dirname(self.filename)
+    tmpname = self.filename + '.tmp'
+    try:
+      if not os.path.isdir(indexdir):
+        os.makedirs(indexdir, 0700)
+      fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+      try:
+        while data:
+          written = os.write(fd, data)
+          data = data[written:]
+      finally:
+        os.close(fd)
+      os.rename(tmpname, self.filename)
+    except (IOError, OSError):
+      return False
+    return True
+
+  def Update(self, unchanged=None):
+    """Bring the index up to date with the backup tree. Blocking.
+
+    Args:
+      unchanged: Function - Called with a directory path, returns True if
+        nothing in the directory changed since the last update, in which
+        case its listing is reused without looking at it.
+
+    Returns:
+      Integer - Number of directories listed again.
+    """
+
+    started = time.time()
+    self.unchanged = unchanged
+    self.known = self.dirs
+    self.dirs = {}
+    self.queue = ['/']
+    self.active = 0
+    self.listed = 0
+    self.condition = threading.Condition()
+    threads = []
+    for number in xrange(self.workers):
+      thread = threading.Thread(target=self.Work, name='Index-%d' % number)
+      thread.setDaemon(True)
+      thread.start()
+      threads.append(thread)
+    for thread in threads:
+      # Join with a timeout, so that KeyboardInterrupt is delivered.
+      while thread.isAlive():
+        thread.join(1)
+    self.known = {}
+    self.unchanged = None
+    self.updated = started
+    return self.listed
+
+  def Work(self):
+    """Body of the index threads, each takes one directory at a time."""
+
+    while True:
+      self.condition.acquire()
+      try:
+        while not self.queue and self.active:
+          self.condition.wait()
+        if not self.queue:
+          # Nothing queued and nothing being listed, done.
+          self.condition.notifyAll()
+          return
+        dirpath = self.queue.pop()
+        self.active += 1
+      finally:
+        self.condition.release()
+      listing = self.ListDirectory(dirpath)
+      self.condition.acquire()
+      try:
+        self.active -= 1
+        if listing is not None:
+          self.dirs[dirpath] = listing
+          if listing is not self.known.get(dirpath):
+            self.listed += 1
+          for name, meta in listing[1].iteritems():
+            if stat.S_ISDIR(meta[_MODE]):
+              self.queue.append(os.path.join(dirpath, name))
+        self.condition.notifyAll()
+      finally:
+        self.condition.release()
+
+  def ListDirectory(self, dirpath):
+    """Returns (ctime, {name: metadata}) of a directory, None if gone.
+
+    The listing of the index is reused if the directory did not change.
+    """
+
+    known = self.known.get(dirpath)
+    if (known is not None and self.unchanged is not None and
+        self.unchanged(dirpath)):
+      return known
+    realpath = self.RealPath(dirpath)
+    try:
+      ctime = os.lstat(realpath).st_ctime
+      if known is not None and known[0] == ctime:
+        return known
+      names = os.listdir(realpath)
+    except OSError:
+      return None
+    entries = {}
+    for name in names:
+      try:
+        entries[name] = StatMeta(os.lstat(os.path.join(realpath, name)))
+      except OSError:
+        continue
+    return ctime, entries
+
+  def Lookup(self, path):
+    """Returns the metadata of a source path, None if not backed up."""
+
+    path = os.path.normpath(path)
+    if path == '/':
+      try:
+        return StatMeta(os.lstat(self.RealPath(path)))
+      except OSError:
+        return None
+    listing = self.dirs.get(os.path.dirname(path))
+    if listing is None:
+      return None
+    return listing[1].get(os.path.basename(path))
+
+  def Walk(self, dirpath, depth=None):
+    """Returns everything below a directory.
+
+    Args:
+      dirpath: String - Directory path.
+      depth: Integer - Levels descended, all if None.
+
+    Returns:
+      List - (path, metadata) tuples.
+    """
+
+    found = []
+    stack = [(dirpath, 1)]
+    while stack:
+      current, level = stack.pop()
+      listing = self.dirs.get(current)
+      if listing is None:
+        continue
+      for name, meta in listing[1].iteritems():
+        path = os.path.join(current, name)
+        found.append((path, meta))
+        if stat.S_ISDIR(meta[_MODE]) and (depth is None or level < depth):
+          stack.append((path, level + 1))
+    return found
+
+  def Match(self, pattern):
+    """Returns the paths matching a path or pattern.
+
+    Only the directories below the leading components without wildcards
+    are looked at.
+    """
+
+    parts = PathParts(pattern)
+    literal = []
+    for part in parts:
+      if HasGlob(part):
+        break
+      literal.append(part)
+    prefix = '/' + '/'.join(literal)
+    if len(literal) == len(parts):
+      if self.Lookup(prefix) is None:
+        return []
+      return [prefix]
+    rest = parts[len(literal):]
+    depth = None
+    if '**' not in rest:
+      depth = len(rest)
+    matched = []
+    for path, meta in self.Walk(prefix, depth):
+      if MatchParts(rest, PathParts(path)[len(literal):]):
+        matched.append(path)
+    return matched
+
+  def Select(self, patterns):
+    """Returns {path: metadata} of the paths matched and below them."""
+
+    selected = {}
+    for pattern in patterns:
+      for path in self.Match(pattern):
+        meta = self.Lookup(path)
+        selected[path] = meta
+        if stat.S_ISDIR(meta[_MODE]):
+          for below, belowmeta in self.Walk(path):
+            selected[below] = belowmeta
+    return selected
+
+
+def StoreVersions(store, when):
+  """Find the versions of the version store current at a given time.
+
+  The version of a file at that time is the first one displaced after it,
+  unless that one was modified after the time: the file did not exist then.
+
+  Args:
+    store: Object - versionstore.VersionStore.
+    when: Float - Time (seconds).
+
+  Returns:
+    Tuple - ({path: (backup time, manifest value or None if the file did
+      not exist)}, time of the oldest manifest or None if there is none).
+  """
+
+  try:
+    names = os.listdir(store.manifestdir)
+  except OSError:
+    return {}, None
+  manifests = []
+  for name in names:
+    if not name.endswith('.manifest'):
+      continue
+    manifest = versionstore.ReadManifest(os.path.join(store.manifestdir,
+                                                      name))
+    if manifest is not None:
+      manifests.append((manifest[0]['time'], manifest[1]))
+  manifests.sort()
+  versions = {}
+  for backuptime, files in manifests:
+    if backuptime <= when:
+      continue
+    for path, meta in files.iteritems():
+      if path not in versions:
+        if meta[3] > when:
+          meta = None
+        versions[path] = (backuptime, meta)
+  if not manifests:
+    return versions, None
+  return versions, manifests[0][0]
+
+
+def SnapshotAt(snapshotdir, when):
+  """Returns the name of the newest snapshot taken at or before a time."""
+
+  try:
+    names = os.listdir(snapshotdir)
+  except OSError:
+    return None
+  found = None
+  for name in names:
+    taken = snapshot.GenerationTime(name)
+    if taken is not None and taken <= when and (found is None or
+                                                name > found):
+      found = name
+  return found
+
+
+class Restorer:
+  """Copies selected paths out of a backup tree, see module docstring."""
+
+  def __init__(self, destroot, treeroot, loghandle, workers=RESTORE_WORKERS,
+               force=False):
+    """Initialise an empty restore.
+
+    Args:
+      destroot: String - Paths are restored below this directory, "/" to
+        restore them in place.
+      treeroot: String - Backup tree the missing parents are created from.
+      loghandle: Object - Handle to the logging object.
+      workers: Integer - Threads copying files.
+      force: Boolean - Overwrite files newer at the destination.
+    """
+
+    self.destroot = destroot.rstrip('/')
+    self.treeroot = treeroot.rstrip('/')
+    self.loghandle = loghandle
+    self.workers = max(1, workers)
+    self.force = force
+    # (path, source, metadata or None, origin) of files, links and devices.
+    # source is the path of the version to copy (None for a symlink kept in
+    # the version store), the metadata is read from it if None.
+    self.items = []
+    # Path => source directory
+    self.dirs = {}
+    self.total = 0
+    self.missing = 0
+    # Files left out since they did not exist at the time restored.
+    self.newer = 0
+    self.next = 0
+    self.done = 0
+    self.bytes = 0
+    self.changed = 0
+    self.errors = []
+    # (destination, lstat result) of the directories whose times are set
+    # once the files below them are restored.
+    self.dirtimes = []
+    self.lock = threading.Lock()
+
+  def Destination(self, path):
+    return self.destroot + path
+
+  def AddFile(self, path, source, st=None, size=0, origin='backup'):
+    """Queue a file (or symlink, device) to restore."""
+
+    self.items.append((path, source, st, origin))
+    self.total += size
+
+  def AddSelection(self, index, patterns, previous=False, versions=None,
+                   store=None, origin='backup', when=None):
+    """Queue what patterns select in a backup tree.
+
+    Args:
+      index: Object - TreeIndex of the tree.
+      patterns: List - Paths or patterns.
+      previous: Boolean - Restore the ".odb~" versions instead.
+      versions: Dictionary - Versions to restore instead of the files of
+        the tree, see StoreVersions.
+      store: Object - versionstore.VersionStore holding versions.
+      origin: String - Where the files of the tree come from, for listing.
+      when: Float - Time restored (-t), files of the tree modified after it
+        are left out.
+    """
+
+    selected = index.Select(patterns)
+    if versions:
+      # Files removed since are only in the version store.
+      patternparts = [PathParts(pattern) for pattern in patterns]
+      for path in versions:
+        if path in selected:
+          continue
+        for parts in patternparts:
+          if Covers(parts, PathParts(path)):
+            selected[path] = None
+            break
+    for path, meta in selected.iteritems():
+      if meta is not None and stat.S_ISDIR(meta[_MODE]):
+        self.dirs[path] = index.RealPath(path)
+        continue
+      if versions and path in versions:
+        backuptime, version = versions[path]
+        if version is None:
+          self.newer += 1
+          continue
+        st = StatInfo(version)
+        source = None
+        if version[0] is not None:
+          source = store.ObjectPath(version[0])
+        self.AddFile(path, source, st, st.st_size, 'version of %s' %
+                     time.strftime('%Y-%m-%d %H:%M:%S',
+                                   time.localtime(backuptime)))
+        continue
+      if when is not None and meta[_MTIME] > when:
+        # Not backed up yet at that time.
+        self.newer += 1
+        continue
+      if path.endswith(BACKUP_SUFFIX):
+        original = path[:-len(BACKUP_SUFFIX)]
+        if previous and original not in selected:
+          # Removed since, only the previous version is left.
+          self.AddFile(original, index.RealPath(path), size=meta[_SIZE],
+                       origin='previous')
+        continue
+      if previous:
+        kept = index.Lookup(path + BACKUP_SUFFIX)
+        if kept is None:
+          self.missing += 1
+          continue
+        self.AddFile(path, index.RealPath(path + BACKUP_SUFFIX),
+                     size=kept[_SIZE], origin='previous')
+      else:
+        self.AddFile(path, index.RealPath(path), size=meta[_SIZE],
+                     origin=origin)
+
+  def List(self):
+    """Print what would be restored."""
+
+    items = self.items[:]
+    items.sort()
+    for path, source, st, origin in items:
+      print '%s  (%s)' % (path, origin)
+    print '%s files, %s, %s directories' % (len(self.items),
+                                            capacity.FormatBytes(self.total),
+                                            len(self.dirs))
+
+  def Run(self):
+    """Restore the queued paths. Blocking.
+
+    Returns:
+      Integer - Number of paths which failed.
+    """
+
+    started = time.time()
+    self.MakeDirectories()
+    # In path order, files of a directory are written together.
+    self.items.sort()
+    threads = []
+    for number in xrange(min(self.workers, max(1, len(self.items)))):
+      thread = threading.Thread(target=self.Work, name='Restore-%d' % number)
+      thread.setDaemon(True)
+      thread.start()
+      threads.append(thread)
+    for thread in threads:
+      while thread.isAlive():
+        thread.join(PROGRESS_INTERVAL)
+        if thread.isAlive():
+          self.ShowProgress(started)
+    self.dirtimes.sort()
+    self.dirtimes.reverse()
+    for dest, st in self.dirtimes:
+      try:
+        os.utime(dest, (st.st_atime, st.st_mtime))
+      except OSError:
+        pass
+    seconds = max(time.time() - started, 0.001)
+    self.loghandle.logger.info('Restored %s files (%s written, %s failed),'
+                               ' %s in %.0f seconds, %s/s', self.done,
+                               self.changed, len(self.errors),
+                               capacity.FormatBytes(self.bytes), seconds,
+                               capacity.FormatBytes(self.bytes / seconds))
+    return len(self.errors)
+
+  def ShowProgress(self, started):
+    """Print how far the restore is."""
+
+    seconds = max(time.time() - started, 0.001)
+    self.loghandle.logger.info('%s/%s files, %s of %s, %s/s', self.done,
+                               len(self.items),
+                               capacity.FormatBytes(self.bytes),
+                               capacity.FormatBytes(self.total),
+                               capacity.FormatBytes(self.bytes / seconds))
+
+  def Error(self, path, error):
+    line = 'restore "%s" failed: %s' % (path, error)
+    self.loghandle.logger.warning('%s', line)
+    self.errors.append(line)
+
+  def MakeDirectories(self):
+    """Create the restored directories and the missing parents.
+
+    Parents which exist at the destination are left as they are, the
+    restored directories get the attributes they have in the backup.
+    """
+
+    copier = localcopy.LocalCopier(self.destroot, self.loghandle)
+    paths = self.dirs.keys()
+    for path, source, st, origin in self.items:
+      paths.append(os.path.dirname(path))
+    needed = set()
+    for path in paths:
+      while path != '/' and path not in needed:
+        needed.add(path)
+        path = os.path.dirname(path)
+    dirpaths = list(needed)
+    dirpaths.sort()
+    for path in dirpaths:
+      dest = self.Destination(path)
+      source = self.dirs.get(path)
+      if source is None:
+        if os.path.isdir(dest):
+          continue
+        source = self.treeroot + path
+      try:
+        try:
+          st = os.lstat(source)
+        except OSError:
+          # Not in the backup tree (removed since, version store).
+          os.mkdir(dest, 0755)
+          continue
+        copier.CopyDirectory(source, dest, st)
+        self.dirtimes.append((dest, st))
+      except OSError, e:
+        self.Error(path, e)
+
+  def Work(self):
+    """Body of the restore threads, copies one file at a time."""
+
+    copier = localcopy.LocalCopier(self.destroot, self.loghandle)
+    copier.update = not self.force
+    while True:
+      self.lock.acquire()
+      try:
+        if self.next >= len(self.items):
+          self.changed += copier.changed
+          return
+        path, source, st, origin = self.items[self.next]
+        self.next += 1
+      finally:
+        self.lock.release()
+      dest = self.Destination(path)
+      error = None
+      size = 0
+      try:
+        if st is None:
+          st = os.lstat(source)
+        mode = st.st_mode
+        if stat.S_ISREG(mode):
+          copier.CopyFile(source, dest, st)
+          size = st.st_size
+        elif stat.S_ISLNK(mode):
+          copier.CopyLink(source, dest, st, getattr(st, 'target', None))
+        elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+          copier.CopyDevice(source, dest, st)
+        else:
+          self.loghandle.logger.debug('Skipping non-regular file %s', path)
+      except (IOError, OSError), e:
+        error = e
+      self.lock.acquire()
+      try:
+        self.done += 1
+        self.bytes += size
+        if error is not None:
+          self.Error(path, error)
+      finally:
+        self.lock.release()
+
+
+def Usage():
+  """Prints usage."""
+
+  name = 'openduckbill-restore'
+  print 'Usage : %s [options] <path or pattern> ...' % (name)
+  print '      : -c <path to config file>'
+  print '      : -b <backup directory> (instead of the one of the config file)'
+  print '      : -H <hostname> (restore the backup of another host)'
+  print '      : -t <time> (as backed up at "YYYY-MM-DD[ HH:MM[:SS]]")'
+  print '      : -P (restore the previous ".odb~" versions)'
+  print '      : -d <directory> (restore below directory, not in place)'
+  print '      : -f (overwrite files newer than the restored ones)'
+  print '      : -j <number> (files copied at a time, default %s)' % (
+      RESTORE_WORKERS)
+  print '      : -l (list what would be restored)'
+  print '      : -r (rebuild the index of the backup directory, reading'
+  print '             every directory)'
+  print '      : -D (Debug)'
+  print '      : -h (Show this message)'
+
+
+def UserDirectory(configfile, loghandle):
+  """Returns <localmount>/<user> of the config file, None on error."""
+
+  try:
+    import yaml
+  except ImportError, e:
+    loghandle.logger.error('%s, please install PyYAML or use -b', e)
+    return None
+  try:
+    readhandle = file(configfile, 'r')
+    try:
+      configdata = yaml.load(readhandle)
+    finally:
+      readhandle.close()
+    method = configdata['global']['backupmethod'].upper()
+    if method == 'RSYNC':
+      loghandle.logger.error('Backup method RSYNC: restore on the backup'
+                             ' server, or mount its backup directory and'
+                             ' use -b')
+      return None
+    localmount = configdata[method]['localmount']
+  except (IOError, KeyError, TypeError, AttributeError), e:
+    loghandle.logger.error('Cannot read the backup directory from %s: %s',
+                           configfile, e)
+    return None
+  except yaml.YAMLError, e:
+    loghandle.logger.error('Error in configuration file: %s, %s', configfile,
+                           e)
+    return None
+  try:
+    user = os.getlogin()
+  except OSError:
+    user = pwd.getpwuid(os.getuid())[0]
+  return os.path.join(localmount, user)
+
+
+def Main(argv):
+  """Run the restore tool. Returns the exit value."""
+
+  try:
+    optlist, patterns = getopt.getopt(argv, 'c:b:H:t:Pd:fj:lrDh')
+  except getopt.GetoptError, e:
+    print e
+    Usage()
+    return 1
+  options = {}
+  for opt, arg in optlist:
+    options[opt] = arg
+  if '-h' in options or not patterns:
+    Usage()
+    return 1
+  loghandle = RestoreLog('-D' in options)
+  hostname = options.get('-H', platform.node().split('.')[0])
+  if '-b' in options:
+    backupdir = os.path.abspath(os.path.expanduser(options['-b']))
+    userdir = os.path.dirname(os.path.dirname(backupdir))
+    hostname = os.path.basename(backupdir)
+  else:
+    configfile = os.path.expanduser(options.get('-c', DEFAULT_CONFIG))
+    userdir = UserDirectory(configfile, loghandle)
+    if userdir is None:
+      return 1
+    backupdir = os.path.join(userdir, '__backups__', hostname)
+  if not os.path.isdir(backupdir):
+    loghandle.logger.error('Backup directory %s not found', backupdir)
+    return 1
+  try:
+    workers = int(options.get('-j', RESTORE_WORKERS))
+  except ValueError:
+    loghandle.logger.error('Invalid number of workers: %s', options['-j'])
+    return 1
+  previous = '-P' in options
+  patterns = [os.path.abspath(os.path.expanduser(pattern))
+              for pattern in patterns]
+
+  treeroot = backupdir
+  origin = 'backup'
+  store = None
+  versions = None
+  when = None
+  if '-t' in options:
+    when = ParseTime(options['-t'])
+    if when is None:
+      loghandle.logger.error('Invalid time: %s', options['-t'])
+      return 1
+    if previous:
+      loghandle.logger.error('-t and -P can not be used together')
+      return 1
+    store = versionstore.VersionStore(
+        os.path.join(userdir, '__versions__', hostname), loghandle)
+    versions, oldest = StoreVersions(store, when)
+    generation = SnapshotAt(os.path.join(userdir, '__snapshots__', hostname),
+                            when)
+    if generation and (oldest is None or when < oldest):
+      treeroot = os.path.join(userdir, '__snapshots__', hostname, generation)
+      origin = 'snapshot %s' % generation
+      versions = None
+      # The snapshot holds nothing newer.
+      when = None
+    elif oldest is None:
+      loghandle.logger.error('Neither version store nor snapshot found for'
+                             ' %s', options['-t'])
+      return 1
+    elif when < oldest:
+      loghandle.logger.warning('Versions older than %s are not kept',
+                               time.ctime(oldest))
+
+  index = TreeIndex(treeroot)
+  unchanged = None
+  if '-r' in options or not index.Load():
+    loghandle.logger.info('Building the index of %s', treeroot)
+  elif treeroot == backupdir and index.updated:
+    since = index.updated
+    backupindex = destindex.DestinationIndex(backupdir)
+    # Directories changed before the daemon index was started are unknown.
+    if backupindex.Load() and backupindex.created < since:
+      unchanged = lambda dirpath: backupindex.Unchanged(dirpath, since)
+  started = time.time()
+  listed = index.Update(unchanged)
+  loghandle.logger.debug('Index of %s: %s directories, %s listed again in'
+                         ' %.1f seconds', treeroot, len(index), listed,
+                         time.time() - started)
+  if not index.Save():
+    loghandle.logger.warning('Failed to write the index %s', index.filename)
+
+  destroot = os.path.abspath(os.path.expanduser(options.get('-d', '/')))
+  if not os.path.isdir(destroot):
+    try:
+      os.makedirs(destroot)
+    except OSError, e:
+      loghandle.logger.error('%s', e)
+      return 1
+  restorer = Restorer(destroot, treeroot, loghandle, workers,
+                      '-f' in options)
+  restorer.AddSelection(index, patterns, previous, versions, store, origin,
+                        when)
+  if restorer.newer:
+    loghandle.logger.info('%s files created after %s left out',
+                          restorer.newer, time.ctime(when))
+  if restorer.missing:
+    loghandle.logger.warning('%s files have no previous version',
+                             restorer.missing)
+  if not restorer.items and not restorer.dirs:
+    loghandle.logger.error('Nothing backed up matches %s', patterns)
+    return 1
+  if '-l' in options:
+    restorer.List()
+    return 0
+  if restorer.Run():
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(Main(sys.argv[1:]))
@@ -0,0 +1,222 @@
+#!/usr/bin/python2.4
+
+# Copyright 2008 Google Inc.
+# Author : Anoop Chandran <anoopj@google.com>
+#
+# openduckbill is a simple backup application. It offers support for
+# transferring data to a local backup directory, NFS. It also provides
+# file system monitoring of directories marked for backup. Please read
+# the README file for more details.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Decides when the changes of an entry are flushed to the backup directory.
+
+Changes of an entry are flushed once the entry has been quiet (no new
+filesystem events) for "quietperiod" seconds, or at the latest "syncinterval"
+seconds after its first pending change, whichever comes first. The scheduler
+keeps one event loop timer at the earliest deadline; nothing runs at all
+while there is nothing to back up.
+"""
+
+import time
+
+
+class Debouncer:
+  """Keeps the flush deadline of every entry with pending changes.
+
+  FlushScheduler drives it from the event loop.
+  """
+
+  def __init__(self, quietperiod, maxlatency):
+    """Initialise an empty debouncer.
+
+    Args:
+      quietperiod: Integer - Seconds without events after which an entry is
+        flushed.
+      maxlatency: Integer - Maximum seconds between the first pending change
+        of an entry and its flush.
+    """
+
+    self.quietperiod = quietperiod
+    self.maxlatency = maxlatency
+    # key => [first event, last event, not before]
+    self.pending = {}
+
+  def __len__(self):
+    return len(self.pending)
+
+  def Touch(self, key, now):
+    """Record an event for key.
+
+    Returns:
+      Boolean - True if key had no pending changes before.
+    """
+
+    try:
+      self.pending[key][1] = now
+      return False
+    except KeyError:
+      self.pending[key] = [now, now, 0]
+      return True
+
+  def Defer(self, key, delay, now):
+    """Do not flush key for delay seconds (eg. backup threads are busy)."""
+
+    try:
+      self.pending[key][2] = now + delay
+    except KeyError:
+      self.pending[key] = [now, now, now + delay]
+
+  def Forget(self, key):
+    """Drop key, without flushing it."""
+
+    try:
+      del self.pending[key]
+    except KeyError:
+      pass
+
+  def Deadline(self, key):
+    """Returns the time at which key has to be flushed."""
+
+    first, last, notbefore = self.pending[key]
+    return max(notbefore, min(last + self.quietperiod,
+                              first + self.maxlatency))
+
+  def NextDeadline(self):
+    """Returns the earliest deadline, None if nothing is pending."""
+
+    deadline = None
+    for key in self.pending:
+      keydeadline = self.Deadline(key)
+      if deadline is None or keydeadline < deadline:
+        deadline = keydeadline
+    return deadline
+
+  def PopDue(self, now):
+    """Remove and return the keys whose deadline has passed.
+
+    Returns:
+      List - (key, seconds since the first pending change) tuples.
+    """
+
+    due = []
+    for key in self.pending.keys():
+      if self.Deadline(key) <= now:
+        due.append((key, now - self.pending[key][0]))
+        del self.pending[key]
+    due.sort()
+    return due
+
+
+class FlushScheduler:
+  """Calls flushfunc from the event loop when entries are due for a backup."""
+
+  def __init__(self, loop, quietperiod, maxlatency, flushfunc, loghandle):
+    """Initialise the scheduler.
+
+    Args:
+      loop: Object - eventloop.EventLoop.
+      quietperiod: Integer - See Debouncer.
+      maxlatency: Integer - See Debouncer.
+      flushfunc: Function - Called with the list of due (key, latency)
+        tuples.
+      loghandle: Object - Handle to the logging object.
+    """
+
+    self.loop = loop
+    self.debouncer = Debouncer(quietperiod, maxlatency)
+    self.flushfunc = flushfunc
+    self.loghandle = loghandle
+    self.timer = None
+    self.stopped = False
+    # Flush latency statistics (seconds from first change to flush)
+    self.flushes = 0
+    self.totallatency = 0.0
+    self.maxlatency = 0.0
+
+  def Notify(self, key):
+    """Record an event for key. Called for every filesystem event."""
+
+    if self.debouncer.Touch(key, time.time()):
+      # New deadline, which might be the earliest one.
+      self.Reschedule()
+
+  def Defer(self, key, delay):
+    """Retry flushing key after delay seconds."""
+
+    self.debouncer.Defer(key, delay, time.time())
+    self.Reschedule()
+
+  def Forget(self, key):
+    """Stop scheduling key."""
+
+    self.debouncer.Forget(key)
+
+  def Stop(self):
+    """Stop scheduling flushes."""
+
+    self.stopped = True
+    if self.timer:
+      self.timer.Cancel()
+      self.timer = None
+
+  def Reschedule(self):
+    """Point the loop timer at the earliest deadline.
+
+    Deadlines only move later while events keep coming in, so the timer is
+    not moved for every event; Flush looks again when it fires early.
+    """
+
+    if self.stopped:
+      return
+    deadline = self.debouncer.NextDeadline()
+    if self.timer:
+      if deadline is not None and self.timer.when <= deadline:
+        return
+      self.timer.Cancel()
+      self.timer = None
+    if deadline is not None:
+      self.timer = self.loop.CallAt(deadline, self.Flush)
+
+  def Flush(self):
+    """Timer callback, flush the entries which are due."""
+
+    self.timer = None
+    due = self.debouncer.PopDue(time.time())
+    for key, latency in due:
+      self.flushes += 1
+      self.totallatency += latency
+      self.maxlatency = max(self.maxlatency, latency)
+      self.loghandle.logger.debug('Flushing %s, %.1f seconds after its first'
+                                  ' change', key, latency)
+    if due:
+      try:
+        self.flushfunc(due)
+      except Exception, e:
+        self.loghandle.logger.error('Flush failed: %s', e)
+    self.Reschedule()
+
+  def Pending(self):
+    """Returns the keys waiting to be flushed."""
+
+    return self.debouncer.pending.keys()
+
+  def LatencyStats(self):
+    """Returns (flushes, average latency, maximum latency) in seconds."""
+
+    if not self.flushes:
+      return 0, 0.0, 0.0
+    return (self.flushes, self.totallatency / self.flushes, self.maxlatency)
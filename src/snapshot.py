@@ -0,0 +1,301 @@
+#!/usr/bin/python2.4
+
+# Copyright 2008 Google Inc.
+# Author : Anoop Chandran <anoopj@google.com>
+#
+# openduckbill is a simple backup application. It offers support for
+# transferring data to a local backup directory, NFS. It also provides
+# file system monitoring of directories marked for backup. Please read
+# the README file for more details.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""Point-in-time snapshots of the backup directory, with tiered retention.
+
+With backup methods LOCAL and NFS, the backup directory (an exact copy of
+the entries) is copied every "snapshotinterval" seconds to a generation
+named after the time it was taken:
+
+  <localmount>/<user>/__snapshots__/<hostname>/2008-06-21T143000/
+
+A generation is made by rsync with --link-dest pointing at the previous
+generation: unchanged files are hard links to the previous generation, so
+a generation costs the changed files and the directories only (the first
+generation is a full copy). Generations are never linked to the backup
+directory, whose files are changed in place (eg. permissions). rsync
+writes to a directory named ".partial", renamed to the generation name
+once complete (a generation is never incomplete, an interrupted one is
+resumed).
+
+Retention keeps the newest generation of each of the last "keephourly"
+hours, "keepdaily" days and "keepweekly" weeks (and always the newest
+generation). Which generations to drop is decided from their names alone.
+A dropped generation is first renamed to ".prune-<name>", then removed a
+batch of files at a time by a worker thread, so that pruning never holds
+a worker (nor the disk) for long.
+"""
+
+import os
+import re
+import time
+
+# Generation names, in time.strftime format.
+NAME_FORMAT = '%Y-%m-%dT%H%M%S'
+NAME_RE = re.compile(r'^\d{4}-\d\d-\d\dT\d{6}$')
+PARTIAL = '.partial'
+PRUNE_PREFIX = '.prune-'
+# Files and directories removed by one worker call when pruning.
+PRUNE_BATCH = 2000
+# Seconds between two pruning batches.
+PRUNE_PAUSE = 1
+# rsync exit value when files vanished during the transfer.
+RSYNC_VANISHED = 24
+
+
+def GenerationTime(name):
+  """Returns the time (seconds) a generation was taken, None if not one."""
+
+  if not NAME_RE.match(name):
+    return None
+  try:
+    return time.mktime(time.strptime(name, NAME_FORMAT))
+  except (ValueError, OverflowError):
+    return None
+
+
+def KeptGenerations(names, hourly, daily, weekly):
+  """Apply the retention tiers to generation names.
+
+  In each tier, the newest generation of each period (hour, day, week) is
+  kept, for the newest "count" periods having a generation.
+
+  Args:
+    names: List - Generation names.
+    hourly: Integer - Number of hours to keep a generation of.
+    daily: Integer - Number of days to keep a generation of.
+    weekly: Integer - Number of weeks to keep a generation of.
+
+  Returns:
+    Set - Names of the generations to keep.
+  """
+
+  generations = []
+  for name in names:
+    taken = GenerationTime(name)
+    if taken is not None:
+      generations.append((taken, name))
+  generations.sort()
+  generations.reverse()
+  kept = set()
+  if generations:
+    kept.add(generations[0][1])
+  for count, periodformat in ((hourly, '%Y%m%d%H'), (daily, '%Y%m%d'),
+                              (weekly, '%Y%W')):
+    periods = set()
+    for taken, name in generations:
+      period = time.strftime(periodformat, time.localtime(taken))
+      if period in periods:
+        continue
+      if len(periods) >= count:
+        break
+      periods.add(period)
+      kept.add(name)
+  return kept
+
+
+def RemoveSome(path, limit):
+  """Remove up to limit files and directories below path, deepest first.
+
+  Blocking, meant to run in a worker thread.
+
+  Returns:
+    Boolean - True once path itself has been removed.
+  """
+
+  removed = 0
+  for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+    for filename in filenames:
+      os.remove(os.path.join(dirpath, filename))
+      removed += 1
+    # Symbolic links to directories are listed as directories.
+    for dirname in dirnames:
+      subpath = os.path.join(dirpath, dirname)
+      if os.path.islink(subpath):
+        os.remove(subpath)
+        removed += 1
+    os.rmdir(dirpath)
+    removed += 1
+    if removed >= limit:
+      return dirpath == path
+  return not os.path.lexists(path)
+
+
+class SnapshotManager:
+  """Takes and prunes the generations, see module docstring."""
+
+  def __init__(self, loop, backupdir, snapshotdir, rsyncpath, loghandle,
+               hourly, daily, weekly):
+    """Initialise the snapshot manager.
+
+    Args:
+      loop: Object - eventloop.EventLoop.
+      backupdir: String - Backup directory the snapshots are taken of.
+      snapshotdir: String - Directory holding the generations.
+      rsyncpath: String - Path of the rsync binary.
+      loghandle: Object - Handle to the logging object.
+      hourly: Integer - See KeptGenerations.
+      daily: Integer - See KeptGenerations.
+      weekly: Integer - See KeptGenerations.
+    """
+
+    self.loop = loop
+    self.backupdir = backupdir.rstrip('/')
+    self.snapshotdir = snapshotdir.rstrip('/')
+    self.rsyncpath = rsyncpath
+    self.loghandle = loghandle
+    self.hourly = hourly
+    self.daily = daily
+    self.weekly = weekly
+    self.callback = None
+    self.name = None
+    # Paths of the generations being removed.
+    self.pruning = []
+    self.removing = False
+    self.stopped = False
+
+  def Generations(self):
+    """Returns the names of the complete generations, oldest first."""
+
+    try:
+      names = os.listdir(self.snapshotdir)
+    except OSError:
+      return []
+    names = [name for name in names if GenerationTime(name) is not None]
+    names.sort()
+    return names
+
+  def LastTime(self):
+    """Returns the time the newest generation was taken, None if none."""
+
+    names = self.Generations()
+    if not names:
+      return None
+    return GenerationTime(names[-1])
+
+  def Take(self, callback):
+    """Start taking a generation.
+
+    Args:
+      callback: Function - Called on the loop with True if a generation has
+        been taken, False otherwise.
+    """
+
+    self.callback = callback
+    self.name = time.strftime(NAME_FORMAT)
+    partial = os.path.join(self.snapshotdir, PARTIAL)
+    try:
+      if not os.path.isdir(partial):
+        os.makedirs(partial, 0700)
+    except OSError, e:
+      self.loghandle.logger.error('Snapshot: %s', e)
+      self.loop.CallLater(0, callback, False)
+      return
+    cmdarglist = [self.rsyncpath, '-a', '--delete']
+    names = self.Generations()
+    if names:
+      cmdarglist.append('--link-dest=' +
+                        os.path.join(self.snapshotdir, names[-1]))
+    cmdarglist.extend([self.backupdir + '/', partial + '/'])
+    self.loghandle.logger.debug('%s', cmdarglist)
+    self.loop.SpawnProcess(cmdarglist, self.Taken)
+
+  def Taken(self, retcode, lines):
+    """The rsync command of Take has exited."""
+
+    callback = self.callback
+    self.callback = None
+    if retcode not in (0, RSYNC_VANISHED):
+      self.loghandle.logger.error('Snapshot %s failed. Error code: %s',
+                                  self.name, retcode)
+      callback(False)
+      return
+    try:
+      os.rename(os.path.join(self.snapshotdir, PARTIAL),
+                os.path.join(self.snapshotdir, self.name))
+    except OSError, e:
+      self.loghandle.logger.error('Snapshot %s: %s', self.name, e)
+      callback(False)
+      return
+    self.loghandle.logger.info('Snapshot %s taken', self.name)
+    self.Prune()
+    callback(True)
+
+  def Prune(self):
+    """Drop the generations the retention tiers do not keep."""
+
+    names = self.Generations()
+    kept = KeptGenerations(names, self.hourly, self.daily, self.weekly)
+    for name in names:
+      if name in kept:
+        continue
+      pruned = os.path.join(self.snapshotdir, PRUNE_PREFIX + name)
+      try:
+        os.rename(os.path.join(self.snapshotdir, name), pruned)
+      except OSError, e:
+        self.loghandle.logger.warning('Snapshot %s: %s', name, e)
+        continue
+      self.loghandle.logger.info('Snapshot %s expired', name)
+      self.pruning.append(pruned)
+    self.RemoveNext()
+
+  def Recover(self):
+    """Resume removing the generations being pruned at the last exit."""
+
+    try:
+      names = os.listdir(self.snapshotdir)
+    except OSError:
+      return
+    for name in names:
+      if name.startswith(PRUNE_PREFIX):
+        self.pruning.append(os.path.join(self.snapshotdir, name))
+    self.RemoveNext()
+
+  def RemoveNext(self):
+    """Remove the next batch of a pruned generation."""
+
+    if self.removing or self.stopped or not self.pruning:
+      return
+    self.removing = True
+    self.loop.RunInThread(RemoveSome, (self.pruning[0], PRUNE_BATCH),
+                          self.Removed)
+
+  def Removed(self, done, error):
+    """A pruning batch is done, schedule the next one."""
+
+    self.removing = False
+    if error is not None:
+      self.loghandle.logger.warning('Removing snapshot %s: %s',
+                                    self.pruning[0], error)
+      done = True
+    if done:
+      self.pruning.pop(0)
+    if self.pruning:
+      self.loop.CallLater(PRUNE_PAUSE, self.RemoveNext)
+
+  def Stop(self):
+    """Stop pruning, what is left is removed after the next start."""
+
+    self.stopped = True
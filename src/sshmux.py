@@ -0,0 +1,174 @@
+#!/usr/bin/python2.4
+
+# Copyright 2008 Google Inc.
+# Author : Anoop Chandran <anoopj@google.com>
+#
+# openduckbill is a simple backup application. It offers support for
+# transferring data to a local backup directory, NFS. It also provides
+# file system monitoring of directories marked for backup. Please read
+# the README file for more details.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""Persistent multiplexed ssh connection to the backup server.
+
+With backup method RSYNC every rsync (and every remote command) runs its own
+ssh, paying a full ssh handshake (several round trips) each time. sshmux
+keeps one master connection (ssh ControlMaster) open to the server, which
+every later ssh command reuses through a control socket in
+~/.openduckbill. A command started while the master is down connects
+directly, as if there were no master.
+
+The master runs in the background (ssh -f), detached from the daemon, and
+is checked (ssh -O check) regularly; it is restarted when it died, eg.
+after the network went down.
+"""
+
+import os
+import subprocess
+import tempfile
+
+# Seconds between master connection checks.
+CHECK_INTERVAL = 60
+# Keepalive: a master whose server does not answer for
+# SERVER_ALIVE_INTERVAL * SERVER_ALIVE_COUNT seconds exits.
+SERVER_ALIVE_INTERVAL = 15
+SERVER_ALIVE_COUNT = 4
+
+
+def ShellQuote(arg):
+  """Quote a string for a POSIX shell."""
+
+  return "'" + arg.replace("'", "'\\''") + "'"
+
+
+class SshMaster:
+  """Master ssh connection to one server."""
+
+  def __init__(self, sshpath, user, port, server, helper, loghandle,
+               controldir='~/.openduckbill'):
+    """Initialise the master, see Start.
+
+    Args:
+      sshpath: String - ssh executable.
+      user: String - Login on the server.
+      port: String - ssh port of the server.
+      server: String - Server hostname.
+      helper: Object - helper.CommandHelper, runs the ssh commands.
+      loghandle: Object - Handle to the logging object.
+      controldir: String - Directory of the control socket.
+    """
+
+    self.sshpath = sshpath
+    self.user = user
+    self.port = port
+    self.server = server
+    self.helper = helper
+    self.loghandle = loghandle
+    # ssh expands the tokens: one socket per user, server and port.
+    self.controlpath = os.path.join(os.path.expanduser(controldir),
+                                    'ssh-%r@%h:%p')
+    self.running = False
+
+  def Options(self):
+    """Returns the ssh options making a client use the master."""
+
+    return ['-o', 'ControlPath=' + self.controlpath,
+            '-o', 'ControlMaster=no']
+
+  def ShellCommand(self):
+    """Returns the remote shell command for rsync (-e option)."""
+
+    return ' '.join([self.sshpath, '-p', self.port, '-o',
+                     ShellQuote('ControlPath=' + self.controlpath),
+                     '-o', 'ControlMaster=no'])
+
+  def Command(self, args):
+    """Returns the command running args on the server through the master."""
+
+    return ([self.sshpath] + self.Options() +
+            ['-l', self.user, '-p', self.port, self.server] + args)
+
+  def Control(self, operation):
+    """Returns the command sending a control operation to the master."""
+
+    return [self.sshpath, '-o', 'ControlPath=' + self.controlpath,
+            '-O', operation, '-l', self.user, '-p', self.port, self.server]
+
+  def Start(self):
+    """Start the master connection. Blocking.
+
+    Returns once the connection is authenticated (or failed), the master
+    itself keeps running in the background.
+
+    Returns:
+      Boolean - True if the master is running.
+    """
+
+    cmd = [self.sshpath, '-M', '-N', '-f',
+           '-o', 'ControlPath=' + self.controlpath,
+           '-o', 'BatchMode=yes',
+           '-o', 'ServerAliveInterval=%d' % SERVER_ALIVE_INTERVAL,
+           '-o', 'ServerAliveCountMax=%d' % SERVER_ALIVE_COUNT,
+           '-l', self.user, '-p', self.port, self.server]
+    self.loghandle.logger.debug(cmd)
+    # The backgrounded master inherits stdout and stderr, output is not read
+    # from a pipe which would stay open.
+    devnull = file(os.devnull, 'r+')
+    errors = tempfile.TemporaryFile()
+    try:
+      try:
+        retval = subprocess.call(cmd, stdin=devnull, stdout=devnull,
+                                 stderr=errors, close_fds=True)
+      except OSError, e:
+        retval = 1
+        errors.write(str(e))
+      errors.seek(0)
+      output = errors.read()
+    finally:
+      errors.close()
+      devnull.close()
+    self.running = not retval
+    if self.running:
+      self.loghandle.logger.info('Started ssh master connection to %s',
+                                 self.server)
+    else:
+      self.loghandle.logger.warning('Could not start ssh master connection'
+                                    ' to %s: %s', self.server,
+                                    output.strip())
+    return self.running
+
+  def Check(self):
+    """Check the master, restart it if it is gone. Blocking.
+
+    Returns:
+      Boolean - True if the master is running.
+    """
+
+    retval, output = self.helper.RunCommandOutput(self.Control('check'))
+    if not retval:
+      self.running = True
+      return True
+    if self.running:
+      self.loghandle.logger.warning('ssh master connection to %s lost: %s',
+                                    self.server, output.strip())
+    return self.Start()
+
+  def Stop(self):
+    """Close the master connection."""
+
+    self.helper.RunCommandOutput(self.Control('exit'))
+    self.running = False
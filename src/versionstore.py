@@ -0,0 +1,475 @@
+#!/usr/bin/python2.4
+
+# Copyright 2008 Google Inc.
+# Author : Anoop Chandran <anoopj@google.com>
+#
+# openduckbill is a simple backup application. It offers support for
+# transferring data to a local backup directory, NFS. It also provides
+# file system monitoring of directories marked for backup. Please read
+# the README file for more details.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""Content-addressed store of the previous versions of backed up files.
+
+With "maintainprevious" and "versionstore", rsync (or localcopy) moves the
+version of a file it is about to replace or delete into a staging
+directory of the store (rsync --backup-dir), instead of keeping it next to
+the new one with the ".odb~" suffix. The staging directory is then
+ingested: each file is hashed (SHA-1, read in blocks by a few threads) and
+moved to objects/<first 2 hex digits>/<other 38 digits>, unless an object
+with the same contents exists already, in which case the staged copy is
+simply removed. A manifest listing the path, metadata and hash of every
+version kept by the backup is written to manifests/. The store lives next
+to the backup directory:
+
+  <localmount>/<user>/__versions__/<hostname>/
+    objects/    file contents, named after their hash
+    manifests/  one file per backup, see Ingest
+    staging/    versions moved away by running backups
+
+Moving a file into the store is a rename (the store is on the same
+filesystem as the backup directory), so an unchanged or duplicate file
+costs no additional bytes nor writes; only modified contents take space,
+once. Staging directories left behind by a crash are ingested on the next
+start (see Recover).
+
+Objects are left as they were moved in: changing their mode would change
+every other link to the same file, and the manifests record it anyway.
+Manifests older than "keepversions" seconds are removed once a day, along
+with the objects no other manifest uses (see Expire), which bounds the
+store to the versions of that period.
+"""
+
+import errno
+import marshal
+import os
+import stat
+import tempfile
+import threading
+import time
+
+try:
+  import hashlib
+  NewHash = hashlib.sha1
+except ImportError:
+  # Python 2.4
+  import sha
+  NewHash = sha.new
+
+MANIFEST_VERSION = 1
+# Bytes hashed at a time.
+HASH_BLOCK = 1024 * 1024
+# Threads hashing the files of one staging directory.
+HASH_WORKERS = 4
+# Seconds a version is kept, by default (30 days).
+KEEP_VERSIONS = 2592000
+# Seconds between two expiries of the store.
+EXPIRE_INTERVAL = 86400
+# Format of the time prefixing the names of manifests and staging
+# directories.
+NAME_TIME_FORMAT = '%Y%m%d%H%M%S'
+
+
+def HashFile(path):
+  """Returns the hex SHA-1 digest of the contents of a file."""
+
+  digest = NewHash()
+  hashfile = file(path, 'rb')
+  try:
+    while True:
+      data = hashfile.read(HASH_BLOCK)
+      if not data:
+        break
+      digest.update(data)
+  finally:
+    hashfile.close()
+  return digest.hexdigest()
+
+
+def ReadManifest(filename):
+  """Read a manifest written by VersionStore.Ingest.
+
+  Returns:
+    Tuple - (header, files) dictionaries, see VersionStore.WriteManifest.
+      None if the manifest cannot be read.
+  """
+
+  try:
+    manifest = file(filename, 'rb')
+    try:
+      header = marshal.load(manifest)
+      if header.get('version') != MANIFEST_VERSION:
+        return None
+      files = marshal.load(manifest)
+    finally:
+      manifest.close()
+  except (IOError, EOFError, ValueError, TypeError, AttributeError):
+    return None
+  return header, files
+
+
+class VersionStore:
+  """Stores previous versions by content, see module docstring."""
+
+  def __init__(self, storedir, loghandle, workers=HASH_WORKERS):
+    """Initialise the store.
+
+    Args:
+      storedir: String - Directory of the store. Created when first used.
+      loghandle: Object - Handle to the logging object.
+      workers: Integer - Threads hashing the files of a staging directory.
+    """
+
+    self.storedir = storedir
+    self.objectdir = os.path.join(storedir, 'objects')
+    self.manifestdir = os.path.join(storedir, 'manifests')
+    self.stagingdir = os.path.join(storedir, 'staging')
+    self.loghandle = loghandle
+    self.workers = max(1, workers)
+    # Ingests and Expire do not run at the same time: an ingest may use
+    # objects which no manifest lists yet.
+    self.ready = threading.Condition()
+    self.ingesting = 0
+    self.collecting = False
+
+  def NewStaging(self):
+    """Create a staging directory for the versions replaced by a backup.
+
+    Returns:
+      String - Path of the staging directory, None on error.
+    """
+
+    try:
+      for dirpath in (self.objectdir, self.manifestdir, self.stagingdir):
+        if not os.path.isdir(dirpath):
+          os.makedirs(dirpath, 0700)
+      return tempfile.mkdtemp('', time.strftime(NAME_TIME_FORMAT + '-'),
+                              self.stagingdir)
+    except OSError, e:
+      self.loghandle.logger.error('Version store: %s', e)
+      return None
+
+  def ObjectPath(self, digest):
+    """Returns the path of the object holding the contents with digest."""
+
+    return os.path.join(self.objectdir, digest[:2], digest[2:])
+
+  def Ingest(self, staging, name):
+    """Move the versions found in a staging directory into the store.
+
+    Blocking, meant to run in a worker thread. Files which could not be
+    stored are left in the staging directory, which is ingested again by
+    Recover on the next start.
+
+    Args:
+      staging: String - Staging directory, see NewStaging.
+      name: String - Entry (or entries) backed up, for the manifest.
+
+    Returns:
+      String - Path of the manifest written, None if nothing was kept.
+    """
+
+    self.ready.acquire()
+    try:
+      while self.collecting:
+        self.ready.wait()
+      self.ingesting += 1
+    finally:
+      self.ready.release()
+    try:
+      return self.IngestStaging(staging, name)
+    finally:
+      self.ready.acquire()
+      try:
+        self.ingesting -= 1
+        self.ready.notifyAll()
+      finally:
+        self.ready.release()
+
+  def IngestStaging(self, staging, name):
+    """Ingest a staging directory, see Ingest."""
+
+    prefix = staging.rstrip('/')
+    files = []
+    links = []
+    for dirpath, dirnames, filenames in os.walk(staging):
+      for filename in filenames:
+        staged = os.path.join(dirpath, filename)
+        try:
+          st = os.lstat(staged)
+        except OSError:
+          continue
+        if stat.S_ISREG(st.st_mode):
+          files.append((staged, st))
+        elif stat.S_ISLNK(st.st_mode):
+          links.append((staged, st))
+    # Backed up path => (hash or None, mode, size, mtime, uid, gid, symlink
+    # target or None)
+    manifest = {}
+    for staged, st in links:
+      try:
+        target = os.readlink(staged)
+        os.remove(staged)
+      except OSError, e:
+        self.loghandle.logger.warning('Version store: %s', e)
+        continue
+      manifest[staged[len(prefix):]] = (None, st.st_mode, st.st_size,
+                                        int(st.st_mtime), st.st_uid,
+                                        st.st_gid, target)
+    stored = self.StoreFiles(files, prefix, manifest)
+    self.RemoveEmpty(staging)
+    if not manifest:
+      return None
+    manifestname = self.WriteManifest(manifest, name)
+    self.loghandle.logger.debug('Version store: %s versions of %s kept, %s'
+                                ' bytes of new contents', len(manifest), name,
+                                stored)
+    return manifestname
+
+  def StoreFiles(self, files, prefix, manifest):
+    """Hash files and move them into the store, with a few threads.
+
+    Args:
+      files: List - (staged path, lstat result) tuples.
+      prefix: String - Staging directory, removed from the staged paths.
+      manifest: Dictionary - Filled in, see Ingest.
+
+    Returns:
+      Integer - Bytes of contents which were not in the store before.
+    """
+
+    queue = list(files)
+    lock = threading.Lock()
+    # Bytes of new contents, a list so that the threads can add to it.
+    stored = [0]
+    args = (queue, lock, prefix, manifest, stored)
+    threads = []
+    for number in xrange(min(self.workers, len(queue)) - 1):
+      thread = threading.Thread(target=self.HashWorker, args=args,
+                                name='VersionStore-%d' % number)
+      thread.setDaemon(True)
+      thread.start()
+      threads.append(thread)
+    # The calling thread hashes too.
+    self.HashWorker(*args)
+    for thread in threads:
+      thread.join()
+    return stored[0]
+
+  def HashWorker(self, queue, lock, prefix, manifest, stored):
+    """Store the files of queue until it is empty, see StoreFiles."""
+
+    while True:
+      lock.acquire()
+      try:
+        if not queue:
+          return
+        staged, st = queue.pop()
+      finally:
+        lock.release()
+      try:
+        digest = HashFile(staged)
+        added = self.StoreObject(staged, digest)
+      except (IOError, OSError), e:
+        self.loghandle.logger.warning('Version store: %s', e)
+        continue
+      lock.acquire()
+      try:
+        manifest[staged[len(prefix):]] = (digest, st.st_mode, st.st_size,
+                                          int(st.st_mtime), st.st_uid,
+                                          st.st_gid, None)
+        if added:
+          stored[0] += st.st_size
+      finally:
+        lock.release()
+
+  def StoreObject(self, staged, digest):
+    """Move a staged file to its object, or drop it if the object exists.
+
+    Returns:
+      Boolean - True if a new object was added.
+    """
+
+    objpath = self.ObjectPath(digest)
+    if os.path.exists(objpath):
+      os.remove(staged)
+      return False
+    objdir = os.path.dirname(objpath)
+    try:
+      os.mkdir(objdir, 0700)
+    except OSError, e:
+      if e.errno != errno.EEXIST:
+        raise
+    os.rename(staged, objpath)
+    return True
+
+  def RemoveEmpty(self, staging):
+    """Remove the directories of staging which are empty, staging included."""
+
+    for dirpath, dirnames, filenames in os.walk(staging, topdown=False):
+      try:
+        os.rmdir(dirpath)
+      except OSError:
+        pass
+
+  def WriteManifest(self, manifest, name):
+    """Write the manifest of one backup.
+
+    The file holds two marshal'ed dictionaries: a header (version, time of
+    the backup, entry name) and backed up path => (hash, mode, size, mtime,
+    uid, gid, symlink target). Manifests are named after the time of the
+    backup, so they sort in backup order.
+
+    Returns:
+      String - Path of the manifest, None on error.
+    """
+
+    header = {'version': MANIFEST_VERSION, 'time': time.time(),
+              'entry': name}
+    data = marshal.dumps(header) + marshal.dumps(manifest)
+    try:
+      fd, tmpname = tempfile.mkstemp('.tmp', time.strftime(NAME_TIME_FORMAT + '-'),
+                                     self.manifestdir)
+      try:
+        while data:
+          written = os.write(fd, data)
+          data = data[written:]
+        os.fsync(fd)
+      finally:
+        os.close(fd)
+      manifestname = tmpname[:-len('.tmp')] + '.manifest'
+      os.rename(tmpname, manifestname)
+    except OSError, e:
+      self.loghandle.logger.error('Version store: failed to write manifest:'
+                                  ' %s', e)
+      return None
+    return manifestname
+
+  def Expire(self, maxage):
+    """Remove the old manifests, and the objects no other manifest uses.
+
+    Blocking, meant to run in a worker thread. Ingests wait while objects
+    are collected; the pass is skipped if one is running, or if a manifest
+    which is kept cannot be read (its objects are unknown).
+
+    Args:
+      maxage: Integer - Seconds a manifest is kept.
+
+    Returns:
+      Integer - Bytes of objects removed.
+    """
+
+    self.ready.acquire()
+    try:
+      if self.ingesting:
+        self.loghandle.logger.debug('Version store: ingest running, expiry'
+                                    ' skipped')
+        return 0
+      self.collecting = True
+    finally:
+      self.ready.release()
+    try:
+      return self.Collect(time.time() - maxage)
+    finally:
+      self.ready.acquire()
+      try:
+        self.collecting = False
+        self.ready.notifyAll()
+      finally:
+        self.ready.release()
+
+  def Collect(self, oldest):
+    """Remove the manifests written before oldest and unused objects.
+
+    Args:
+      oldest: Float - Time of the oldest manifest kept.
+
+    Returns:
+      Integer - Bytes of objects removed.
+    """
+
+    try:
+      names = os.listdir(self.manifestdir)
+    except OSError:
+      return 0
+    used = {}
+    expired = 0
+    for name in names:
+      if not name.endswith('.manifest'):
+        continue
+      filename = os.path.join(self.manifestdir, name)
+      try:
+        written = time.mktime(time.strptime(name[:14], NAME_TIME_FORMAT))
+      except ValueError:
+        written = None
+      if written is not None and written < oldest:
+        try:
+          os.remove(filename)
+          expired += 1
+          continue
+        except OSError, e:
+          self.loghandle.logger.warning('Version store: %s', e)
+      manifest = ReadManifest(filename)
+      if manifest is None:
+        self.loghandle.logger.warning('Version store: cannot read %s, no'
+                                      ' object removed', filename)
+        return 0
+      for meta in manifest[1].itervalues():
+        if meta[0] is not None:
+          used[meta[0]] = True
+    freed = 0
+    removed = 0
+    try:
+      subdirs = os.listdir(self.objectdir)
+    except OSError:
+      subdirs = []
+    for subdir in subdirs:
+      objdir = os.path.join(self.objectdir, subdir)
+      try:
+        objnames = os.listdir(objdir)
+      except OSError:
+        continue
+      for objname in objnames:
+        if subdir + objname in used:
+          continue
+        objpath = os.path.join(objdir, objname)
+        try:
+          size = os.lstat(objpath).st_size
+          os.remove(objpath)
+        except OSError, e:
+          self.loghandle.logger.warning('Version store: %s', e)
+          continue
+        freed += size
+        removed += 1
+    self.loghandle.logger.info('Version store: %s manifests expired, %s'
+                               ' objects (%s bytes) removed', expired,
+                               removed, freed)
+    return freed
+
+  def Recover(self):
+    """Ingest the staging directories left behind by an earlier run."""
+
+    try:
+      names = os.listdir(self.stagingdir)
+    except OSError:
+      return
+    names.sort()
+    for name in names:
+      staging = os.path.join(self.stagingdir, name)
+      if os.path.isdir(staging):
+        self.loghandle.logger.info('Version store: recovering %s', staging)
+        self.Ingest(staging, 'recovered')